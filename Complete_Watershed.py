@@ -1,7 +1,8 @@
 #-------------------------------------------------------------------------------
 # Name:        Complete Watershed Tool
 # Purpose:      For use in the Outfall Delineation. Note that this tool
-# requires the Spatial Analyst extension, and is for use with ArcGIS 10.2.
+# requires the Spatial Analyst extension with the default ARCGIS engine (the
+# NUMPY and TILED engines do not), and is for use with ArcGIS 10.2.
 #
 # Author:      Eliza Wallace, GIS Analyst, Metropolitan Area Planning Council
 #
@@ -11,10 +12,15 @@
 import arcpy
 import sys
 import os
+import numpy as np
 from arcpy import sa
 from arcpy.sa import *
 from arcpy import env
 
+import hydrology
+import hydrology_cache
+import hydrology_tiles
+
 # Get inputs
 
 workspace = arcpy.GetParameterAsText(0)
@@ -25,6 +31,36 @@ snap = arcpy.GetParameterAsText(4)
 outwtrshd = arcpy.GetParameterAsText(5)
 outpoly = arcpy.GetParameterAsText(6)
 
+# Parameters 7-11 are not in the toolbox (.tbx) files; they keep their
+# defaults unless added to the script tool (see README.md)
+
+# Optional: 'NUMPY' computes the hydrology rasters with hydrology.py instead
+# of Spatial Analyst ('ARCGIS', the default); 'TILED' with hydrology_tiles.py,
+# for DEMs larger than memory
+engine = arcpy.GetParameterAsText(7).upper()
+if not engine: engine = 'ARCGIS'
+if engine not in ['ARCGIS', 'NUMPY', 'TILED']:
+    arcpy.AddError('ERROR: Unknown hydrology engine ' + engine + ' (ARCGIS, NUMPY or TILED)')
+    raise arcpy.ExecuteError('Unknown hydrology engine ' + engine)
+
+# Optional: number of threads for the NUMPY flow accumulation
+threads = arcpy.GetParameterAsText(8)
+threads = int(threads) if threads else 1
+
+# Optional: peak working memory of the TILED engine, in MB
+max_memory = arcpy.GetParameterAsText(9)
+max_memory = float(max_memory) if max_memory else hydrology_tiles.DEFAULT_MEMORY
+blocksize = hydrology_tiles.tile_size(max_memory)
+
+# Optional: folder in which the hydrology rasters are kept between runs, by
+# DEM content; and its disk budget, in MB
+cachefolder = arcpy.GetParameterAsText(10)
+cachebudget = arcpy.GetParameterAsText(11)
+cachebudget = float(cachebudget) if cachebudget else hydrology_cache.DEFAULT_BUDGET
+
+# Fill z-limit
+zlimit = 1
+
 # set environment settings
 env.workspace = workspace
 
@@ -119,47 +155,198 @@ def AutoName(raster):
 
     return newname
 
+# reads a raster into a numpy array, with NoData as NaN (or "nodata" for
+# integer rasters)
+def RasterArray(raster, nodata = np.nan):
+    return arcpy.RasterToNumPyArray(raster, nodata_to_value = nodata)
+
+# saves a numpy array as a raster on the grid of "template"
+def SaveArray(array, template, outname, nodata = np.nan):
+    desc = arcpy.Describe(template)
+    lowerleft = arcpy.Point(desc.extent.XMin, desc.extent.YMin)
+    raster = arcpy.NumPyArrayToRaster(array, lowerleft, desc.meanCellWidth, desc.meanCellHeight, nodata)
+    raster.save(outname)
+    arcpy.DefineProjection_management(outname, desc.spatialReference)
+
+# path of a temporary .npy file for the TILED engine
+def ArrayFile(name):
+    return os.path.join(arcpy.env.scratchFolder, lidarname + "_" + name + ".npy")
+
+# reads a raster block by block: yields the rows and columns (r0, r1, c0, c1)
+# of every block and its values, with NoData as "nodata"
+def RasterBlocks(raster, nodata = np.nan):
+    desc = arcpy.Describe(raster)
+    for (r0, r1, c0, c1) in hydrology_tiles.tile_grid((desc.height, desc.width), blocksize):
+        corner = arcpy.Point(desc.extent.XMin + c0*desc.meanCellWidth, desc.extent.YMax - r1*desc.meanCellHeight)
+        yield (r0, r1, c0, c1), arcpy.RasterToNumPyArray(raster, corner, c1 - c0, r1 - r0, nodata)
+
+# copies a raster into a .npy file, block by block
+def RasterToArrayFile(raster, path, dtype = np.float32, nodata = np.nan):
+    desc = arcpy.Describe(raster)
+    array = hydrology_tiles.create_array(path, (desc.height, desc.width), dtype)
+    for ((r0, r1, c0, c1), block) in RasterBlocks(raster, nodata):
+        array[r0:r1, c0:c1] = block
+    del array
+
+# saves a .npy file as a raster on the grid of "template", block by block
+PIXEL_TYPES = {'float32': '32_BIT_FLOAT', 'uint8': '8_BIT_UNSIGNED', 'int32': '32_BIT_SIGNED'}
+def ArrayFileToRaster(path, template, outname, nodata):
+    desc = arcpy.Describe(template)
+    array = hydrology_tiles.open_array(path)
+    blocks = []
+    for (r0, r1, c0, c1) in hydrology_tiles.tile_grid(array.shape, blocksize):
+        corner = arcpy.Point(desc.extent.XMin + c0*desc.meanCellWidth, desc.extent.YMax - r1*desc.meanCellHeight)
+        block = arcpy.NumPyArrayToRaster(np.array(array[r0:r1, c0:c1]), corner, desc.meanCellWidth, desc.meanCellHeight, nodata)
+        blockname = os.path.join(arcpy.env.scratchFolder, "block" + str(len(blocks)) + ".tif")
+        block.save(blockname)
+        blocks.append(blockname)
+    pixeltype = PIXEL_TYPES[array.dtype.name]
+    del array
+    arcpy.MosaicToNewRaster_management(blocks, os.path.dirname(outname) or workspace, os.path.basename(outname),
+                                       desc.spatialReference, pixeltype, desc.meanCellWidth, 1)
+    for blockname in blocks:
+        arcpy.Delete_management(blockname)
+
+# parameters the hydrology rasters of the lidar depend on, besides its values
+# (the NUMPY and TILED engines give the same rasters)
+def HydrologyParameters(raster):
+    desc = arcpy.Describe(raster)
+    return {'extent': [desc.extent.XMin, desc.extent.YMin, desc.extent.XMax, desc.extent.YMax],
+            'cellsize': [desc.meanCellWidth, desc.meanCellHeight],
+            'spatialreference': desc.spatialReference.exportToString(),
+            'engine': 'ARCGIS' if engine == 'ARCGIS' else 'NUMPY',
+            'zlimit': zlimit}
+
+# name of a hydrology raster of the lidar: a new name next to the lidar, or
+# its place in the cache
+def HydrologyRaster(product):
+    if cache is None:
+        return AutoName(lidar + "_" + product)
+    path = cache.path(fingerprint, product)
+    if cache.get(fingerprint, product) is None and arcpy.Exists(path):
+        arcpy.Delete_management(path) # left over by an interrupted run
+    return path
+
+# checks whether a hydrology raster of the lidar is in the cache
+def Cached(product):
+    return cache is not None and cache.get(fingerprint, product) is not None
+
+# records a new hydrology raster of the lidar in the cache
+def Store(product):
+    if cache is not None:
+        cache.put(fingerprint, product)
+
 try: 
+    if cachefolder:
+        arcpy.AddMessage("Fingerprinting the DEM...")
+
+        cache = hydrology_cache.HydrologyCache(cachefolder, cachebudget)
+        fingerprint = hydrology_cache.dem_fingerprint((block for (rows, block) in RasterBlocks(lidar)), HydrologyParameters(lidar))
+    else:
+        cache = None
+
     # fill sinks
 
     arcpy.AddMessage("Filling the sinks in the DEM...")
 
-    fill = lidar + "_fill"
-    fill = AutoName(fill)
-    outfill = fill
-    fill = arcpy.sa.Fill(lidar, 1)
+    outfill = HydrologyRaster("fill")
+
+    if Cached("fill"):
+        arcpy.AddMessage("Using the cached filled DEM " + outfill + "...")
+    elif engine == 'NUMPY':
+        message = "Saving filled DEM as " + outfill + "..."
+        arcpy.AddMessage(message)
 
-    message = "Saving filled DEM as " + outfill + "..."
-    arcpy.AddMessage(message)
+        SaveArray(hydrology.fill(RasterArray(lidar), zlimit).astype(np.float32), lidar, outfill)
+    elif engine == 'TILED':
+        RasterToArrayFile(lidar, ArrayFile("dem"))
+        dem = hydrology_tiles.open_array(ArrayFile("dem"))
+        filled = hydrology_tiles.create_array(ArrayFile("fill"), dem.shape, np.float32)
+        hydrology_tiles.fill(dem, filled, zlimit, max_memory, arcpy.env.scratchFolder)
+        del dem, filled
+        os.remove(ArrayFile("dem"))
 
-    fill.save(outfill)
+        message = "Saving filled DEM as " + outfill + "..."
+        arcpy.AddMessage(message)
+
+        ArrayFileToRaster(ArrayFile("fill"), lidar, outfill, np.nan)
+    else:
+        fill = arcpy.sa.Fill(lidar, zlimit)
+
+        message = "Saving filled DEM as " + outfill + "..."
+        arcpy.AddMessage(message)
+
+        fill.save(outfill)
+    Store("fill")
 
     # create flow direction raster
 
     arcpy.AddMessage("Creating the flow direction raster...")
 
-    flowdir = lidar + "_flwdir"
-    flowdir = AutoName(flowdir)
-    outflowdir = flowdir
-    flowdir = arcpy.sa.FlowDirection(outfill,"NORMAL")
+    outflowdir = HydrologyRaster("flwdir")
 
-    message = "Saving flow direction raster as " + outflowdir + "..."
-    arcpy.AddMessage(message)
+    if Cached("flwdir"):
+        arcpy.AddMessage("Using the cached flow direction raster " + outflowdir + "...")
+    elif engine == 'NUMPY':
+        message = "Saving flow direction raster as " + outflowdir + "..."
+        arcpy.AddMessage(message)
 
-    flowdir.save(outflowdir)
+        # ESRI codes; cells that cannot drain get 0, NoData cells 255
+        SaveArray(hydrology.flow_direction(RasterArray(outfill)), lidar, outflowdir, hydrology.NODATA_DIRECTION)
+    elif engine == 'TILED':
+        if not os.path.exists(ArrayFile("fill")): # cached filled DEM
+            RasterToArrayFile(outfill, ArrayFile("fill"))
+        filled = hydrology_tiles.open_array(ArrayFile("fill"))
+        direction = hydrology_tiles.create_array(ArrayFile("flwdir"), filled.shape, np.uint8)
+        hydrology_tiles.flow_direction(filled, direction, max_memory, arcpy.env.scratchFolder)
+        del filled, direction
+
+        message = "Saving flow direction raster as " + outflowdir + "..."
+        arcpy.AddMessage(message)
+
+        ArrayFileToRaster(ArrayFile("flwdir"), lidar, outflowdir, hydrology.NODATA_DIRECTION)
+    else:
+        flowdir = arcpy.sa.FlowDirection(outfill,"NORMAL")
+
+        message = "Saving flow direction raster as " + outflowdir + "..."
+        arcpy.AddMessage(message)
+
+        flowdir.save(outflowdir)
+    Store("flwdir")
 
     # create flow accumulation raster
     arcpy.AddMessage("Creating the flow accumulation raster. This may take a while...")
 
-    flowacc = lidar + "_flwacc"
-    flowacc = AutoName(flowacc)
-    outflowacc = flowacc
-    flowacc = arcpy.sa.FlowAccumulation(outflowdir)
+    outflowacc = HydrologyRaster("flwacc")
 
-    message = "Saving flow accumulation raster as " + outflowacc + "..."
-    arcpy.AddMessage(message)
+    if Cached("flwacc"):
+        arcpy.AddMessage("Using the cached flow accumulation raster " + outflowacc + "...")
+    elif engine == 'NUMPY':
+        message = "Saving flow accumulation raster as " + outflowacc + "..."
+        arcpy.AddMessage(message)
 
-    flowacc.save(outflowacc)
+        flowacc = hydrology.flow_accumulation(RasterArray(outflowdir, hydrology.NODATA_DIRECTION), threads = threads)
+        SaveArray(flowacc, lidar, outflowacc, -1)
+    elif engine == 'TILED':
+        if not os.path.exists(ArrayFile("flwdir")): # cached flow direction raster
+            RasterToArrayFile(outflowdir, ArrayFile("flwdir"), np.uint8, hydrology.NODATA_DIRECTION)
+        direction = hydrology_tiles.open_array(ArrayFile("flwdir"))
+        flowacc = hydrology_tiles.create_array(ArrayFile("flwacc"), direction.shape, np.int32)
+        hydrology_tiles.flow_accumulation(direction, flowacc, None, max_memory, arcpy.env.scratchFolder)
+        del direction, flowacc
+
+        message = "Saving flow accumulation raster as " + outflowacc + "..."
+        arcpy.AddMessage(message)
+
+        ArrayFileToRaster(ArrayFile("flwacc"), lidar, outflowacc, -1)
+    else:
+        flowacc = arcpy.sa.FlowAccumulation(outflowdir)
+
+        message = "Saving flow accumulation raster as " + outflowacc + "..."
+        arcpy.AddMessage(message)
+
+        flowacc.save(outflowacc)
+    Store("flwacc")
 
     # snap pour points
     arcpy.AddMessage("Snapping pour points...")
@@ -168,19 +355,79 @@ try:
     pptsnap = pour + "_snp"
     pptsnap = AutoName(pptsnap)
     outppt = pptsnap
-    pptsnap = arcpy.sa.SnapPourPoint(pour,outflowacc,snap,pptfield)
 
-    message = "Saving pour point raster as " + outppt + "..."
+    if engine == 'ARCGIS':
+        pptsnap = arcpy.sa.SnapPourPoint(pour,outflowacc,snap,pptfield)
 
-    arcpy.AddMessage(message)
+        message = "Saving pour point raster as " + outppt + "..."
 
-    pptsnap.save(outppt)
+        arcpy.AddMessage(message)
+
+        pptsnap.save(outppt)
+    else:
+        # pour points on the cells of the lidar; points off the lidar are
+        # left out, as by SnapPourPoint
+        desc = arcpy.Describe(lidar)
+        (rows, cols, values) = ([], [], [])
+        with arcpy.da.SearchCursor(pour, ["SHAPE@XY", pptfield], None, desc.spatialReference) as cursor:
+            for ((x, y), value) in cursor:
+                row = int(np.floor((desc.extent.YMax - y)/desc.meanCellHeight))
+                col = int(np.floor((x - desc.extent.XMin)/desc.meanCellWidth))
+                if value is not None and 0 <= row < desc.height and 0 <= col < desc.width:
+                    rows.append(row)
+                    cols.append(col)
+                    values.append(value)
+        ppnodata = np.iinfo(np.int32).min
+
+        if engine == 'NUMPY':
+            flowacc = RasterArray(outflowacc, -1)
+        else:
+            if not os.path.exists(ArrayFile("flwacc")): # cached flow accumulation raster
+                RasterToArrayFile(outflowacc, ArrayFile("flwacc"), np.int32, -1)
+            flowacc = hydrology_tiles.open_array(ArrayFile("flwacc"))
+        (rows, cols) = hydrology.snap_pour_points(flowacc, rows, cols, snap/desc.meanCellWidth)
+        del flowacc
+
+        message = "Saving pour point raster as " + outppt + "..."
+
+        arcpy.AddMessage(message)
+
+        if engine == 'NUMPY':
+            pptsnap = np.full((desc.height, desc.width), ppnodata, dtype = np.int32)
+            pptsnap[rows, cols] = values
+            SaveArray(pptsnap, lidar, outppt, ppnodata)
+        else:
+            pptsnap = hydrology_tiles.create_array(ArrayFile("pour"), (desc.height, desc.width), np.int32)
+            for (r0, r1, c0, c1) in hydrology_tiles.tile_grid(pptsnap.shape, blocksize):
+                pptsnap[r0:r1, c0:c1] = ppnodata
+            pptsnap[rows, cols] = values
+            del pptsnap
+            ArrayFileToRaster(ArrayFile("pour"), lidar, outppt, ppnodata)
 
     # create watershed raster
     arcpy.AddMessage("Creating watershed raster...")
 
-    wtrshd = arcpy.sa.Watershed(outflowdir,outppt,"Value")
-    wtrshd.save(outwtrshd)
+    if engine == 'NUMPY':
+        SaveArray(hydrology.watershed(RasterArray(outflowdir, hydrology.NODATA_DIRECTION), pptsnap, ppnodata),
+                  lidar, outwtrshd, ppnodata)
+        del pptsnap
+    elif engine == 'TILED':
+        if not os.path.exists(ArrayFile("flwdir")): # cached flow direction raster
+            RasterToArrayFile(outflowdir, ArrayFile("flwdir"), np.uint8, hydrology.NODATA_DIRECTION)
+        direction = hydrology_tiles.open_array(ArrayFile("flwdir"))
+        pptsnap = hydrology_tiles.open_array(ArrayFile("pour"))
+        wtrshd = hydrology_tiles.create_array(ArrayFile("wtrshd"), direction.shape, np.int32)
+        hydrology_tiles.watershed(direction, pptsnap, wtrshd, ppnodata, max_memory, arcpy.env.scratchFolder)
+        del direction, pptsnap, wtrshd
+        ArrayFileToRaster(ArrayFile("wtrshd"), lidar, outwtrshd, ppnodata)
+    else:
+        wtrshd = arcpy.sa.Watershed(outflowdir,outppt,"Value")
+        wtrshd.save(outwtrshd)
+
+    # remove the temporary files of the TILED engine
+    for name in ["fill", "flwdir", "flwacc", "pour", "wtrshd"]:
+        if os.path.exists(ArrayFile(name)):
+            os.remove(ArrayFile(name))
     
     arcpy.AddMessage("Creating watershed vector...")
     
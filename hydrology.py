@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Hydrology Engine
+Purpose:     NumPy versions of the Spatial Analyst hydrology tools used by
+             Complete_Watershed.py, so that catchments can be delineated
+             without ArcGIS (e.g. on Linux batch servers).
+
+             fill: sink filling, as arcpy.sa.Fill. Every cell is raised to
+             the lowest elevation at which water can leave it for the edge of
+             the raster or a NoData (NaN) cell, along 8-connected paths. This
+             is the result of a Priority-Flood, computed on the graph of
+             drainage basins rather than cell by cell:
+
+               1. Every cell is linked to its steepest lower neighbour
+                  (shifted-array arithmetic) and the links are followed with
+                  pointer jumping to the pit, or the outlet, each cell drains
+                  to. Cells on the edge or next to NaN cells are outlets.
+               2. The spill elevation between two neighbouring basins is the
+                  lowest max(z, z') over the pairs of neighbouring cells that
+                  straddle them.
+               3. A Priority-Flood of the basin graph (a heap of basins by
+                  spill elevation, and a plain queue for basins that drain at
+                  the current level) gives the level of every basin, and a
+                  cell's filled elevation is max(z, level of its basin).
+
+             Only steps 1 and 2 touch every cell, with array operations; the
+             Python loop runs over basins, which are far fewer than cells.
+
+             flow_direction: D8 flow direction, as arcpy.sa.FlowDirection
+             with the "NORMAL" edge option, in the ESRI encoding (1 = E,
+             2 = SE, 4 = S ... 128 = NE). Every cell flows to its steepest
+             lower neighbour; edge cells and cells next to NaN cells with no
+             lower neighbour flow out of the raster. Flats (cells with no
+             lower neighbour, e.g. filled sinks) are resolved as in Barnes,
+             Lehman and Mulla (2014), "An efficient assignment of drainage
+             direction over flat surfaces": breadth-first distances from the
+             flat's outlets (gradient towards lower terrain) and from its
+             higher rim (gradient away from higher terrain) are combined, and
+             every flat cell flows to the neighbour of the same flat with the
+             lowest combination. The searches run level by level on arrays of
+             flat cell indices, so the cost is proportional to the number of
+             flat cells. Cells that cannot drain (sinks left by a z-limit,
+             closed flats) get 0 and stay valid cells; NaN cells get
+             NODATA_DIRECTION (255), which is saved as the raster's NoData.
+
+             flow_accumulation: number of upstream cells (or sum of their
+             weights) of every cell, as arcpy.sa.FlowAccumulation. The D8
+             graph is processed in topological order, level by level: the
+             cells with no upstream cells left pass their totals to their
+             downstream cells (a sort and a reduceat over the arrays of cell
+             indices), whose in-degrees drop; the cells that reach 0 form the
+             next level. Every cell is handled once, so the cost is linear in
+             the number of cells. Drainage basins are independent, so they
+             can be split among threads (numpy releases the GIL in the array
+             operations). Cells that cannot drain (code 0) receive flow like
+             any other cell; only NODATA_DIRECTION cells are NoData.
+
+             snap_pour_points and watershed: pour points are moved to the
+             cell of highest flow accumulation near them, as
+             arcpy.sa.SnapPourPoint, and every cell gets the value of the
+             first pour point downstream of it (pointer jumping along the
+             flow directions, stopped at pour points), as arcpy.sa.Watershed.
+
+"""
+
+import collections
+import heapq
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+# Neighbour offsets (row, column) in the order of the ESRI flow direction
+# codes: 1 = E, 2 = SE, 4 = S, 8 = SW, 16 = W, 32 = NW, 64 = N, 128 = NE
+D8_CODES = [1, 2, 4, 8, 16, 32, 64, 128]
+D8_OFFSETS = [(0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1)]
+D8_DISTANCES = [1.0, np.sqrt(2.0), 1.0, np.sqrt(2.0), 1.0, np.sqrt(2.0), 1.0, np.sqrt(2.0)]
+
+# Flow direction of NoData cells. Cells that cannot drain (sinks, closed
+# flats) get 0, as they are valid cells that receive flow.
+NODATA_DIRECTION = 255
+
+
+def index_dtype(ncells):
+    ''' Smallest integer type able to hold the flat index of every cell. '''
+    return(np.int32 if ncells < 2**31 - 1 else np.int64)
+
+def shifted(values, dr, dc, fill):
+    ''' Array of the neighbour of every cell at offset (dr, dc):
+    out[i, j] = values[i + dr, j + dc], or "fill" outside the array. '''
+    (nrows, ncols) = values.shape
+    out = np.full(values.shape, fill, dtype = values.dtype)
+    out[max(0, -dr):nrows - max(0, dr), max(0, -dc):ncols - max(0, dc)] = \
+        values[max(0, dr):nrows - max(0, -dr), max(0, dc):ncols - max(0, -dc)]
+    return(out)
+
+def outlet_cells(dem):
+    ''' Cells water can leave the raster from: non-NaN cells on the edge of
+    the raster or next to a NaN (NoData) cell. '''
+    nodata = np.isnan(dem)
+    outlet = np.zeros(dem.shape, dtype = bool)
+    outlet[0, :] = outlet[-1, :] = True
+    outlet[:, 0] = outlet[:, -1] = True
+    for (dr, dc) in D8_OFFSETS:
+        outlet |= shifted(nodata, dr, dc, False)
+    return(outlet & ~nodata)
+
+def steepest_neighbour(dem):
+    ''' Position in D8_OFFSETS of the steepest strictly lower neighbour of
+    every cell (drop over distance; the first in code order on ties), or -1
+    for pits, flats and NaN cells. '''
+    best = np.full(dem.shape, -1, dtype = np.int8)
+    bestdrop = np.zeros(dem.shape, dtype = dem.dtype)
+    for k in range(len(D8_OFFSETS)):
+        (dr, dc) = D8_OFFSETS[k]
+        with np.errstate(invalid = 'ignore'):
+            drop = (dem - shifted(dem, dr, dc, np.nan))/D8_DISTANCES[k]
+            better = drop > bestdrop
+        bestdrop[better] = drop[better]
+        best[better] = k
+    return(best)
+
+def receivers(neighbour):
+    ''' Flat index of the cell every cell flows to, from the positions in
+    D8_OFFSETS of its downstream neighbours (-1: none, the cell itself). '''
+    ncols = neighbour.shape[1]
+    itype = index_dtype(neighbour.size)
+    steps = np.array([dr*ncols + dc for (dr, dc) in D8_OFFSETS] + [0], dtype = itype)
+    return(np.arange(neighbour.size, dtype = itype) + steps[neighbour.ravel()])
+
+def outward_neighbour(dem):
+    ''' Position in D8_OFFSETS of a neighbour outside the raster or NaN of
+    every cell that has one (straight directions first, then diagonals, in
+    code order), or -1. '''
+    nodata = np.isnan(dem)
+    best = np.full(dem.shape, -1, dtype = np.int8)
+    for k in [0, 2, 4, 6, 1, 3, 5, 7]:
+        (dr, dc) = D8_OFFSETS[k]
+        out = shifted(nodata, dr, dc, True) & (best < 0)
+        best[out] = k
+    best[nodata] = -1
+    return(best)
+
+def steepest_descent(dem, outlet = None):
+    ''' Flat index of the steepest strictly lower neighbour of every cell,
+    or of the cell itself for pits, flats, outlets and NaN cells. '''
+    neighbour = steepest_neighbour(dem)
+    if outlet is not None:
+        neighbour[outlet] = -1
+    return(receivers(neighbour))
+
+def drainage_basins(receiver, outlet, nodata):
+    ''' Basin number of every cell from the "receiver" links (flat indices):
+    cells that drain to an outlet cell are in basin 0, those that drain to
+    any other root (a cell that is its own receiver) in basins 1, 2 ... in
+    the order of the roots, and NaN cells in -1. Returns the basins (shaped
+    as "outlet") and the flat indices of the roots of basins 1, 2 ... '''
+    root = follow(receiver)
+    roots = np.nonzero((root == np.arange(len(root))) & ~outlet.ravel() & ~nodata.ravel())[0]
+    rootbasin = np.full(len(root), -1, dtype = index_dtype(len(roots) + 1))
+    rootbasin[outlet.ravel()] = 0
+    rootbasin[roots] = np.arange(1, len(roots) + 1)
+    basin = rootbasin[root].reshape(outlet.shape)
+    basin[nodata] = -1
+    return(basin, roots)
+
+def follow(receiver):
+    ''' Root (a cell that is its own receiver) reached from every cell by
+    following "receiver" links, by pointer jumping. '''
+    root = receiver.copy()
+    while True:
+        nxt = root[root]
+        if np.array_equal(nxt, root):
+            return(root)
+        root = nxt
+
+def basin_graph(dem, basin, nbasins):
+    ''' Spill elevation between every pair of neighbouring basins: the lowest
+    max(z, z') of the neighbouring cells straddling them. Returns (basin a,
+    basin b, elevation) arrays with a < b. '''
+    pairs = list()
+    for (dr, dc) in D8_OFFSETS[:4]:
+        # Every pair of neighbours once: E, SE, S and SW of each cell
+        nbasin = shifted(basin, dr, dc, -1)
+        with np.errstate(invalid = 'ignore'):
+            spill = np.fmax(dem, shifted(dem, dr, dc, np.nan))
+        cross = (nbasin >= 0) & (basin >= 0) & (nbasin != basin) & ~np.isnan(spill)
+        a = basin[cross]
+        b = nbasin[cross]
+        pairs.append((np.minimum(a, b), np.maximum(a, b), spill[cross]))
+
+    a = np.concatenate([p[0] for p in pairs])
+    b = np.concatenate([p[1] for p in pairs])
+    spill = np.concatenate([p[2] for p in pairs])
+    return(min_spill(a, b, spill, nbasins))
+
+def min_spill(a, b, spill, nbasins):
+    ''' Lowest "spill" of every distinct pair of basins (a, b), a < b. '''
+    a = np.asarray(a, dtype = np.int64)
+    b = np.asarray(b, dtype = np.int64)
+    if len(a) == 0:
+        return(a, b, spill)
+    key = a*nbasins + b
+    order = np.argsort(key)
+    key = key[order]
+    starts = np.nonzero(np.r_[True, key[1:] != key[:-1]])[0]
+    spill = np.minimum.reduceat(spill[order], starts)
+    return(key[starts]//nbasins, key[starts] % nbasins, spill)
+
+def adjacency(nbasins, a, b, spill):
+    ''' Adjacency lists of the basin graph as flat arrays (CSR): the
+    neighbours of basin k and the spill elevations to them are
+    others[starts[k]:starts[k + 1]] and weights[starts[k]:starts[k + 1]].
+    Returns (starts, others, weights). '''
+    ends = np.r_[a, b]
+    order = np.argsort(ends, kind = 'mergesort')
+    starts = np.searchsorted(ends[order], np.arange(nbasins + 1))
+    return(starts, np.r_[b, a][order], np.r_[spill, spill][order])
+
+def flood_basins(starts, others, weights, seeds, level, closed, label = None):
+    ''' Priority-Flood of the basin graph in adjacency lists (see adjacency).
+    "seeds" maps the basins that drain out of the raster to their level.
+    Sets the level of every basin in "level" (all inf), marking the basins
+    done in "closed" (all False); lists, or arrays on disk for graphs larger
+    than memory (see hydrology_tiles.fill). With a "label" list, every basin
+    also gets the label of the basin it is flooded from (seeds keep
+    theirs). '''
+    heap = [(z, k) for (k, z) in seeds.items()]
+    heapq.heapify(heap)
+    pitqueue = collections.deque()
+    while heap or pitqueue:
+        if pitqueue:
+            (z, k) = pitqueue.popleft()
+        else:
+            (z, k) = heapq.heappop(heap)
+            if closed[k]:
+                continue
+        closed[k] = True
+        level[k] = z
+
+        for j in range(starts[k], starts[k + 1]):
+            other = others[j]
+            if closed[other]:
+                continue
+            w = weights[j]
+            if w <= z:
+                # Drains at the current level: no need for the heap
+                closed[other] = True
+                pitqueue.append((z, other))
+            elif w < level[other]:
+                level[other] = w
+                heapq.heappush(heap, (w, other))
+            else:
+                continue
+            if label is not None:
+                label[other] = label[k]
+
+def terminal_graph(nbasins, a, b, spill, terminals):
+    ''' Graph between some basins of the graph (a, b, spill), the
+    "terminals", that keeps the bottleneck (the lowest highest spill of any
+    path) between every pair of them: every basin joins the terminal it is
+    flooded from, and the spills between the basins of two terminals,
+    raised to the levels on both sides, become edges between them. Returns
+    (terminal a, terminal b, spill) arrays with a < b. '''
+    (starts, others, weights) = adjacency(nbasins, a, b, spill)
+    level = [np.inf]*nbasins
+    label = [-1]*nbasins
+    for t in terminals:
+        (level[t], label[t]) = (-np.inf, t)
+    flood_basins(starts.tolist(), others.tolist(), weights.tolist(), dict((t, -np.inf) for t in terminals),
+                 level, [False]*nbasins, label)
+    level = np.array(level)
+    label = np.array(label)
+    (la, lb) = (label[a], label[b])
+    cross = (la != lb) & (la >= 0) & (lb >= 0)
+    spill = np.maximum(np.maximum(level[a], level[b]), spill)[cross]
+    return(min_spill(np.minimum(la, lb)[cross], np.maximum(la, lb)[cross], spill, nbasins))
+
+def components(n, a, b):
+    ''' Connected component of every node 0 ... n - 1 of the graph with
+    edges (a, b), numbered by its smallest node: roots are hooked under
+    smaller roots and paths compressed until no edge joins two roots. '''
+    label = np.arange(n)
+    while True:
+        la = label[a]
+        lb = label[b]
+        join = la != lb
+        if not join.any():
+            return(label)
+        lo = np.minimum(la, lb)[join]
+        hi = np.maximum(la, lb)[join]
+        order = np.lexsort((lo, hi))
+        hi = hi[order]
+        first = np.r_[True, hi[1:] != hi[:-1]]
+        label[hi[first]] = np.minimum(label[hi[first]], lo[order][first])
+        label = follow(label)
+
+def depressions(level, a, b, spill, pit):
+    ''' Depression of every raised basin (level above its pit): the
+    component of the basins at the same level joined by spills no higher,
+    numbered by its smallest basin, or -1 for basins that are not raised.
+    Unlike the order of the flood, this does not depend on how the cells
+    are divided into basins. '''
+    joined = (level[a] == level[b]) & (spill <= level[a]) & (a > 0)
+    label = components(len(level), a[joined], b[joined])
+    return(np.where(level > pit, label, -1))
+
+def basin_levels(nbasins, a, b, spill, pit, z_limit = None, cell = None):
+    ''' Level of every basin of the graph (a, b, spill), with basin 0 the
+    outlet and "pit" the lowest elevation of every basin. With a "z_limit",
+    depressions deeper than the limit get their lowest basin as an extra
+    outlet, until none is too deep; between basins as low, the one whose
+    lowest cell comes first in "cell" (flat indices in the raster). '''
+    (starts, others, weights) = adjacency(nbasins, a, b, spill)
+    (starts, others, weights) = (starts.tolist(), others.tolist(), weights.tolist())
+    seeds = {0: -np.inf}
+    while True:
+        level = [np.inf]*nbasins
+        flood_basins(starts, others, weights, seeds, level, [False]*nbasins)
+        level = np.array(level)
+        if z_limit is None:
+            return(level)
+        depression = depressions(level, a, b, spill, pit)
+        raised = np.nonzero(depression >= 0)[0]
+        if len(raised) == 0:
+            return(level)
+        keys = (pit[raised], depression[raised])
+        if cell is not None:
+            keys = (cell[raised],) + keys
+        order = raised[np.lexsort(keys)]
+        dep = depression[order]
+        first = np.r_[True, dep[1:] != dep[:-1]]
+        lowest = order[first]
+        deep = lowest[level[lowest] - pit[lowest] > z_limit]
+        if len(deep) == 0:
+            return(level)
+        for k in deep.tolist():
+            seeds[k] = pit[k]
+
+def fill(dem, z_limit = None):
+    ''' Fills the sinks of "dem" (2D array, NaN for NoData), as
+    arcpy.sa.Fill. With a "z_limit", depressions deeper than the limit below
+    their pour point are left unfilled (their lowest cell drains), while the
+    shallower sinks inside them are still filled. Returns a new array. '''
+    dem = np.asarray(dem)
+    if dem.dtype.kind != 'f':
+        dem = dem.astype(float)
+    nodata = np.isnan(dem)
+    outlet = outlet_cells(dem)
+
+    # 1. Basins: roots of the descent links, outlets all in basin 0
+    (basin, roots) = drainage_basins(steepest_descent(dem, outlet), outlet, nodata)
+    nbasins = len(roots) + 1
+    pit = np.r_[-np.inf, dem.ravel()[roots]]
+
+    # 2. Spill elevations between basins
+    (a, b, spill) = basin_graph(dem, basin, nbasins)
+
+    # 3. Basin levels
+    level = basin_levels(nbasins, a, b, spill, pit, z_limit, np.r_[-1, roots])
+    filled = np.fmax(dem, level[basin].astype(dem.dtype))
+    filled[nodata] = np.nan
+    return(filled)
+
+def padded(values, fill):
+    ''' "values" with a border of one "fill" cell on every side, flattened:
+    flat indices of the padded array need no bounds checks (see
+    flat_distance). '''
+    return(np.pad(values, 1, 'constant', constant_values = fill).ravel())
+
+def padded_steps(shape):
+    ''' Flat index offsets of the D8 neighbours in a padded array of a
+    raster of the given shape, in the order of D8_OFFSETS. '''
+    ncols = shape[1] + 2
+    itype = index_dtype((shape[0] + 2)*ncols)
+    return([itype(dr*ncols + dc) for (dr, dc) in D8_OFFSETS])
+
+def d8_neighbour(dem):
+    ''' Position in D8_OFFSETS of the downstream neighbour of every cell
+    before flats are resolved: the steepest lower neighbour, or for cells on
+    the edge or next to NaN cells with none, outward (-1: none). '''
+    neighbour = steepest_neighbour(dem)
+    outward = outward_neighbour(dem)
+    edge = (neighbour < 0) & (outward >= 0)
+    neighbour[edge] = outward[edge]
+    return(neighbour)
+
+def flat_edges(dem, neighbour):
+    ''' Flat cells of "dem" (no downstream neighbour in "neighbour"), low
+    edges (draining cells next to a flat cell of the same elevation) and
+    high edges (flat cells next to a higher cell), as boolean arrays. '''
+    flat = (neighbour < 0) & ~np.isnan(dem)
+    low = np.zeros(dem.shape, dtype = bool)
+    high = np.zeros(dem.shape, dtype = bool)
+    for (dr, dc) in D8_OFFSETS:
+        zn = shifted(dem, dr, dc, np.nan)
+        low |= shifted(flat, dr, dc, False) & (zn == dem)
+        with np.errstate(invalid = 'ignore'):
+            high |= zn > dem
+    return(flat, low & (neighbour >= 0), high & flat)
+
+def flat_distance(distance, allowed, z, steps):
+    ''' Breadth-first distance, in cells, through "allowed" cells and
+    neighbours of equal elevation "z", from the cells with a distance (>= 0;
+    -1 elsewhere). Known distances are lowered where a shorter path is found,
+    so the search can be resumed with the distances of neighbouring tiles.
+    Cells are flat indices into a padded raster (see padded) whose border is
+    not allowed, and "steps" are the offsets of the D8 neighbours (see
+    padded_steps). Updates "distance" in place and returns it. '''
+    seeds = np.nonzero(distance >= 0)[0]
+    if len(seeds) == 0:
+        return(distance)
+    seeds = seeds[np.argsort(distance[seeds], kind = 'mergesort')].astype(steps[0].dtype)
+    seeddistance = distance[seeds]
+    frontier = seeds[:0]
+    d = seeddistance[0]
+    k = 0
+    while len(frontier) or k < len(seeds):
+        if len(frontier) == 0:
+            d = seeddistance[k]
+        # Seeds at the current distance, unless a shorter path was found
+        j = np.searchsorted(seeddistance, d, 'right')
+        start = seeds[k:j]
+        k = j
+        frontier = np.r_[frontier, start[distance[start] == d]]
+        d += 1
+        found = list()
+        for step in steps:
+            # An offset maps distinct cells to distinct cells, and cells
+            # found by earlier offsets are excluded: "found" has no repeats
+            nb = frontier + step
+            dn = distance[nb]
+            nb = nb[allowed[nb] & ((dn < 0) | (dn > d)) & (z[nb] == z[frontier])]
+            distance[nb] = d
+            found.append(nb)
+        frontier = np.concatenate(found)
+    return(distance)
+
+def flat_directions(cells, allowed, z, towards, away, steps):
+    ''' Flow directions (positions in D8_OFFSETS) of flat "cells" (padded
+    flat indices, with a distance "towards" the outlets > 0) from the
+    distances towards the flats' outlets and away from their higher rims.
+
+    The combined gradient is 2 x distance to the outlets - distance from the
+    rim. The distances from the rim are compared within a flat only, so they
+    need not be inverted by the flat's largest distance as in the paper.
+    Outlets rank lowest and cells outside the flats are never chosen. Every
+    cell has a neighbour one step closer to an outlet, with a strictly lower
+    value, so the directions form no cycles. '''
+    low = ~allowed & (towards == 0)
+    value = np.full(len(z), np.iinfo(np.int32).max, dtype = np.int32)
+    reached = allowed & (towards > 0)
+    value[reached] = 2*towards[reached] - np.maximum(away[reached], 0)
+    value[low] = np.iinfo(np.int32).min
+
+    best = np.full(len(cells), -1, dtype = np.int8)
+    bestvalue = value[cells]
+    for k in range(len(steps)):
+        nb = cells + steps[k]
+        vn = value[nb]
+        better = (vn < bestvalue) & (z[nb] == z[cells])
+        bestvalue[better] = vn[better]
+        best[better] = k
+    return(best)
+
+def resolve_flats(dem, neighbour):
+    ''' Flow directions (positions in D8_OFFSETS) for the flat cells of
+    "dem", those with no downstream neighbour (-1) in "neighbour", that can
+    drain through a neighbour of the same elevation. Returns a new array;
+    flats without an outlet stay -1. '''
+    neighbour = neighbour.copy()
+    (flat, low, high) = flat_edges(dem, neighbour)
+    if not flat.any():
+        return(neighbour)
+
+    z = padded(dem, np.nan)
+    allowed = padded(flat, False)
+    steps = padded_steps(dem.shape)
+    towards = np.where(padded(low, False), 0, -1).astype(np.int32)
+    away = np.where(padded(high, False), 0, -1).astype(np.int32)
+    flat_distance(towards, allowed, z, steps)
+    flat_distance(away, allowed, z, steps)
+
+    cells = np.nonzero(allowed & (towards > 0))[0].astype(steps[0].dtype)
+    (rows, cols) = (cells // (dem.shape[1] + 2), cells % (dem.shape[1] + 2))
+    neighbour[rows - 1, cols - 1] = flat_directions(cells, allowed, z, towards, away, steps)
+    return(neighbour)
+
+def flow_direction(dem):
+    ''' D8 flow direction of every cell of "dem" (2D array, NaN for NoData;
+    usually filled), as arcpy.sa.FlowDirection(dem, "NORMAL"), in the ESRI
+    codes (D8_CODES). Flats are resolved towards their outlets; cells that
+    cannot drain get 0 and NaN cells NODATA_DIRECTION. Returns a uint8
+    array. '''
+    dem = np.asarray(dem)
+    if dem.dtype.kind != 'f':
+        dem = dem.astype(float)
+    neighbour = resolve_flats(dem, d8_neighbour(dem))
+    return(direction_codes(neighbour, np.isnan(dem)))
+
+def direction_codes(neighbour, nodata = None):
+    ''' ESRI flow direction codes of positions in D8_OFFSETS (-1: 0), with
+    NODATA_DIRECTION where the boolean array "nodata" is set. '''
+    codes = np.array(D8_CODES + [0], dtype = np.uint8)[neighbour]
+    if nodata is not None:
+        codes[nodata] = NODATA_DIRECTION
+    return(codes)
+
+def downstream(direction):
+    ''' Flat index of the cell every cell of a D8 flow direction raster
+    (ESRI codes, NODATA_DIRECTION for NoData) flows to, or -1 for cells with
+    no valid code (e.g. 0 for cells that cannot drain), or that flow out of
+    the raster or into a NoData cell. '''
+    itype = index_dtype(direction.size)
+    ncols = direction.shape[1]
+    cells = np.arange(direction.size, dtype = itype).reshape(direction.shape)
+    receiver = np.full(direction.shape, -1, dtype = itype)
+    for k in range(len(D8_OFFSETS)):
+        (dr, dc) = D8_OFFSETS[k]
+        m = (direction == D8_CODES[k]) & (shifted(direction, dr, dc, NODATA_DIRECTION) != NODATA_DIRECTION)
+        receiver[m] = cells[m] + itype(dr*ncols + dc)
+    return(receiver.ravel())
+
+def accumulate(receiver, total, indegree, cells):
+    ''' Adds the totals of the upstream cells to "total", in place, for
+    "cells" (flat indices of whole drainage basins), in topological order.
+    "indegree" (number of upstream neighbours) is used up. '''
+    front = cells[indegree[cells] == 0]
+    while len(front):
+        down = receiver[front]
+        keep = down >= 0
+        down = down[keep]
+        if len(down) == 0:
+            break
+        order = np.argsort(down, kind = 'mergesort')
+        down = down[order]
+        starts = np.nonzero(np.r_[True, down[1:] != down[:-1]])[0]
+        targets = down[starts]
+        total[targets] += np.add.reduceat(total[front[keep][order]], starts)
+        indegree[targets] -= np.diff(np.r_[starts, len(down)]).astype(indegree.dtype)
+        front = targets[indegree[targets] == 0]
+
+def basin_groups(receiver, groups):
+    ''' Splits the cells into at most "groups" arrays of flat indices of
+    whole drainage basins, of about equal numbers of cells. '''
+    cells = np.arange(len(receiver), dtype = receiver.dtype)
+    root = follow(np.where(receiver < 0, cells, receiver))
+    # Basins in order of their outlets, cut into runs of equal total size
+    size = np.bincount(root, minlength = len(receiver))
+    mid = np.cumsum(size) - size/2.0
+    group = np.minimum((mid/len(receiver)*groups).astype(np.int32), groups - 1)[root]
+    parts = [np.nonzero(group == k)[0].astype(receiver.dtype) for k in range(groups)]
+    return([part for part in parts if len(part)])
+
+def flow_accumulation(direction, weight = None, threads = 1):
+    ''' Flow accumulation of a D8 flow direction raster (ESRI codes,
+    NODATA_DIRECTION for NoData), as arcpy.sa.FlowAccumulation: the number
+    of cells upstream of every cell, not counting the cell itself, or with a
+    "weight" raster (e.g. impervious cover) the sum of their weights (NaN
+    weights count as 0). Cells that cannot drain (0 or any other code that
+    is not a direction) collect the flow of their upstream cells; flow into
+    NoData cells is dropped.
+
+    threads: number of threads the drainage basins are split among.
+
+    Returns an int32 array with -1 for NoData cells, or with weights a
+    float32 array with NaN for NoData cells. Cells on loops of the flow
+    directions (which FlowDirection does not produce) are left incomplete. '''
+    direction = np.asarray(direction)
+    receiver = downstream(direction)
+    nodata = (direction == NODATA_DIRECTION).ravel()
+    down = receiver[receiver >= 0]
+    indegree = np.bincount(down, minlength = len(receiver)).astype(np.int32)
+
+    if weight is None:
+        own = np.ones(len(receiver), dtype = np.int32)
+        missing = -1
+    else:
+        own = np.asarray(weight, dtype = np.float32).ravel()
+        own = np.where(np.isnan(own), np.float32(0), own)
+        missing = np.nan
+    total = own.copy()
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(lambda cells: accumulate(receiver, total, indegree, cells), basin_groups(receiver, threads))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        accumulate(receiver, total, indegree, np.arange(len(receiver), dtype = receiver.dtype))
+
+    total -= own
+    total[nodata] = missing
+    return(total.reshape(direction.shape))
+
+def snap_pour_points(accumulation, rows, cols, radius):
+    ''' Cell of highest flow accumulation within "radius" cells of every pour
+    point (rows, cols), as arcpy.sa.SnapPourPoint; the nearest of equal
+    cells wins. NaN or negative accumulations are NoData. Only windows
+    around the points are read, so "accumulation" may be an array on disk.
+    Returns the rows and columns of the snapped points. '''
+    (nrows, ncols) = accumulation.shape
+    reach = int(radius)
+    (dr, dc) = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+    distance = dr**2 + dc**2
+    snapped = list()
+    for (row, col) in zip(rows, cols):
+        (r0, r1, c0, c1) = (max(row - reach, 0), min(row + reach + 1, nrows), max(col - reach, 0), min(col + reach + 1, ncols))
+        window = np.asarray(accumulation[r0:r1, c0:c1], dtype = np.float64)
+        near = distance[r0 - row + reach:r1 - row + reach, c0 - col + reach:c1 - col + reach]
+        with np.errstate(invalid = 'ignore'):
+            valid = (near <= radius**2) & (window >= 0)
+        if not valid.any():
+            snapped.append((row, col))
+            continue
+        window = np.where(valid, window, -1)
+        k = np.argmin(np.where(window == window.max(), near, np.inf))
+        snapped.append((r0 + k // (c1 - c0), c0 + k % (c1 - c0)))
+    return([np.array([p[k] for p in snapped], dtype = np.int64) for k in (0, 1)])
+
+def watershed(direction, pour, nodata):
+    ''' Watershed of every pour point, as arcpy.sa.Watershed: the value of
+    the first cell of "pour" (an integer raster, "nodata" where there is no
+    pour point) downstream of every cell of a D8 flow direction raster (ESRI
+    codes, NODATA_DIRECTION for NoData), or "nodata". '''
+    pour = np.asarray(pour).ravel()
+    receiver = downstream(np.asarray(direction))
+    cells = np.arange(len(receiver), dtype = receiver.dtype)
+    root = follow(np.where((receiver < 0) | (pour != nodata), cells, receiver))
+    return(pour[root].reshape(direction.shape))
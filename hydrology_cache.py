@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Hydrology Raster Cache
+Purpose:     Keeps the filled DEM, flow direction and flow accumulation
+             rasters of Complete_Watershed.py between runs, so that
+             delineating catchments again from the same lidar (e.g. after
+             moving a few outfalls) skips the hours spent on them.
+
+             Products are keyed by a fingerprint of the DEM: a content hash
+             of its cell values, read block by block, and of the parameters
+             they are derived with (georeference, engine, z-limit ...; see
+             dem_fingerprint). A DEM that has changed, or other parameters,
+             give a new fingerprint and new products.
+
+             Every fingerprint has a folder of product rasters in the cache
+             directory, and a manifest records their sizes and when they
+             were last used. When the cache grows beyond its disk budget,
+             the least recently used fingerprints are removed. Fingerprint
+             folders the manifest does not know (left by an interrupted run)
+             are removed when the cache is opened; other folders are never
+             touched, so the cache can share a folder with other data.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+from json_files import load_json, save_json
+
+
+# Disk budget of the cache, in MB
+DEFAULT_BUDGET = 20480
+
+# Changed when the products of the same DEM and parameters would change
+# (e.g. a new version of the hydrology engines), to leave old products out
+CACHE_VERSION = 2
+
+MANIFEST = 'manifest.json'
+
+PRODUCT_EXTENSION = '.tif'
+
+# Names of fingerprint folders (see dem_fingerprint)
+FINGERPRINT = re.compile('^[0-9a-f]{40}$')
+
+
+def dem_fingerprint(blocks, parameters):
+    ''' Content hash of a DEM from its cell values, as numpy arrays read
+    block by block in a fixed order, and of the dict of "parameters" its
+    products are derived with. '''
+    sha = hashlib.sha1()
+    sha.update(json.dumps([CACHE_VERSION, parameters], sort_keys = True).encode('utf-8'))
+    for block in blocks:
+        sha.update((str(block.shape) + block.dtype.str).encode('ascii'))
+        sha.update(np.ascontiguousarray(block).data)
+    return(sha.hexdigest())
+
+def folder_size(folder, prefix):
+    ''' Total size in bytes of the files of "folder" whose name starts with
+    "prefix" (a raster and its auxiliary files). '''
+    return(sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+               if name.startswith(prefix)))
+
+
+class HydrologyCache(object):
+    ''' Directory of hydrology rasters keyed by DEM fingerprint.
+
+    directory: cache folder; it is created when needed.
+    budget: disk budget in MB. '''
+
+    def __init__(self, directory, budget = DEFAULT_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.manifest = os.path.join(directory, MANIFEST)
+        self.entries = load_json(self.manifest, dict())
+        self.sweep()
+
+    def path(self, fingerprint, product):
+        ''' Path of a product raster of a fingerprint, cached or not (its
+        folder is created when needed). '''
+        folder = os.path.join(self.directory, fingerprint)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return(os.path.join(folder, product + PRODUCT_EXTENSION))
+
+    def get(self, fingerprint, product):
+        ''' Path of a cached product raster, or None. '''
+        entry = self.entries.get(fingerprint)
+        if entry is None or product not in entry['products']:
+            return(None)
+        path = os.path.join(self.directory, fingerprint, product + PRODUCT_EXTENSION)
+        if not os.path.exists(path):
+            return(None)
+        entry['used'] = time.time()
+        self.save()
+        return(path)
+
+    def put(self, fingerprint, product):
+        ''' Records the product raster written at self.path(fingerprint,
+        product), and removes least recently used fingerprints (other than
+        this one) while the cache is over its budget. '''
+        folder = os.path.join(self.directory, fingerprint)
+        entry = self.entries.setdefault(fingerprint, {'products': {}})
+        entry['products'][product] = folder_size(folder, product + '.')
+        entry['used'] = time.time()
+        self.evict(keep = fingerprint)
+        self.save()
+        return(self.path(fingerprint, product))
+
+    def size(self):
+        ''' Total size of the cached products, in bytes. '''
+        return(sum(sum(entry['products'].values()) for entry in self.entries.values()))
+
+    def evict(self, keep = None):
+        ''' Removes the least recently used fingerprints, except "keep", until
+        the cache fits in its budget. '''
+        budget = self.budget*2**20
+        for fingerprint in sorted(self.entries, key = lambda k: self.entries[k]['used']):
+            if self.size() <= budget:
+                break
+            if fingerprint == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, fingerprint), ignore_errors = True)
+            del self.entries[fingerprint]
+
+    def sweep(self):
+        ''' Removes the folders of fingerprints the manifest does not record,
+        such as products of a run interrupted before they were put. Only
+        folders named like a fingerprint are removed. '''
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if FINGERPRINT.match(name) and name not in self.entries and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors = True)
+
+    def save(self):
+        ''' Writes the manifest (see json_files.save_json). '''
+        save_json(self.manifest, self.entries)
@@ -0,0 +1,778 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Tiled Hydrology Engine
+Purpose:     Out-of-core versions of hydrology.fill, flow_direction,
+             flow_accumulation and watershed for DEMs larger than memory,
+             such as the regional lidar mosaics of Lidar_prep_tool.py.
+
+             Rasters are 2D arrays read and written by tiles, usually .npy
+             files opened as memory maps (see open_array and create_array).
+             Only one tile and a halo of one or two cells around it are in
+             memory at a time, so peak memory is set by the tile size (see
+             tile_size), whatever the size of the DEM. The results are the
+             same as those of the in-memory engine.
+
+             fill: every tile is split into drainage basins as in
+             hydrology.fill, a cell whose steepest descent leaves the tile
+             ending its basin. The spill graph of all the basins is made of
+             the graphs of the tiles and of the pairs of cells straddling
+             tile edges (read from rows and columns kept for every tile
+             seam), kept in temporary files. Every tile's graph is flooded
+             in memory from its terminals, the basins on seams (and the
+             pits of deep depressions of a z-limit), and only the smaller
+             graph between the terminals of all the tiles is flooded on
+             disk, with the levels of the basins. A second pass over the
+             tiles writes max(z, level).
+
+             flow_direction: directions are computed by tile with a halo of
+             two cells. The breadth-first distances that resolve flats are
+             kept on disk and resumed from the halos of the neighbouring
+             tiles until no tile changes (one or two rounds, unless flats
+             wind across many tiles), and the flat cells' directions are then
+             set from them.
+
+             flow_accumulation: every tile is accumulated on its own, and
+             the path of every cell on the tile's perimeter is followed to
+             the next perimeter cell downstream. Flow entering every tile
+             from its neighbours is then accumulated on the graph of
+             perimeter cells, kept in temporary files, and a second pass
+             over the tiles adds it.
+
+             watershed: every tile's cells are followed to a pour point or to
+             the tile's perimeter, as for flow_accumulation, and the
+             perimeter cells to the pour point their flow reaches in other
+             tiles, on a graph kept in temporary files.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import hydrology
+
+
+# Peak working memory of the engines, in MB
+DEFAULT_MEMORY = 1024
+
+# Working memory of the engines per cell of a tile, in bytes
+BYTES_PER_CELL = 160
+
+MIN_TILE_SIZE = 64
+
+
+def open_array(path):
+    ''' Memory map of a raster saved as a .npy file, read-only. '''
+    return(np.load(path, mmap_mode = 'r'))
+
+def create_array(path, shape, dtype):
+    ''' New .npy file of the given shape and type, as a writable memory map. '''
+    return(np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = tuple(shape)))
+
+def tile_size(max_memory = DEFAULT_MEMORY, bytes_per_cell = BYTES_PER_CELL):
+    ''' Side, in cells, of the square tiles that fit in "max_memory" MB. '''
+    return(max(MIN_TILE_SIZE, int(np.sqrt(max_memory*2.0**20/bytes_per_cell))))
+
+def tile_grid(shape, size):
+    ''' Tiles (first row, end row, first column, end column) of "size" cells
+    covering a raster of the given shape, by rows of tiles. '''
+    (nrows, ncols) = shape
+    return([(r0, min(r0 + size, nrows), c0, min(c0 + size, ncols))
+            for r0 in range(0, nrows, size) for c0 in range(0, ncols, size)])
+
+def read_window(array, tile, halo):
+    ''' Values of a tile and of a halo of "halo" cells around it, clipped to
+    the raster, so that the edges of the window are edges of the raster or
+    halo cells. Returns a copy and the slices of the tile in it. '''
+    (r0, r1, c0, c1) = tile
+    (nrows, ncols) = array.shape
+    (w0, w1, v0, v1) = (max(r0 - halo, 0), min(r1 + halo, nrows), max(c0 - halo, 0), min(c1 + halo, ncols))
+    window = np.array(array[w0:w1, v0:v1])
+    return(window, (slice(r0 - w0, r1 - w0), slice(c0 - v0, c1 - v0)))
+
+def as_float(values):
+    if values.dtype.kind != 'f':
+        return(values.astype(float))
+    return(values)
+
+def neighbour_tiles(tiles, k):
+    ''' Positions in "tiles" of the tiles touching tile k (edges or
+    corners). '''
+    (r0, r1, c0, c1) = tiles[k]
+    return([j for (j, (s0, s1, d0, d1)) in enumerate(tiles)
+            if j != k and s0 <= r1 and s1 >= r0 and d0 <= c1 and d1 >= c0])
+
+
+# Fill
+
+def tile_basins(dem, tile):
+    ''' Drainage basins of a tile (see hydrology.drainage_basins): cells
+    whose steepest descent leaves the tile end their basin, like pits.
+    Returns the elevations, the basins and the roots of the tile. '''
+    (window, crop) = read_window(dem, tile, 1)
+    window = as_float(window)
+    outlet = hydrology.outlet_cells(window)[crop]
+    neighbour = hydrology.steepest_neighbour(window)[crop]
+    z = window[crop]
+
+    inside = np.ones(z.shape, dtype = bool)
+    for k in range(len(hydrology.D8_OFFSETS)):
+        (dr, dc) = hydrology.D8_OFFSETS[k]
+        leaves = (neighbour == k) & ~hydrology.shifted(inside, dr, dc, False)
+        neighbour[leaves] = -1
+    neighbour[outlet] = -1
+
+    (basin, roots) = hydrology.drainage_basins(hydrology.receivers(neighbour), outlet, np.isnan(z))
+    return(z, basin, roots)
+
+def global_basins(basin, offset):
+    ''' Numbers of the basins of a tile in the whole raster: basins 1, 2 ...
+    of the tile follow "offset"; the outlet (0) and NaN cells (-1) stay. '''
+    basin = basin.astype(np.int64)
+    basin[basin > 0] += offset
+    return(basin)
+
+def seam_pairs(la, za, lb, zb):
+    ''' Spill elevations between the basins of two neighbouring rows (or
+    columns) of cells, "a" and "b": the pairs of cells at offsets 0, +1 and
+    -1 along the seam. Returns (basin a, basin b, elevation), a < b. '''
+    pairs = list()
+    for (sa, sb) in [(slice(None), slice(None)), (slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1))]:
+        (a, b) = (la[sa], lb[sb])
+        with np.errstate(invalid = 'ignore'):
+            spill = np.fmax(za[sa], zb[sb])
+        cross = (a >= 0) & (b >= 0) & (a != b) & ~np.isnan(spill)
+        pairs.append((np.minimum(a, b)[cross], np.maximum(a, b)[cross], spill[cross]))
+    return([np.concatenate([p[k] for p in pairs]) for k in range(3)])
+
+def fill(dem, out, z_limit = None, max_memory = DEFAULT_MEMORY, scratch = None):
+    ''' Fills the sinks of "dem" (2D array, NaN for NoData) into "out", as
+    hydrology.fill, reading and writing by tiles that fit in "max_memory"
+    MB. The spill graph of the basins is kept in temporary files in
+    "scratch" (default: the system's temporary folder). '''
+    size = tile_size(max_memory)
+    tiles = tile_grid(dem.shape, size)
+    (nrows, ncols) = dem.shape
+    folder = tempfile.mkdtemp(dir = scratch)
+    try:
+        # 1. Basins and spill graph of every tile, in the tile's own
+        # numbering; the rows and columns on both sides of every seam
+        # between tiles
+        seamrows = sorted(set(t[0] for t in tiles) | set(t[1] - 1 for t in tiles))
+        seamcols = sorted(set(t[2] for t in tiles) | set(t[3] - 1 for t in tiles))
+        rows = dict((r, k) for (k, r) in enumerate(seamrows))
+        cols = dict((c, k) for (k, c) in enumerate(seamcols))
+        rowbasin = create_array(os.path.join(folder, 'rowbasin.npy'), (len(rows), ncols), np.int64)
+        rowz = create_array(os.path.join(folder, 'rowz.npy'), (len(rows), ncols), np.float64)
+        colbasin = create_array(os.path.join(folder, 'colbasin.npy'), (len(cols), nrows), np.int64)
+        colz = create_array(os.path.join(folder, 'colz.npy'), (len(cols), nrows), np.float64)
+        for name in ('a', 'b', 'spill', 'seama', 'seamb', 'seamspill', 'pit', 'cell'):
+            open(os.path.join(folder, name), 'wb').close()
+        append_raw(folder, 'pit', np.array([-np.inf]))
+        append_raw(folder, 'cell', np.array([-1], dtype = np.int64))
+        offsets = [0]
+        edges = [0]
+        for tile in tiles:
+            (r0, r1, c0, c1) = tile
+            (z, basin, roots) = tile_basins(dem, tile)
+            append_raw(folder, 'pit', z.ravel()[roots].astype(np.float64))
+            append_raw(folder, 'cell', (roots // (c1 - c0) + r0)*ncols + roots % (c1 - c0) + c0)
+            (a, b, spill) = hydrology.basin_graph(z, basin, len(roots) + 1)
+            append_edges(folder, '', a, b, spill)
+            edges.append(edges[-1] + len(a))
+            basin = global_basins(basin, offsets[-1])
+            offsets.append(offsets[-1] + len(roots))
+            for (r, k) in [(r0, 0), (r1 - 1, -1)]:
+                rowbasin[rows[r], c0:c1] = basin[k, :]
+                rowz[rows[r], c0:c1] = z[k, :]
+            for (c, k) in [(c0, 0), (c1 - 1, -1)]:
+                colbasin[cols[c], r0:r1] = basin[:, k]
+                colz[cols[c], r0:r1] = z[:, k]
+
+        # Pairs of cells straddling the seams, a tile's length (and a cell)
+        # at a time
+        for (lines, basins, zs, length) in [(rows, rowbasin, rowz, ncols), (cols, colbasin, colz, nrows)]:
+            for (line, k) in lines.items():
+                if line + 1 in lines:
+                    for (s, e) in chunks(length, size):
+                        s = slice(s, min(e + 1, length))
+                        append_edges(folder, 'seam', *seam_pairs(np.array(basins[k, s]), np.array(zs[k, s]),
+                                                                 np.array(basins[lines[line + 1], s]), np.array(zs[lines[line + 1], s])))
+        del rowbasin, rowz, colbasin, colz
+
+        # 2. Basin levels
+        level = tile_levels(folder, offsets, edges, z_limit, size*size)
+
+        # 3. Filled elevations
+        for (tile, offset) in zip(tiles, offsets):
+            (r0, r1, c0, c1) = tile
+            (z, basin, roots) = tile_basins(dem, tile)
+            basin = global_basins(basin, offset)
+            filled = np.fmax(z, level[basin].astype(z.dtype))
+            filled[basin < 0] = np.nan
+            out[r0:r1, c0:c1] = filled
+        del level
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+
+def chunks(n, size):
+    ''' Ranges (start, end) of "size" values covering 0 ... n - 1. '''
+    return([(s, min(s + size, n)) for s in range(0, n, size)])
+
+def append_raw(folder, name, values):
+    ''' Appends "values" to the raw array file "name" in "folder". '''
+    with open(os.path.join(folder, name), 'ab') as f:
+        np.ascontiguousarray(values).tofile(f)
+
+def append_edges(folder, prefix, a, b, spill):
+    ''' Appends edges (basin a, basin b, spill elevation) of a spill graph
+    to the raw array files "a", "b" and "spill" (after "prefix") in
+    "folder". '''
+    append_raw(folder, prefix + 'a', np.asarray(a, dtype = np.int64))
+    append_raw(folder, prefix + 'b', np.asarray(b, dtype = np.int64))
+    append_raw(folder, prefix + 'spill', np.asarray(spill, dtype = np.float64))
+
+def open_raw(folder, name, dtype):
+    ''' Raw array file "name" in "folder", as a writable memory map. '''
+    path = os.path.join(folder, name)
+    if os.path.getsize(path) == 0:
+        return(np.zeros(0, dtype = dtype))
+    return(np.memmap(path, dtype = dtype, mode = 'r+'))
+
+def scratch_array(folder, name, length, dtype, value = 0):
+    ''' New array on disk of "length" values set to "value", in "folder". '''
+    if length == 0:
+        return(np.zeros(0, dtype = dtype))
+    array = create_array(os.path.join(folder, name + '.npy'), (length,), dtype)
+    if value != 0:
+        array[:] = value
+    return(array)
+
+def runs(values):
+    ''' Distinct values of an array and the number of times each occurs. '''
+    values = np.sort(values)
+    first = np.nonzero(np.r_[len(values) > 0, values[1:] != values[:-1]])[0]
+    return(values[first], np.diff(np.r_[first, len(values)]).astype(np.int64))
+
+def disk_adjacency(folder, nbasins, a, b, spill, chunk):
+    ''' hydrology.adjacency of the graph (a, b, spill) on disk, built into
+    arrays on disk "chunk" edges at a time. '''
+    # Number of neighbours of every basin, then their cumulative sum
+    starts = scratch_array(folder, 'starts', nbasins + 1, np.int64)
+    for ends in (a, b):
+        for (s, e) in chunks(len(ends), chunk):
+            (nodes, counts) = runs(ends[s:e])
+            starts[nodes + 1] += counts
+    total = 0
+    for (s, e) in chunks(nbasins + 1, chunk):
+        starts[s:e] = np.cumsum(starts[s:e]) + total
+        total = starts[e - 1]
+
+    # Neighbours in place, after those of the same basin already placed
+    position = scratch_array(folder, 'position', nbasins, np.int64)
+    for (s, e) in chunks(nbasins, chunk):
+        position[s:e] = starts[s:e]
+    others = scratch_array(folder, 'others', 2*len(a), np.int64)
+    weights = scratch_array(folder, 'weights', 2*len(a), np.float64)
+    for (ends, other) in [(a, b), (b, a)]:
+        for (s, e) in chunks(len(ends), chunk):
+            x = np.array(ends[s:e])
+            order = np.argsort(x, kind = 'mergesort')
+            x = x[order]
+            (nodes, counts) = runs(x)
+            first = np.repeat(np.cumsum(counts) - counts, counts)
+            slot = position[x] + np.arange(len(x)) - first
+            others[slot] = other[s:e][order]
+            weights[slot] = spill[s:e][order]
+            position[nodes] += counts
+    return(starts, others, weights)
+
+def disk_follow(root, chunk):
+    ''' hydrology.follow in place, for an array on disk, "chunk" values at a
+    time. '''
+    while True:
+        changed = False
+        for (s, e) in chunks(len(root), chunk):
+            current = np.array(root[s:e])
+            nxt = root[current]
+            if not np.array_equal(nxt, current):
+                root[s:e] = nxt
+                changed = True
+        if not changed:
+            return
+
+def disk_components(folder, n, a, b, chunk):
+    ''' hydrology.components of the graph with edges (a, b), arrays on disk,
+    "chunk" edges at a time. Roots are hooked under smaller labels, so the
+    component of every node is still numbered by its smallest node. '''
+    label = scratch_array(folder, 'label', n, np.int64)
+    for (s, e) in chunks(n, chunk):
+        label[s:e] = np.arange(s, e)
+    while True:
+        joined = False
+        for (s, e) in chunks(len(a), chunk):
+            la = label[a[s:e]]
+            lb = label[b[s:e]]
+            join = la != lb
+            if not join.any():
+                continue
+            joined = True
+            lo = np.minimum(la, lb)[join]
+            hi = np.maximum(la, lb)[join]
+            order = np.lexsort((lo, hi))
+            hi = hi[order]
+            first = np.r_[True, hi[1:] != hi[:-1]]
+            label[hi[first]] = np.minimum(label[hi[first]], lo[order][first])
+        if not joined:
+            return(label)
+        disk_follow(label, chunk)
+
+def tile_graph(graph, offsets, edges, k):
+    ''' Spill graph of tile k in its own numbering (see fill): the number of
+    basins (0 being the outlet), the edges (a, b, spill), and the lowest
+    elevation and its cell for every basin. '''
+    (a, b, spill, pit, cell) = graph
+    (e0, e1) = (edges[k], edges[k + 1])
+    (g0, g1) = (offsets[k] + 1, offsets[k + 1] + 1)
+    return(g1 - g0 + 1, np.array(a[e0:e1]), np.array(b[e0:e1]), np.array(spill[e0:e1]),
+           np.r_[-np.inf, pit[g0:g1]], np.r_[-1, cell[g0:g1]])
+
+def tile_terminals(terminal, offsets, tileseeds, k):
+    ''' Terminals of tile k in its own numbering: the outlet (0), the basins
+    on seam edges and the seeds of deep depressions. '''
+    onseam = np.nonzero(terminal[offsets[k] + 1:offsets[k + 1] + 1])[0] + 1
+    return(sorted(set([0] + onseam.tolist() + tileseeds[k])))
+
+def disk_flood(folder, prefix, nbasins, seeds, chunk):
+    ''' hydrology.flood_basins of the graph in the raw array files "a", "b"
+    and "spill" of "folder" (after "prefix"), with the graph and levels on
+    disk. Returns the levels as an array on disk. '''
+    a = open_raw(folder, prefix + 'a', np.int64)
+    b = open_raw(folder, prefix + 'b', np.int64)
+    spill = open_raw(folder, prefix + 'spill', np.float64)
+    (starts, others, weights) = disk_adjacency(folder, nbasins, a, b, spill, chunk)
+    level = scratch_array(folder, prefix + 'level', nbasins, np.float64, np.inf)
+    closed = scratch_array(folder, prefix + 'closed', nbasins, bool)
+    hydrology.flood_basins(np.asarray(starts), np.asarray(others), np.asarray(weights), seeds,
+                           np.asarray(level), np.asarray(closed))
+    return(level)
+
+def tile_levels(folder, offsets, edges, z_limit, chunk):
+    ''' hydrology.basin_levels of the spill graph of fill, in "folder": the
+    graphs of the tiles in their own numbering (tile k has basins
+    offsets[k] + 1 ... offsets[k + 1] of the raster and edges
+    edges[k] ... edges[k + 1] - 1), and the edges across seams. Every tile
+    is flooded in memory from its terminals (see tile_terminals), whose
+    levels come from the flood of the graph between terminals (see
+    hydrology.terminal_graph) and the seam edges, on disk. Depressions are
+    found within tiles, then joined across seams. Returns the level of
+    every basin, as an array on disk. '''
+    ntiles = len(edges) - 1
+    nbasins = offsets[-1] + 1
+    graph = [open_raw(folder, name, dtype) for (name, dtype) in
+             [('a', np.int64), ('b', np.int64), ('spill', np.float64), ('pit', np.float64), ('cell', np.int64)]]
+    (pit, cell) = graph[3:]
+    seam = [open_raw(folder, 'seam' + name, dtype) for (name, dtype) in
+            [('a', np.int64), ('b', np.int64), ('spill', np.float64)]]
+    terminal = scratch_array(folder, 'terminal', nbasins, bool)
+    terminal[0] = True
+    for (s, e) in chunks(len(seam[0]), chunk):
+        terminal[seam[0][s:e]] = True
+        terminal[seam[1][s:e]] = True
+    level = scratch_array(folder, 'level', nbasins, np.float64, -np.inf)
+    seeds = {0: -np.inf}
+    tileseeds = [list() for k in range(ntiles)]
+    changed = range(ntiles)
+    while True:
+        # Graph between the terminals of the tiles that changed
+        for k in changed:
+            (n, a, b, spill, pits, cells) = tile_graph(graph, offsets, edges, k)
+            terminals = tile_terminals(terminal, offsets, tileseeds, k)
+            (ta, tb, tspill) = hydrology.terminal_graph(n, a, b, spill, terminals)
+            for (name, values) in [('a', global_basins(ta, offsets[k])), ('b', global_basins(tb, offsets[k])), ('spill', tspill)]:
+                np.save(os.path.join(folder, 'terminals' + str(k) + name + '.npy'), values)
+
+        # Levels of the terminals
+        for name in ('a', 'b', 'spill'):
+            open(os.path.join(folder, 'terminal' + name), 'wb').close()
+        for k in range(ntiles):
+            append_edges(folder, 'terminal', *[np.load(os.path.join(folder, 'terminals' + str(k) + name + '.npy'))
+                                               for name in ('a', 'b', 'spill')])
+        for (s, e) in chunks(len(seam[0]), chunk):
+            append_edges(folder, 'terminal', seam[0][s:e], seam[1][s:e], seam[2][s:e])
+        top = disk_flood(folder, 'terminal', nbasins, seeds, chunk)
+
+        # Levels of the basins of every tile; depressions within tiles
+        if z_limit is not None:
+            component = scratch_array(folder, 'component', nbasins, np.int64)
+            for name in ('candidate', 'candidatecomponent'):
+                open(os.path.join(folder, name), 'wb').close()
+        for k in range(ntiles):
+            (n, a, b, spill, pits, cells) = tile_graph(graph, offsets, edges, k)
+            terminals = np.array(tile_terminals(terminal, offsets, tileseeds, k))
+            (starts, others, weights) = hydrology.adjacency(n, a, b, spill)
+            tilelevel = [np.inf]*n
+            hydrology.flood_basins(starts.tolist(), others.tolist(), weights.tolist(),
+                                   dict(zip(terminals.tolist(), top[global_basins(terminals, offsets[k])].tolist())),
+                                   tilelevel, [False]*n)
+            tilelevel = np.array(tilelevel)
+            level[offsets[k] + 1:offsets[k + 1] + 1] = tilelevel[1:]
+            if z_limit is None:
+                continue
+            joined = (tilelevel[a] == tilelevel[b]) & (spill <= tilelevel[a]) & (a > 0)
+            label = hydrology.components(n, a[joined], b[joined])
+            component[offsets[k] + 1:offsets[k + 1] + 1] = global_basins(label[1:], offsets[k])
+            raised = np.nonzero(tilelevel > pits)[0]
+            order = raised[np.lexsort((cells[raised], pits[raised], label[raised]))]
+            first = np.r_[True, label[order][1:] != label[order][:-1]][:len(order)]
+            append_raw(folder, 'candidate', global_basins(order[first], offsets[k]))
+            append_raw(folder, 'candidatecomponent', global_basins(label[order][first], offsets[k]))
+        del top
+        if z_limit is None:
+            return(level)
+
+        deep = deep_depressions(folder, level, component, seam, pit, cell, z_limit, chunk)
+        if len(deep) == 0:
+            return(level)
+        changed = set()
+        for g in deep.tolist():
+            seeds[g] = pit[g]
+            k = np.searchsorted(offsets, g) - 1
+            tileseeds[k].append(g - offsets[k])
+            changed.add(k)
+
+def deep_depressions(folder, level, component, seam, pit, cell, z_limit, chunk):
+    ''' Lowest basin of every depression deeper than "z_limit" (see
+    hydrology.depressions and hydrology.basin_levels), from the depressions
+    within tiles ("component" of every basin, and the lowest basin of each
+    in the raw array files "candidate" and "candidatecomponent" of
+    "folder") joined by the seam edges, "chunk" values at a time. '''
+    # Depressions within tiles joined across seams
+    (a, b, spill) = seam
+    for name in ('joineda', 'joinedb'):
+        open(os.path.join(folder, name), 'wb').close()
+    for (s, e) in chunks(len(a), chunk):
+        (ea, eb) = (a[s:e], b[s:e])
+        za = level[ea]
+        joined = (za == level[eb]) & (spill[s:e] <= za) & (ea > 0)
+        append_raw(folder, 'joineda', component[ea[joined]])
+        append_raw(folder, 'joinedb', component[eb[joined]])
+    label = disk_components(folder, len(level), open_raw(folder, 'joineda', np.int64),
+                            open_raw(folder, 'joinedb', np.int64), chunk)
+
+    # Lowest basin of every depression: lowest pit, then first cell
+    candidate = open_raw(folder, 'candidate', np.int64)
+    candidatecomponent = open_raw(folder, 'candidatecomponent', np.int64)
+    lowest = scratch_array(folder, 'lowest', len(level), np.int64, -1)
+    for (s, e) in chunks(len(candidate), chunk):
+        k = np.array(candidate[s:e])
+        depression = label[candidatecomponent[s:e]]
+        order = np.lexsort((cell[k], pit[k], depression))
+        (k, depression) = (k[order], depression[order])
+        first = np.r_[True, depression[1:] != depression[:-1]]
+        (k, depression) = (k[first], depression[first])
+        known = lowest[depression]
+        j = np.maximum(known, 0)
+        lower = (known < 0) | (pit[k] < pit[j]) | ((pit[k] == pit[j]) & (cell[k] < cell[j]))
+        lowest[depression[lower]] = k[lower]
+
+    deep = list()
+    for (s, e) in chunks(len(level), chunk):
+        k = lowest[s:e]
+        k = k[k >= 0]
+        deep.append(k[level[k] - pit[k] > z_limit])
+    return(np.concatenate(deep))
+
+
+# Flow direction
+
+def flow_direction(dem, out, max_memory = DEFAULT_MEMORY, scratch = None):
+    ''' D8 flow direction of "dem" (2D array, NaN for NoData; usually filled)
+    into "out", as hydrology.flow_direction, reading and writing by tiles
+    that fit in "max_memory" MB. The distances that resolve flats are kept
+    in temporary files in "scratch" (default: the system's temporary
+    folder). '''
+    tiles = tile_grid(dem.shape, tile_size(max_memory))
+    folder = tempfile.mkdtemp(dir = scratch)
+    try:
+        neighbour = create_array(os.path.join(folder, 'neighbour.npy'), dem.shape, np.int8)
+        towards = create_array(os.path.join(folder, 'towards.npy'), dem.shape, np.int32)
+        away = create_array(os.path.join(folder, 'away.npy'), dem.shape, np.int32)
+
+        # 1. Directions outside flats, flats and their edges
+        flats = set()
+        for (k, tile) in enumerate(tiles):
+            (r0, r1, c0, c1) = tile
+            (window, crop) = read_window(dem, tile, 2)
+            window = as_float(window)
+            d8 = hydrology.d8_neighbour(window)
+            (flat, low, high) = hydrology.flat_edges(window, d8)
+            neighbour[r0:r1, c0:c1] = d8[crop]
+            towards[r0:r1, c0:c1] = np.where(low[crop], 0, -1)
+            away[r0:r1, c0:c1] = np.where(high[crop], 0, -1)
+            if flat[crop].any():
+                flats.add(k)
+
+        # 2. Distances across flats, resumed from the halos of neighbouring
+        # tiles until no tile changes
+        pending = set(flats)
+        while pending:
+            changed = set()
+            for k in sorted(pending):
+                (r0, r1, c0, c1) = tiles[k]
+                (window, crop) = read_window(dem, tiles[k], 1)
+                (z, allowed, steps) = flat_window(window, read_window(neighbour, tiles[k], 1)[0])
+                for distances in (towards, away):
+                    d = hydrology.padded(read_window(distances, tiles[k], 1)[0], -1)
+                    hydrology.flat_distance(d, allowed, z, steps)
+                    d = d.reshape(window.shape[0] + 2, window.shape[1] + 2)[1:-1, 1:-1][crop]
+                    if not np.array_equal(d, distances[r0:r1, c0:c1]):
+                        distances[r0:r1, c0:c1] = d
+                        changed.add(k)
+            pending = set(j for k in changed for j in neighbour_tiles(tiles, k) if j in flats)
+
+        # 3. Directions of the flat cells
+        for (k, tile) in enumerate(tiles):
+            (r0, r1, c0, c1) = tile
+            d8 = np.array(neighbour[r0:r1, c0:c1])
+            if k in flats:
+                (window, crop) = read_window(dem, tile, 1)
+                (z, allowed, steps) = flat_window(window, read_window(neighbour, tile, 1)[0])
+                t = hydrology.padded(read_window(towards, tile, 1)[0], -1)
+                a = hydrology.padded(read_window(away, tile, 1)[0], -1)
+                inside = np.zeros(window.shape, dtype = bool)
+                inside[crop] = True
+                cells = np.nonzero(allowed & (t > 0) & hydrology.padded(inside, False))[0].astype(steps[0].dtype)
+                width = window.shape[1] + 2
+                rows = cells // width - 1 - crop[0].start
+                cols = cells % width - 1 - crop[1].start
+                d8[rows, cols] = hydrology.flat_directions(cells, allowed, z, t, a, steps)
+            out[r0:r1, c0:c1] = hydrology.direction_codes(d8, np.isnan(as_float(np.asarray(dem[r0:r1, c0:c1]))))
+
+        del neighbour, towards, away
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+
+def flat_window(window, neighbour):
+    ''' Padded elevations, flat cells and D8 steps of a window (see
+    hydrology.flat_distance). '''
+    window = as_float(window)
+    z = hydrology.padded(window, np.nan)
+    allowed = hydrology.padded((neighbour < 0) & ~np.isnan(window), False)
+    return(z, allowed, hydrology.padded_steps(window.shape))
+
+
+# Flow accumulation
+
+def tile_flow(direction, tile):
+    ''' D8 graph of a tile: the receiver of every cell in the tile (flat
+    index, or -1 if it flows out of the tile or nowhere), the flat index in
+    the whole raster of the cell it flows to out of the tile (or -1), and
+    the NoData cells. '''
+    (r0, r1, c0, c1) = tile
+    (window, crop) = read_window(direction, tile, 1)
+    (height, width) = (r1 - r0, c1 - c0)
+    receiver = hydrology.downstream(window).reshape(window.shape)[crop].astype(np.int64)
+    valid = receiver >= 0
+    (rows, cols) = (receiver // window.shape[1] - crop[0].start, receiver % window.shape[1] - crop[1].start)
+    inside = valid & (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    local = np.where(inside, rows*width + cols, -1)
+    leaving = np.where(valid & ~inside, (rows + r0)*direction.shape[1] + cols + c0, -1)
+    return(local.ravel(), leaving.ravel(), (window[crop] == hydrology.NODATA_DIRECTION).ravel())
+
+def perimeter(height, width):
+    ''' Flat indices of the cells on the edge of a tile. '''
+    edge = np.zeros((height, width), dtype = bool)
+    edge[0, :] = edge[-1, :] = True
+    edge[:, 0] = edge[:, -1] = True
+    return(np.nonzero(edge.ravel())[0])
+
+def tile_weights(weight, tile, ncells):
+    ''' Own contribution of every cell of a tile: 1, or its weight (NaN
+    weights count as 0). '''
+    if weight is None:
+        return(np.ones(ncells, dtype = np.int32))
+    (r0, r1, c0, c1) = tile
+    own = np.asarray(weight[r0:r1, c0:c1], dtype = np.float32).ravel()
+    return(np.where(np.isnan(own), np.float32(0), own))
+
+def tile_accumulate(local, total):
+    ''' Accumulates "total" in place along the receivers of a tile. '''
+    indegree = np.bincount(local[local >= 0], minlength = len(local)).astype(np.int32)
+    hydrology.accumulate(local, total, indegree, np.arange(len(local), dtype = local.dtype))
+
+def perimeter_nodes(cells, shape, size, starts):
+    ''' Nodes of perimeter cells (flat indices in the raster) in the graph of
+    flow_accumulation: the perimeters of the tiles (see perimeter) one after
+    another, tile k's from starts[k]. '''
+    ncols = shape[1]
+    (r, c) = (cells // ncols, cells % ncols)
+    (tr, tc) = (r // size, c // size)
+    (i, j) = (r - tr*size, c - tc*size)
+    height = np.minimum(size, shape[0] - tr*size)
+    width = np.minimum(size, ncols - tc*size)
+    middle = np.minimum(width, 2)
+    position = np.where(i == 0, j, np.where(i == height - 1, width + middle*(height - 2) + j,
+                                            width + middle*(i - 1) + (j > 0)))
+    return(starts[tr*(-(-ncols // size)) + tc] + position)
+
+def flow_accumulation(direction, out, weight = None, max_memory = DEFAULT_MEMORY, scratch = None):
+    ''' Flow accumulation of a D8 flow direction raster (ESRI codes,
+    hydrology.NODATA_DIRECTION for NoData) into "out", as
+    hydrology.flow_accumulation (cells that cannot drain collect the flow of
+    their upstream cells), reading and writing by tiles that fit in
+    "max_memory" MB. "weight" is an optional raster of the same shape. The
+    graph of the perimeter cells of the tiles is kept in temporary files in
+    "scratch" (default: the system's temporary folder). '''
+    size = tile_size(max_memory)
+    tiles = tile_grid(direction.shape, size)
+    ncols = direction.shape[1]
+    folder = tempfile.mkdtemp(dir = scratch)
+    try:
+        # 1. Every tile on its own. Perimeter cells are linked to the next
+        # perimeter cell downstream, in the tile or across its edge.
+        for name in ('link', 'carried', 'exit', 'source'):
+            open(os.path.join(folder, name), 'wb').close()
+        starts = [0]
+        for tile in tiles:
+            (r0, r1, c0, c1) = tile
+            (height, width) = (r1 - r0, c1 - c0)
+            (local, leaving, nodata) = tile_flow(direction, tile)
+            total = tile_weights(weight, tile, len(local))
+            tile_accumulate(local, total)
+
+            edge = perimeter(height, width)
+            onedge = np.zeros(len(local), dtype = bool)
+            onedge[edge] = True
+            cells = np.arange(len(local))
+            stop = np.where((local < 0) | onedge, cells, local)
+            root = hydrology.follow(stop)
+            nxt = np.where(local[edge] >= 0, root[np.maximum(local[edge], 0)], -1)
+            nxt = np.where((nxt >= 0) & onedge[np.maximum(nxt, 0)], (nxt // width + r0)*ncols + nxt % width + c0, -1)
+            leaves = leaving[edge] >= 0
+
+            starts.append(starts[-1] + len(edge))
+            append_raw(folder, 'link', np.where(leaves, leaving[edge], nxt).astype(np.int64))
+            append_raw(folder, 'carried', np.where(leaves, total[edge], 0).astype(np.float64))
+            append_raw(folder, 'exit', leaves)
+
+        # 2. Flow between tiles, on the graph of perimeter cells, a chunk at
+        # a time: a cell passes on its whole total where it leaves its
+        # tile, and otherwise only the flow that entered the tile upstream
+        # of it
+        nnodes = starts[-1]
+        starts = np.array(starts)
+        chunk = size*size
+        link = open_raw(folder, 'link', np.int64)
+        carried = open_raw(folder, 'carried', np.float64)
+        exits = open_raw(folder, 'exit', bool)
+        receiver = scratch_array(folder, 'receiver', nnodes, np.int64)
+        indegree = scratch_array(folder, 'indegree', nnodes, np.int32)
+        for (s, e) in chunks(nnodes, chunk):
+            links = link[s:e]
+            receiver[s:e] = np.where(links >= 0, perimeter_nodes(np.maximum(links, 0), direction.shape, size, starts), -1)
+            (targets, counts) = runs(receiver[s:e][links >= 0])
+            indegree[targets] += counts.astype(np.int32)
+        for (s, e) in chunks(nnodes, chunk):
+            append_raw(folder, 'source', np.nonzero(indegree[s:e] == 0)[0].astype(np.int64) + s)
+        source = open_raw(folder, 'source', np.int64)
+        for (s, e) in chunks(len(source), chunk):
+            hydrology.accumulate(receiver, carried, indegree, np.array(source[s:e]))
+        inflow = scratch_array(folder, 'inflow', nnodes, np.float64)
+        for (s, e) in chunks(nnodes, chunk):
+            entering = exits[s:e] & (receiver[s:e] >= 0)
+            down = receiver[s:e][entering]
+            if len(down) == 0:
+                continue
+            order = np.argsort(down, kind = 'mergesort')
+            down = down[order]
+            first = np.nonzero(np.r_[True, down[1:] != down[:-1]])[0]
+            inflow[down[first]] += np.add.reduceat(carried[s:e][entering][order], first)
+        del link, carried, exits, receiver, indegree, source
+
+        # 3. Every tile again, with the flow entering it
+        missing = -1 if weight is None else np.nan
+        for (tile, start) in zip(tiles, starts):
+            (r0, r1, c0, c1) = tile
+            (height, width) = (r1 - r0, c1 - c0)
+            (local, leaving, nodata) = tile_flow(direction, tile)
+            own = tile_weights(weight, tile, len(local))
+            edge = perimeter(height, width)
+            total = own.copy()
+            total[edge] += inflow[start:start + len(edge)].astype(total.dtype)
+            tile_accumulate(local, total)
+            total -= own
+            total[nodata] = missing
+            out[r0:r1, c0:c1] = total.reshape(height, width)
+        del inflow
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+
+
+# Watersheds
+
+def watershed(direction, pour, out, nodata, max_memory = DEFAULT_MEMORY, scratch = None):
+    ''' Watershed of every pour point into "out", as hydrology.watershed
+    ("pour" an integer raster, "nodata" where there is no pour point),
+    reading and writing by tiles that fit in "max_memory" MB. The graph of
+    the perimeter cells of the tiles is kept in temporary files in
+    "scratch" (default: the system's temporary folder). '''
+    size = tile_size(max_memory)
+    tiles = tile_grid(direction.shape, size)
+    folder = tempfile.mkdtemp(dir = scratch)
+    try:
+        # 1. Every tile on its own: the first pour point downstream of every
+        # perimeter cell in the tile, or the perimeter cell of the next
+        # tile the flow goes on to
+        for name in ('link', 'label'):
+            open(os.path.join(folder, name), 'wb').close()
+        starts = [0]
+        for tile in tiles:
+            (r0, r1, c0, c1) = tile
+            (leaving, root, values) = tile_watershed(direction, pour, nodata, tile)
+            edge = perimeter(r1 - r0, c1 - c0)
+            starts.append(starts[-1] + len(edge))
+            append_raw(folder, 'link', np.where(values[root[edge]] == nodata, leaving[root[edge]], -1))
+            append_raw(folder, 'label', values[root[edge]].astype(np.int64))
+
+        # 2. Perimeter cells follow their links to the tile where their
+        # flow reaches a pour point, or stops, a chunk at a time
+        nnodes = starts[-1]
+        starts = np.array(starts)
+        chunk = size*size
+        link = open_raw(folder, 'link', np.int64)
+        label = open_raw(folder, 'label', np.int64)
+        node = scratch_array(folder, 'node', nnodes, np.int64)
+        for (s, e) in chunks(nnodes, chunk):
+            links = link[s:e]
+            node[s:e] = np.where(links >= 0, perimeter_nodes(np.maximum(links, 0), direction.shape, size, starts),
+                                 np.arange(s, e))
+        disk_follow(node, chunk)
+        for (s, e) in chunks(nnodes, chunk):
+            label[s:e] = label[node[s:e]]
+        del link, node
+
+        # 3. Every tile again, with the labels of its perimeter cells
+        for (tile, start) in zip(tiles, starts):
+            (r0, r1, c0, c1) = tile
+            (leaving, root, values) = tile_watershed(direction, pour, nodata, tile)
+            edge = perimeter(r1 - r0, c1 - c0)
+            values[edge] = label[start:start + len(edge)]
+            out[r0:r1, c0:c1] = values[root].reshape(r1 - r0, c1 - c0)
+        del label
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+
+def tile_watershed(direction, pour, nodata, tile):
+    ''' Watersheds of a tile on its own: the cells of the raster flowed to
+    out of the tile (see tile_flow), the cell of the tile every cell's flow
+    ends at (a pour point, a cell that flows out of the tile or nowhere) and
+    the pour point values ("nodata" elsewhere). '''
+    (r0, r1, c0, c1) = tile
+    (local, leaving, nodatacells) = tile_flow(direction, tile)
+    values = np.asarray(pour[r0:r1, c0:c1], dtype = np.int64).ravel()
+    cells = np.arange(len(local))
+    root = hydrology.follow(np.where((local < 0) | (values != nodata), cells, local))
+    return(leaving, root, values)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        JSON Files
+Purpose:     Small JSON files kept between runs (cache manifests, the
+             geometry registry), written so that an interrupted run always
+             leaves a whole file behind: a new file is written beside the
+             old one, and the two are swapped through a backup, as os.rename
+             does not replace files on Windows. Reading falls back on the
+             new file, then the backup, when a run stopped between renames.
+
+"""
+
+import json
+import os
+
+
+def load_json(path, default = None):
+    ''' Contents of the JSON file "path", or of the file a save of it
+    interrupted between its renames left behind; "default" if there is
+    none. '''
+    for candidate in (path, path + '.new', path + '.bak'):
+        if os.path.exists(candidate):
+            try:
+                with open(candidate) as f:
+                    return(json.load(f))
+            except ValueError:
+                continue
+    return(default)
+
+def save_json(path, contents):
+    ''' Writes "contents" to the JSON file "path" (its folder is created
+    when needed), through a new file and a backup of the old one. '''
+    folder = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    (new, backup) = (path + '.new', path + '.bak')
+    with open(new, 'w') as f:
+        json.dump(contents, f, indent = 1, sort_keys = True)
+    if os.path.exists(path):
+        if os.path.exists(backup):
+            os.remove(backup)
+        os.rename(path, backup)
+    os.rename(new, path)
+    if os.path.exists(backup):
+        os.remove(backup)
@@ -22,6 +22,10 @@ import arcpy
 import numpy as np
 import os
 
+from parcel_io import read_columns, write_columns, field_props, ensure_valid_geometry
+from parcel_loads import calc_pexport, calc_loads, build_prate_matrix, classify_hsg, join_lookup, apply_lu_rules, parse_lu_rules, DEFAULT_LU_RULES, LU_RULE_FIELDS, hsg_labels, P_LUTYPE_FIELD, P_COVER_FIELD, P_HSG_FIELD, P_RATE_FIELD, HSG_FIELDS, HSG_FIELD, HSG_FIELD_LENGTH, SQFT_PER_ACRE, RATE_SUFFIX, P_LOAD_FIELD
+from parcel_sensitivity import scenario_count, lognormal_factors, unit_area_scenarios, align_prates, p_scenarios, summarize
+
 
 '''
 Define useful functions
@@ -46,66 +50,6 @@ def unique_values(table, field):
         return sorted({row[0] for row in cursor})
 
     
-def join_table_shapefile(table, tablefield, shapefile, shapefield, outputname):
-    # This functino joins a table and feature class ("shapefile" based on the 
-    # join key in "tablefield" and "shapefield." Saves the joined result as a 
-    # new feature class named "outputname."
-    
-    # Create spatial dataset to Feature Layer 
-    shape_layer = AutoName(shapefile + '_table')
-    arcpy.MakeFeatureLayer_management(shapefile, shape_layer, workspace = workspace)
-    
-    # Add a join from the table to the newly created feature layer
-    temp_join = arcpy.AddJoin_management(shape_layer, shapefield, table, tablefield, 'KEEP_ALL')
-    tempout = AutoName('tempout')
-    # To make the join permanent, copy the result to a new feature class "tempout"
-    arcpy.CopyFeatures_management(temp_join, tempout)
-    
-    # Now clean up field names, which at present are messy
-    #   Get names as strings and remove the $ in Excel sheet names
-    table_name = os.path.basename(os.path.normpath(table))
-    shapefile_name = os.path.basename(os.path.normpath(shapefile))
-    table_name = table_name.replace("$", "_")
-    table_name_plus = table_name + '*'
-    shapefile_name = shapefile_name.replace("$", "_")
-    shapefile_name_plus = shapefile_name + '*'
-    
-    # Get all field names in result feature class
-    fms = arcpy.FieldMappings()
-    
-    for field in arcpy.ListFields(tempout, table_name_plus):
-        fm = arcpy.FieldMap()
-        fm.addInputField(tempout, field.name)
-        fname = fm.outputField
-        fname.name = field.name[(len(table_name) + 1):]
-        fname.alias = fname.name
-        fm.outputField = fname
-        fms.addFieldMap(fm)
-        
-    for field in arcpy.ListFields(tempout, shapefile_name_plus):
-        fm = arcpy.FieldMap()
-        fm.addInputField(tempout, field.name)
-        fname = fm.outputField
-        fname.name = field.name[(len(shapefile_name) + 1):]
-        fname.aliasName = fname.name
-        fm.outputField = fname
-        fms.addFieldMap(fm)
-    
-    arcpy.FeatureClassToFeatureClass_conversion(tempout, arcpy.env.workspace, outputname, field_mapping = fms)
-    
-    # Delete intermediate products
-    arcpy.Delete_management(tempout)
-
-    return(outputname)
-    
-def generate_loadexpr(load_field, area_ft_field):
-    # Generates a string expression that tells ArcGIS' field calculator how
-    # to calculate pollutant load using Unit Area Loading method
-    
-    expr = load_field + '*' + '(' + area_ft_field + '/43560' + ')'
-    
-    return(expr)
-    
 def calc_pER(parcelfc, lookuptable, load_field, lutype_field, imp_p_field, area_field, hsg_field):
     # parcelfc: Parcel feature class (attribute table) with HSG classification, impervious percent, and land use type fields
     # lookuptable: A table matching combinations of land use types, perviousness, HSG class with phosphorus export rates
@@ -115,71 +59,20 @@ def calc_pER(parcelfc, lookuptable, load_field, lutype_field, imp_p_field, area_
     # area_field: Name of the area field in parceltable (acres).
     # hsg_field: Name of the hsg class field in parceltable.
     
-    def calcp(perviousrate, imperviousrate, area_ft2, impervpct):
-        area = area_ft2/float(43560)    # convert area in square feet to acres
-        impervpct = impervpct/100.0
-        
-        a_pervious = (1.0 - impervpct)*area
-        a_impervious = impervpct*area
-        
-        pexpratelbs = (perviousrate*a_pervious) + (imperviousrate*a_impervious)
-        pexpratelbsacres = pexpratelbs/area
-        
-        return(pexpratelbs, pexpratelbsacres)
-    
     # Assume all is formatted as numpy structured arrays.
-    parceltable = arcpy.da.FeatureClassToNumPyArray(parcelfc, ['Code_1_2', 'mapc_id', 'lot_areaft', 'pct_imperv', 'hsgtype', 'TP_lbacyr'])
-    l = len(parceltable)
-    loadtable = arcpy.da.TableToNumPyArray(lookuptable, ['Phosphorus_source_by_land_use', 'Land_Surface_Cover', 'HSG', 'P_load_export_rate__lbs_acre_year_'])
+    parceltable = arcpy.da.FeatureClassToNumPyArray(parcelfc, [lutype_field, 'mapc_id', area_field, imp_p_field, hsg_field, load_field])
+    loadtable = arcpy.da.TableToNumPyArray(lookuptable, [P_LUTYPE_FIELD, P_COVER_FIELD, P_HSG_FIELD, P_RATE_FIELD])
     
-    pexpratelbs = list()
-    pexprateperacre = list()
-    for k in range(l):
-        area = parceltable[area_field][k]
-        impervpct = parceltable[imp_p_field][k]
-        hsgtype = parceltable[hsg_field][k]
-        lutype = parceltable[lutype_field][k]
-        
-        # Look up other info from lookup table
-        typematch = np.where(loadtable['Phosphorus_source_by_land_use'] == lutype, True, False)
-        soilmatch = np.where(loadtable['HSG'] == hsgtype, True, False)
-        pervmatch = np.where(loadtable['Land_Surface_Cover'] == 'Pervious', True, False)
-        impervmatch = np.where(loadtable['Land_Surface_Cover'] == 'Directly connected impervious', True, False)
-        
-        perviousind = typematch & soilmatch & pervmatch
-        impervind = typematch & soilmatch & impervmatch
-        
-        if str(hsgtype) == 'UNC': impervpct = 100.0
-        
-        if sum(perviousind) == 0:
-            perviousrate = 0.0
-        else:
-            perviousrate = loadtable['P_load_export_rate__lbs_acre_year_'][perviousind][0]
-            
-        if sum(impervind) == 0:
-            imperviousrate = 0.0
-        else:
-            imperviousrate = loadtable['P_load_export_rate__lbs_acre_year_'][impervind][0]
-            
-        (pexplbstemp, pexplbacrestemp) = calcp(perviousrate, imperviousrate, area, impervpct)
-        pexpratelbs.append(pexplbstemp)
-        pexprateperacre.append(pexplbacrestemp)
+    # Join every parcel to its (land use, HSG, cover) export rates at once
+    (pexpratelbs, pexprateperacre) = calc_pexport(parceltable, loadtable, lutype_field, imp_p_field, area_field, hsg_field)
 
     return(pexpratelbs, pexprateperacre)
-
-    
-def findindex(table, fieldname):
-    ''' Function from https://gis.stackexchange.com/questions/101540/finding-the-index-of-a-field-with-its-name-using-arcpy
-    to find the index of a table's fields from the field name '''
-    return [i.name for i in arcpy.ListFields(table)].index(fieldname)
   
 
 ''' 
 Set up 
 '''
 
-mxd = arcpy.mapping.MapDocument("CURRENT")
-
 # Set up workspace
 workspace = arcpy.GetParameterAsText(0)
 # workspace = 'K:\DataServices\Projects\Current_Projects\Environment\Neponset\IDDE_Task_FY19\BMP_Prioritization\Data\Spatial\ParcelDB_creation.gdb'
@@ -210,6 +103,28 @@ table_1_2 = arcpy.GetParameterAsText(5)     # P export rate table by LU and HGS
 townpolys = arcpy.GetParameterAsText(6)
 # townpolys = 'K:\DataServices\Projects\Current_Projects\Environment\Neponset\IDDE_Task_FY19\BMP_Prioritization\Data\Spatial\ParcelDB_creation.gdb\NepRWA_townpolys'
 
+# Parameters 7-11 are script-only: the BMP Prioritization Toolbox does not
+# define them, so they keep their defaults unless added (see README.md)
+lurules_table = arcpy.GetParameterAsText(7) # Optional land use override rules table or CSV
+                                            # (Field, Operator, Value, Code_3_12, Code_1_2);
+                                            # DEFAULT_LU_RULES are used when left blank
+
+# Optional sensitivity mode: evaluate the loads under many alternative sets of
+# export rates and report how stable each parcel's load and rank are.
+sens_runs = arcpy.GetParameterAsText(8)     # Number of Monte Carlo scenarios (blank or 0: off)
+sens_runs = int(sens_runs) if sens_runs else 0
+sens_cv = arcpy.GetParameterAsText(9)       # Coefficient of variation of the export rates
+sens_cv = float(sens_cv) if sens_cv else 0.3
+sens_ptables = arcpy.GetParameterAsText(10) # Alternative table_1_2 tables, separated by ';'
+sens_ptables = [x for x in sens_ptables.split(';') if x]
+sens_lutables = arcpy.GetParameterAsText(11) # Alternative luloadtable tables, separated by ';'
+sens_lutables = [x for x in sens_lutables.split(';') if x]
+try:
+    nruns = scenario_count(sens_runs, [len(sens_ptables), len(sens_lutables)])
+except ValueError as e:
+    arcpy.AddError('ERROR: ' + str(e))
+    raise arcpy.ExecuteError(str(e))
+
 # Set up names from paths
 bmpparcels_name = os.path.basename(os.path.normpath(bmpparcels))
 loadmaptable_name = os.path.basename(os.path.normpath(loadmaptable))
@@ -220,123 +135,114 @@ pload_name = os.path.basename(os.path.normpath(table_1_2))
 
 ''' Calculate load for each parcel'''
 
-# 1. Join luloadtable to bmpparcels to get code from 3-12 to attach nutrient export rates
-keepfields = ['Code_3_12']  
-outname = AutoName('parcels_with_loadusecode')
-bmp_with312code = join_table_shapefile(loadmaptable, 'Code_Parcel_Database', bmpparcels, 'luc_adj_1', outname)
-bmp_with312code_name = os.path.basename(os.path.normpath(bmp_with312code))
-
-# Repeat with EPA table/guidelines for calculating MS4 phosphorus export rates: add table 1-2
-outname2 = AutoName('parcels_with_plutype')
-parcel_w_12_lutype = join_table_shapefile(plulookup, 'Code_Parcel_Database', bmp_with312code, 'luc_adj_1', outname2)
-parcel_w_12_lutype_name = os.path.basename(os.path.normpath(parcel_w_12_lutype))
-
-# 1a.1 Validate table to replace FEE, ROW parcels with "Low-Priority Loading" (Total N, Total Suspended Solids)
-# or "Highway" or "Water" classes (table 1-2)
+# 1. Look up land use codes for nutrient export rates (table 3-12) and for
+# EPA MS4 phosphorus export rates (table 1-2) from each parcel's land use.
+# The lookup tables are small, so they are joined in memory and only the
+# looked-up columns are written to a single copy of the parcels.
+outname_new = AutoName('parcels_with_loadvals')
+bmp_withloadval = arcpy.CopyFeatures_management(bmpparcels, outname_new).getOutput(0)
 
 lucode = 'luc_adj_1'
 codename = 'Code_3_12'
 codePname = 'Code_1_2'
-wetland_p = 'wetland_p'
-area_ft = 'lot_areaft'
-
-fields = [lucode, codename, codePname, wetland_p, area_ft]
 
-with arcpy.da.UpdateCursor(parcel_w_12_lutype, fields) as cursor:
-    for row in cursor:
-        if row[0] is None or row[0] == ' ':
-            row[1] = 'Low Priority Loading'
-            row[2] = 'Open Land'
-        elif row[3] >= 0.9: # If parcel 90% wetland or more
-            row[1] = 'Low Priority Loading'
-            row[2] = 'Forest'
-        cursor.updateRow(row)
+# 1a. Land use overrides (ROW, PRIV_ROW, RAIL_ROW and WATER parcels, blank land
+# uses and parcels that are 90% wetland or more) come from an ordered rule
+# table, so they can be changed for each region without editing this script.
+if lurules_table:
+    lurules = parse_lu_rules([row for row in arcpy.da.SearchCursor(lurules_table, LU_RULE_FIELDS)])
+else:
+    lurules = DEFAULT_LU_RULES
 
-# 1a. Validate table to make sure FEE, ROW parcels are correctly encoded
+readfields = [lucode, 'lot_areaft', 'pct_imperv'] + HSG_FIELDS + [rule[0] for rule in lurules]
+readfields = [fld for k, fld in enumerate(readfields) if fld not in readfields[:k]]
+parcelcols = read_columns(bmp_withloadval, readfields)
+loadmapcols = read_columns(loadmaptable, ['Code_Parcel_Database', codename])
+plucols = read_columns(plulookup, ['Code_Parcel_Database', codePname])
 
-polyname = 'poly_typ'
-codename = 'Code_3_12'
-codePname = 'Code_1_2'
+codecols = join_lookup(parcelcols[lucode], loadmapcols, 'Code_Parcel_Database', [codename])
+codecols.update(join_lookup(parcelcols[lucode], plucols, 'Code_Parcel_Database', [codePname]))
+(codecols[codename], codecols[codePname]) = apply_lu_rules(parcelcols, codecols[codename], codecols[codePname], lurules)
 
-fields = [polyname, codename, codePname]
-
-with arcpy.da.UpdateCursor(parcel_w_12_lutype, fields) as cursor:
-    for row in cursor:
-        if row[0] == "ROW":
-            row[1] = 'Highway'
-            row[2] = 'Highway'
-            
-        elif row[0] == "PRIV_ROW":
-            row[1] = 'Highway'
-            row[2] = 'Highway'
-            
-        elif row[0] == "RAIL_ROW":
-            row[1] = 'Highway'
-            row[2] = 'Highway'
-            
-        elif row[0] == "WATER":
-            row[1] = 'Low Priority Loading'
-            row[2] = 'Water'
-            
-        cursor.updateRow(row)
-        
-
-
-print "ROW, PRIV_ROW, WATER codes updated"
 arcpy.AddMessage("ROW, PRIV_ROW, WATER codes updated")
 
-# 1b. Use new, fully filled out dataset to calculate nutrient loads
-outname_new = AutoName('parcels_with_loadvals')
-bmp_withloadval = join_table_shapefile(luloadtable, 'LU_Type', parcel_w_12_lutype, codename, outname_new)
-
-# 2. Calculalate nutrient loads based on table 3-12 figures & LU categories, impervious cover percentage
-# 2a. Add fields with appropriate settings
-
-arcpy.AddField_management(bmp_withloadval, 'TN_lbyr', 'DOUBLE')
-arcpy.AddField_management(bmp_withloadval, 'TP_lbyr', 'DOUBLE')
-arcpy.AddField_management(bmp_withloadval, 'TSS_lbyr', 'DOUBLE')
-
-# 2b. Fill in fields with new calculations for total Nitrogen, suspended solids load
-tn_field = '!TN_lbacyr!'
-tp_field = '!TP_lbacyr!'
-tss_field = '!TSS_lbacyr!'
-
-areaft = '!lot_areaft!'  
-
-expr_N = generate_loadexpr(tn_field, areaft)
-expr_TSS = generate_loadexpr(tss_field, areaft)
-
-expr_type = "PYTHON"
-
-arcpy.CalculateField_management(bmp_withloadval, 'TN_lbyr', expr_N, expr_type)
-arcpy.CalculateField_management(bmp_withloadval, 'TSS_lbyr', expr_TSS, expr_type)
+# 1b. Use the overridden codes to look up nutrient export rates
+ratefields = [fld.name for fld in arcpy.ListFields(luloadtable) if fld.type not in ['OID', 'Geometry'] and fld.name != 'LU_Type']
+lurates = read_columns(luloadtable, ['LU_Type'] + ratefields)
+codecols.update(join_lookup(codecols[codename], lurates, 'LU_Type', ratefields))
+
+# 2. Calculate nutrient loads based on table 3-12 figures & LU categories, impervious cover percentage.
+# TN, TSS (and any other pollutant with a *_lbacyr rate in luloadtable) use the
+# Unit Area Loading method; TP uses the EPA MS4 method, which needs the dominant
+# soil group of every parcel.
+parcelcols.update(codecols)
+hsgtypes = hsg_labels(classify_hsg(parcelcols, HSG_FIELDS))
+loadtable = arcpy.da.TableToNumPyArray(table_1_2, [P_LUTYPE_FIELD, P_COVER_FIELD, P_HSG_FIELD, P_RATE_FIELD])
+codecols.update(calc_loads(parcelcols, ratefields, loadtable, codePname, 'pct_imperv', 'lot_areaft', hsgtype = hsgtypes))
+codecols[HSG_FIELD] = hsgtypes.astype(object)
+
+# 2a. Sensitivity mode. Every pollutant is evaluated on the same "nruns"
+# scenarios. They come from the alternative rate tables when they are given
+# (a pollutant whose tables are not varied keeps its rates in every
+# scenario), otherwise every export rate is multiplied by a lognormal factor
+# (mean 1, coefficient of variation "sens_cv") in each scenario.
+# Parcels are ranked on load per acre within their municipality, as in
+# nutrient_muni_percentile.py.
+drawn = not (sens_ptables or sens_lutables)
+if nruns > 0:
+    arcpy.AddMessage('Evaluating ' + str(nruns) + ' export rate scenarios')
+    acres = parcelcols['lot_areaft']/SQFT_PER_ACRE
+    groups = None
+    if arcpy.ListFields(bmp_withloadval, 'muni'):
+        groups = read_columns(bmp_withloadval, ['muni'])['muni'].astype('U')
+
+    scenarios = dict()
+    lutypes = sorted(set(lurates['LU_Type']) - set([None]))
+    for fld in [x for x in ratefields if x.endswith(RATE_SUFFIX) and x != P_LOAD_FIELD]:
+        if sens_lutables:
+            rates = np.array([join_lookup(np.array(lutypes, dtype = object), read_columns(x, ['LU_Type', fld]), 'LU_Type', [fld])[fld] for x in sens_lutables])
+        else:
+            rates = join_lookup(np.array(lutypes, dtype = object), lurates, 'LU_Type', [fld])[fld]
+            if drawn:
+                rates = rates*lognormal_factors(nruns, len(lutypes), sens_cv, seed = len(scenarios))
+            else:
+                rates = np.tile(rates, (nruns, 1))
+        scenarios[fld[:-len(RATE_SUFFIX)]] = unit_area_scenarios(parcelcols[codename], parcelcols['lot_areaft'], lutypes, rates)
+
+    if sens_ptables:
+        prates = align_prates([build_prate_matrix(arcpy.da.TableToNumPyArray(x, [P_LUTYPE_FIELD, P_COVER_FIELD, P_HSG_FIELD, P_RATE_FIELD])) for x in sens_ptables])
+    else:
+        (plutypes, phsgtypes, rates) = build_prate_matrix(loadtable)
+        if drawn:
+            rates = rates*lognormal_factors(nruns, rates.size, sens_cv, seed = len(scenarios)).reshape((nruns,) + rates.shape)
+        else:
+            rates = np.tile(rates, (nruns, 1, 1, 1))
+        prates = (plutypes, phsgtypes, rates)
+    scenarios[P_LOAD_FIELD[:-len(RATE_SUFFIX)]] = p_scenarios(parcelcols[codePname], hsgtypes, parcelcols['lot_areaft'], parcelcols['pct_imperv'], prates)
+
+    for pollutant in sorted(scenarios):
+        arcpy.AddMessage('Summarizing ' + pollutant + ' scenarios')
+        stats = summarize(scenarios[pollutant], acres = acres, groups = groups)
+        for stat in sorted(stats):
+            codecols[pollutant + '_' + stat] = stats[stat]
+
+# Write codes, rates, loads and soil groups back in a single pass
+codetypes = dict((fld, field_props(luloadtable, fld)) for fld in ratefields)
+codetypes[codename] = field_props(loadmaptable, codename)
+codetypes[codePname] = field_props(plulookup, codePname)
+codetypes[HSG_FIELD] = ('TEXT', HSG_FIELD_LENGTH)
+write_columns(bmp_withloadval, codecols, codetypes)
 
 '''
-# Estimate total P export rate based on EPA MS4 method
+# Split parcels by municipality
 '''
     
-def calcp(perviousrate, imperviousrate, area_ft2, impervpct):
-    area = area_ft2/float(43560)    # convert area in square feet to acres
-    impervpct = impervpct/100.0
-    
-    a_pervious = (1.0 - impervpct)*area
-    a_impervious = impervpct*area
-    
-    pexpratelbs = (perviousrate*a_pervious) + (imperviousrate*a_impervious)
-    pexpratelbsacres = pexpratelbs/area
-    
-    return(pexpratelbs, pexpratelbsacres)
-    
-def muniPload(parcelfc,
-              townpolys,
-              muniname,
-              muninamecaps,
-              lookuptable = table_1_2,
-              load_field = 'TP_lbacyr',
-              lutype_field = 'Code_1_2',
-              imp_p_field = 'pct_imperv',
-              area_field = 'lot_areaft',
-              hsg_fields = ['hsgA_ac', 'hsgB_ac', 'hsgC_ac', 'hsgCD_ac', 'hsgD_ac', 'hsgUNC_ac']):
+def municlip(parcelfc,
+             townpolys,
+             muniname,
+             muninamecaps):
+    # Loads only depend on parcel attributes, so they are calculated for the
+    # whole parcel layer above and carried over by the clip.
 
     # Create clip boundary
     munioutline = AutoName(muniname + '_outline')
@@ -345,75 +251,6 @@ def muniPload(parcelfc,
     parcelmuniname = AutoName('clipparcels' + muniname)
     arcpy.AddMessage('Clipping parcels to ' + muniname + ' outline')
     arcpy.Clip_analysis(parcelfc, munioutline, parcelmuniname)
-    
-    parceltable = arcpy.da.FeatureClassToNumPyArray(parcelmuniname, ['Code_1_2', 'mapc_id', 'lot_areaft', 'pct_imperv', 'hsgA_ac', 'hsgB_ac', 'hsgC_ac', 'hsgCD_ac', 'hsgD_ac', 'hsgUNC_ac', 'TP_lbacyr'])
-    l = len(parceltable)
-    loadtable = arcpy.da.TableToNumPyArray(lookuptable, ['Phosphorus_source_by_land_use', 'Land_Surface_Cover', 'HSG', 'P_load_export_rate__lbs_acre_year_'])
-    
-    pexpratelbs = list()
-    pexprateperacre = list()
-    for n in range(l):
-        area = parceltable[area_field][n]
-        impervpct = parceltable[imp_p_field][n]
-        lutype = parceltable[lutype_field][n]
-        hsgA = parceltable[hsg_fields[0]][n]
-        hsgB = parceltable[hsg_fields[1]][n]
-        hsgC = parceltable[hsg_fields[2]][n]
-        hsgCD = parceltable[hsg_fields[3]][n]
-        hsgD = parceltable[hsg_fields[4]][n]
-        hsgUNC = parceltable[hsg_fields[5]][n]
-        hsgareas = np.asarray([hsgA, hsgB, hsgC, hsgCD, hsgD, hsgUNC])
-        if np.max(hsgareas) == hsgA:
-            hsgtype = 'A'
-        elif np.max(hsgareas) == hsgB:
-            hsgtype = 'B'
-        elif np.max(hsgareas) == hsgC:
-            hsgtype = 'C'
-        elif np.max(hsgareas) == hsgCD:
-            hsgtype = 'C/D'
-        elif np.max(hsgareas) == hsgD:
-            hsgtype = 'D'
-        else:
-            hsgtype = 'D'
-        lutype = parceltable[lutype_field][n]
-        
-        # Look up other info from lookup table
-        typematch = np.where(loadtable['Phosphorus_source_by_land_use'] == lutype, True, False)
-        soilmatch = np.where(loadtable['HSG'] == hsgtype, True, False)
-        pervmatch = np.where(loadtable['Land_Surface_Cover'] == 'Pervious', True, False)
-        impervmatch = np.where(loadtable['Land_Surface_Cover'] == 'Directly connected impervious', True, False)
-        
-        perviousind = typematch & soilmatch & pervmatch
-        impervind = typematch & soilmatch & impervmatch
-            
-        if str(hsgtype) == 'UNC': impervpct = 100.0
-        
-        if sum(perviousind) == 0:
-            perviousrate = 0.0
-        else:
-            perviousrate = loadtable['P_load_export_rate__lbs_acre_year_'][perviousind][0]
-            
-        if sum(impervind) == 0:
-            imperviousrate = 0.0
-        else:
-            imperviousrate = loadtable['P_load_export_rate__lbs_acre_year_'][impervind][0]
-            
-        (pexplbstemp, pexplbacrestemp) = calcp(perviousrate, imperviousrate, area, impervpct)
-        pexpratelbs.append(pexplbstemp)
-        pexprateperacre.append(pexplbacrestemp)
-    
-    loadname_lbs = 'TP_lbyr'
-    loadname_lbacres = 'TP_lbacyr'
-    
-    fields = [loadname_lbs, loadname_lbacres]
-    
-    j = 0
-    with arcpy.da.UpdateCursor(parcelmuniname, fields) as cursor:
-        for row in cursor:
-            row[0] = pexpratelbs[j]
-            row[1] = pexprateperacre[j]
-            j = j + 1
-            cursor.updateRow(row)
             
     arcpy.Delete_management(munioutline)
     
@@ -424,15 +261,14 @@ townnames = unique_values(townpolys, 'town')
 townnames = [x.title() for x in townnames]
 townnames_caps = [x.upper() for x in townnames]
 
-# Loop through all municipalities and estimate loads in each.
+# Loop through all municipalities and clip the parcels to each.
 muniparcelnames = list()
 for k in range(len(townnames_caps)):
     muniname = townnames[k]
     muninamecaps = townnames_caps[k]
-    arcpy.AddMessage('Starting ' + muniname + ' Phosphorus load calculations')
-    print('Starting ' + muniname + ' Phosphorus load calculations')
+    arcpy.AddMessage('Starting ' + muniname)
     print('Starting ' + muniname)
-    muniparcelnames.append(muniPload(bmp_withloadval, townpolys, muniname, muninamecaps))
+    muniparcelnames.append(municlip(bmp_withloadval, townpolys, muniname, muninamecaps))
     
 arcpy.AddMessage("Completed all municipalities")
 
@@ -450,36 +286,22 @@ arcpy.AddMessage("Municipalities Merged")
 
 # Now that results have been combined, delete individual municipal results.
 # Also delete other layers that have outlived their usefulness.
-arcpy.Delete_management(bmp_with312code)
-arcpy.Delete_management(parcel_w_12_lutype)
 arcpy.Delete_management(bmp_withloadval)
 for k in range(len(muniparcelnames)):
     arcpy.Delete_management(muniparcelnames[k])
 
 # Clean up results further.
-# Check geometry for issues.
-outtable = AutoName('geomtable')
-arcpy.AddMessage('Checking ' + outfile + ' geometry...')
-arcpy.CheckGeometry_management(outfile, outtable)
-
-#Repair geometry problems
-arcpy.AddMessage('Repairing ' + outfile + ' geometry...')
-arcpy.RepairGeometry_management(outfile)
-arcpy.Delete_management(outtable)
+# Check geometry for issues and repair them.
+ensure_valid_geometry(outfile)
 
 # Clean results further by deleting extraneous fields
-arcpy.DeleteField_management(outfile, 'OBJECTID')
-arcpy.DeleteField_management(outfile, 'LU_type')
-arcpy.DeleteField_management(outfile, 'OBJECTID_1')
-arcpy.DeleteField_management(outfile, 'Code_3_12')
-arcpy.DeleteField_management(outfile, 'Code_1_2')
-arcpy.DeleteField_management(outfile, 'Code_Parcel_Database')
-arcpy.DeleteField_management(outfile, 'OBJECTID_12')
-arcpy.DeleteField_management(outfile, 'Code_3_12_13')
-arcpy.DeleteField_management(outfile, 'Code_Parcel_Database_1')
-arcpy.DeleteField_management(outfile, 'Desc_Parcel_Database_1')
-arcpy.DeleteField_management(outfile, 'Desc_full_1')
-arcpy.DeleteField_management(outfile, 'temp')
+# (the lookup tables are no longer joined, so only drop the fields that exist)
+dropfields = ['OBJECTID', 'LU_type', 'OBJECTID_1', 'Code_3_12', 'Code_1_2', 'Code_Parcel_Database',
+              'OBJECTID_12', 'Code_3_12_13', 'Code_Parcel_Database_1', 'Desc_Parcel_Database_1', 'Desc_full_1', 'temp']
+existing = [fld.name.lower() for fld in arcpy.ListFields(outfile) if fld.type not in ['OID', 'Geometry']]
+dropfields = [fld for fld in dropfields if fld.lower() in existing]
+if dropfields:
+    arcpy.DeleteField_management(outfile, dropfields)
 
 # Fin
 
@@ -9,6 +9,10 @@ Created on Wed Nov 20 12:47:37 2019
 import arcpy
 import numpy as np
 import os
+
+from parcel_io import ensure_valid_geometry
+from parcel_loads import calc_pexport, P_LUTYPE_FIELD, P_COVER_FIELD, P_HSG_FIELD, P_RATE_FIELD
+from parcel_rank import epctile, grouped_epctile
 #from arcpy import env
 #import math
 #import pandas as pd
@@ -98,7 +102,7 @@ def generate_loadexpr(load_field, area_ft_field):
     return(expr)
     
 def calc_pER(parcelfc, lookuptable, load_field, lutype_field, imp_p_field, area_field, hsg_field):
-    # parceltable: Parcel feature class (attribute table) with HSG classification, impervious percent, and land use type fields
+    # parcelfc: Parcel feature class (attribute table) with HSG classification, impervious percent, and land use type fields
     # lookuptable: A table matching combinations of land use types, perviousness, HSG class with phosphorus export rates
     # load_field: the empty field in parceltable in which to store calculated phosphrous export rates from each parce.
     # lutype_field: Name of the field in parceltable that contains land use type classification for lookup in the lookuptable.
@@ -106,55 +110,12 @@ def calc_pER(parcelfc, lookuptable, load_field, lutype_field, imp_p_field, area_
     # area_field: Name of the area field in parceltable (acres).
     # hsg_field: Name of the hsg class field in parceltable.
     
-    def calcp(perviousrate, imperviousrate, area_ft2, impervpct):
-        area = area_ft2/float(43560)    # convert area in square feet to acres
-        impervpct = impervpct/100.0
-        
-        a_pervious = (1.0 - impervpct)*area
-        a_impervious = impervpct*area
-        
-        pexpratelbs = (perviousrate*a_pervious) + (imperviousrate*a_impervious)
-        pexpratelbsacres = pexpratelbs/area
-        
-        return(pexpratelbs, pexpratelbsacres)
-    
     # Assume all is formatted as numpy structured arrays.
-    parceltable = arcpy.da.FeatureClassToNumPyArray(parcelfc, ['Code_1_2', 'mapc_id', 'lot_areaft', 'pct_imperv', 'hsgtype', 'TP_lbacyr'])
-    l = len(parceltable)
-    loadtable = arcpy.da.TableToNumPyArray(lookuptable, ['Phosphorus_source_by_land_use', 'Land_Surface_Cover', 'HSG', 'P_load_export_rate__lbs_acre_year_'])
-    
-    pexpratelbs = list()
-    pexprateperacre = list()
-    for k in range(l):
-        area = parceltable[area_field][k]
-        impervpct = parceltable[imp_p_field][k]
-        hsgtype = parceltable[hsg_field][k]
-        lutype = parceltable[lutype_field][k]
-        
-        # Look up other info from lookup table
-        typematch = np.where(loadtable['Phosphorus_source_by_land_use'] == lutype, True, False)
-        soilmatch = np.where(loadtable['HSG'] == hsgtype, True, False)
-        pervmatch = np.where(loadtable['Land_Surface_Cover'] == 'Pervious', True, False)
-        impervmatch = np.where(loadtable['Land_Surface_Cover'] == 'Directly connected impervious', True, False)
-        
-        perviousind = typematch & soilmatch & pervmatch
-        impervind = typematch & soilmatch & impervmatch
-        
-        if str(hsgtype) == 'UNC': impervpct = 100.0
-        
-        if sum(perviousind) == 0:
-            perviousrate = 0.0
-        else:
-            perviousrate = loadtable['P_load_export_rate__lbs_acre_year_'][perviousind][0]
-            
-        if sum(impervind) == 0:
-            imperviousrate = 0.0
-        else:
-            imperviousrate = loadtable['P_load_export_rate__lbs_acre_year_'][impervind][0]
-            
-        (pexplbstemp, pexplbacrestemp) = calcp(perviousrate, imperviousrate, area, impervpct)
-        pexpratelbs.append(pexplbstemp)
-        pexprateperacre.append(pexplbacrestemp)
+    parceltable = arcpy.da.FeatureClassToNumPyArray(parcelfc, [lutype_field, 'mapc_id', area_field, imp_p_field, hsg_field, load_field])
+    loadtable = arcpy.da.TableToNumPyArray(lookuptable, [P_LUTYPE_FIELD, P_COVER_FIELD, P_HSG_FIELD, P_RATE_FIELD])
+    
+    # Join every parcel to its (land use, HSG, cover) export rates at once
+    (pexpratelbs, pexprateperacre) = calc_pexport(parceltable, loadtable, lutype_field, imp_p_field, area_field, hsg_field)
 
     return(pexpratelbs, pexprateperacre)
         
@@ -193,6 +154,15 @@ loadparcels = arcpy.GetParameterAsText(1)       # This should be the feature cla
 townpolys = arcpy.GetParameterAsText(2)
 # townpolys = 'K:\DataServices\Projects\Current_Projects\Environment\Neponset\IDDE_Task_FY19\BMP_Prioritization\Data\Spatial\ParcelDB_creation.gdb\NepRWA_townpolys'
 
+# Parameters 3 and 4 are script-only (not in the toolbox; see README.md)
+pctile_mode = arcpy.GetParameterAsText(3)   # 'GROUPED' (default): rank parcels within each
+                                            # value of "groupfield" in one pass over the table.
+                                            # 'CLIP': clip parcels to each town outline first.
+if not pctile_mode: pctile_mode = 'GROUPED'
+
+groupfield = arcpy.GetParameterAsText(4)    # Parcel field identifying the municipality
+if not groupfield: groupfield = 'muni'
+
 
 '''
 # Calculate percentiles within each municipality
@@ -212,13 +182,6 @@ def calcp(perviousrate, imperviousrate, area_ft2, impervpct):
     
     return(pexpratelbs, pexpratelbsacres)
     
-def epctile(array):
-    pctiles = np.zeros(len(array))
-    for n in range(len(array)):
-        pctiles[n] = 1.0 - (sum(array > array[n])/float(len(array)))
-        
-    return(pctiles)
-    
 def munipctile(parcelfc,
               townpolys,
               muniname,
@@ -238,19 +201,14 @@ def munipctile(parcelfc,
     
 
     ''' Transfer fields of interest to a numpy array so we can work with numbers more easily. '''
-    # Hitting memory error at this line (MemoryError: cannot allocate array memory)
     parceltable = arcpy.da.FeatureClassToNumPyArray(parcelmuniname, [Pload_field, Nload_field, TSSload_field], null_value = np.nan)
-    l = len(parceltable)
-    
-    # Create vectors for the percentile values.
-    TNpctile = np.zeros(l)
-    TPpctile = np.zeros(l)
-    TSSpctile = np.zeros(l)
     
-    # Fill in arrays with values calculated from parceltable. 
-    TNpctile = epctile(parceltable[Nload_field])
-    TPpctile = epctile(parceltable[Pload_field])
-    TSSpctile = epctile(parceltable[TSSload_field])
+    # Rank all three loads in one call, one column per pollutant.
+    loads = np.column_stack([parceltable[Nload_field], parceltable[Pload_field], parceltable[TSSload_field]])
+    pctiles = epctile(loads)
+    TNpctile = pctiles[:, 0]
+    TPpctile = pctiles[:, 1]
+    TSSpctile = pctiles[:, 2]
     
     ''' Switch back to working with the feature class '''
     # Add fields in preparation
@@ -274,43 +232,88 @@ def munipctile(parcelfc,
     
     return(parcelmuniname)
     
+def grouppctile(parcelfc,
+                outfile,
+                groupfield,
+                groupnames,
+                Pload_field = 'TP_lbacyr',
+                Nload_field = 'TN_lbacyr',
+                TSSload_field = 'TSS_lbacyr'):
+    ''' Calculates load percentiles within every municipality at once. Parcels
+    are grouped by their "groupfield" attribute instead of being clipped to
+    each town outline, so the only geometry copy is the output itself. '''
+    
+    # Copy the parcels of all requested municipalities to the output
+    delimfield = arcpy.AddFieldDelimiters(parcelfc, groupfield)
+    names = ["'" + name.replace("'", "''") + "'" for name in groupnames]
+    arcpy.AddMessage('Selecting parcels in ' + str(len(names)) + ' municipalities')
+    arcpy.Select_analysis(parcelfc, outfile, delimfield + ' IN (' + ', '.join(names) + ')')
+    
+    ''' Transfer fields of interest to a numpy array so we can work with numbers more easily. '''
+    nulls = {groupfield: '', Pload_field: np.nan, Nload_field: np.nan, TSSload_field: np.nan}
+    parceltable = arcpy.da.TableToNumPyArray(outfile, [groupfield, Pload_field, Nload_field, TSSload_field], null_value = nulls)
+    
+    # Rank all three loads within every municipality in one call.
+    loads = np.column_stack([parceltable[Nload_field], parceltable[Pload_field], parceltable[TSSload_field]])
+    arcpy.AddMessage('Calculating percentiles within each municipality')
+    pctiles = grouped_epctile(loads, parceltable[groupfield])
+    
+    ''' Switch back to working with the feature class '''
+    arcpy.AddField_management(outfile, 'TN_pctile', 'DOUBLE')
+    arcpy.AddField_management(outfile, 'TP_pctile', 'DOUBLE')
+    arcpy.AddField_management(outfile, 'TSS_pctile', 'DOUBLE') 
+    
+    fields = ['TN_pctile', 'TP_pctile', 'TSS_pctile']
+    
+    # Write all three columns in a single pass
+    j = 0
+    with arcpy.da.UpdateCursor(outfile, fields) as cursor:
+        for row in cursor:
+            row[0] = pctiles[j, 0]
+            row[1] = pctiles[j, 1]
+            row[2] = pctiles[j, 2]
+            j = j + 1
+            cursor.updateRow(row)
+    
+    return(outfile)
+    
 
 # Get town names from "townpolys" feature class
 townnames = unique_values(townpolys, 'town')
 townnames = [x.title() for x in townnames]
 townnames_caps = [x.upper() for x in townnames]
-muniparcelnames = list()
-for k in range(len(townnames_caps)):
-    muniname = townnames[k]
-    muninamecaps = townnames_caps[k]
-    print('Starting ' + muniname + ' Phosphorus load calculations')
-    print('Starting ' + muniname)
-    muniparcelnames.append(munipctile(loadparcels, townpolys, muniname, muninamecaps))
-
-
+if pctile_mode.upper() == 'CLIP':
+    muniparcelnames = list()
+    for k in range(len(townnames_caps)):
+        muniname = townnames[k]
+        muninamecaps = townnames_caps[k]
+        print('Starting ' + muniname + ' Phosphorus load calculations')
+        print('Starting ' + muniname)
+        muniparcelnames.append(munipctile(loadparcels, townpolys, muniname, muninamecaps))
+    
+    arcpy.AddMessage("Completed all municipalities")
+        
+    ## Create an empty feature class with the desired schema
+    outfile = AutoName('Parcels_withnutrientpctiles')
+    arcpy.CopyFeatures_management(muniparcelnames[0], outfile)
+    arcpy.DeleteRows_management(outfile)    # Empty the output file
     
-arcpy.AddMessage("Completed all municipalities")
+    # Append all municipal files onto empty feature class with appropriate schema
+    arcpy.AddMessage("Re-merging municipalities")
+    arcpy.Append_management(muniparcelnames, outfile, schema_type = "TEST")
+    for k in range(len(muniparcelnames)):
+        arcpy.Delete_management(muniparcelnames[k])
     
-## Create an empty feature class with the desired schema
-outfile = AutoName('Parcels_withnutrientpctiles')
-arcpy.CopyFeatures_management(muniparcelnames[0], outfile)
-arcpy.DeleteRows_management(outfile)    # Empty the output file
-
-# Append all municipal files onto empty feature class with appropriate schema
-arcpy.AddMessage("Re-merging municipalities")
-arcpy.Append_management(muniparcelnames, outfile, schema_type = "TEST")
-for k in range(len(muniparcelnames)):
-    arcpy.Delete_management(muniparcelnames[k])
-
-
-# Repair geometry
-outtable = AutoName('geomtable')
-arcpy.AddMessage('Checking ' + outfile + ' geometry...')
-arcpy.CheckGeometry_management(outfile, outtable)
+    
+    # Repair geometry
+    ensure_valid_geometry(outfile)
 
+else:
+    # Rank every municipality in one pass over the attribute table
+    outfile = AutoName('Parcels_withnutrientpctiles')
+    grouppctile(loadparcels, outfile, groupfield, townnames)
+    arcpy.AddMessage("Completed all municipalities")
     
-#Repair geometry problems
-arcpy.AddMessage('Repairing ' + outfile + ' geometry...')
-arcpy.RepairGeometry_management(outfile)
-arcpy.Delete_management(outtable)
+    # Repair geometry
+    ensure_valid_geometry(outfile)
 
@@ -9,8 +9,16 @@ import arcpy
 from arcpy import env
 import numpy as np
 import os
+import tempfile
 
-mxd = arcpy.mapping.MapDocument("CURRENT")
+from parcel_io import read_shapes, write_columns, field_props, ensure_valid_geometry, valid_layer, layer_key, AttributeAccumulator
+from parcel_geometry import GeometryRegistry
+from parcel_loads import HSG_FIELDS, HSG_CLASSES, encode
+from parcel_overlay import ParcelOverlay, HAS_SHAPELY, from_wkb, area_factor, stack_layers, layer_index, join_mismatches
+from parcel_raster import zone_lookup, zonal_fraction, zonal_class_areas, sample_indices, error_summary, DEFAULT_SAMPLE_SIZE
+from spatial_cache import SpatialIndexCache, DEFAULT_BUDGET
+from parcel_parallel import run_tasks, DEFAULT_RETRIES
+from parcel_tiles import parcel_cost, tile_partition, tile_extents, tile_summary, DEFAULT_TILES_PER_PROCESS
 
 ''' 
 Set up workspace 
@@ -39,6 +47,106 @@ pastinspectpts = arcpy.GetParameterAsText(16)
 catchbasins = arcpy.GetParameterAsText(17)
 drainpipes = arcpy.GetParameterAsText(18)
 
+# The optional parameters 19-33 below are not defined in the BMP
+# Prioritization Toolbox; see README.md to set them.
+
+# Optional: how parcels are overlaid with the wetland, wellhead protection
+# area and soil layers. 'SHAPELY' (default when shapely 2 is installed, which
+# needs Python 3, i.e. ArcGIS Pro; see README.md) uses the exact overlay
+# engine in parcel_overlay.py; 'UNION' uses ArcGIS Union, Select and Spatial
+# Join for every layer and municipality; 'RASTER' is a fast approximation for
+# screening runs (see parcel_raster.py).
+overlay_engine = arcpy.GetParameterAsText(19).upper()
+if not overlay_engine: overlay_engine = 'SHAPELY' if HAS_SHAPELY else 'UNION'
+overlay_reduce = arcpy.GetParameterAsText(20).lower()   # 'max' (default): largest overlap with
+if not overlay_reduce: overlay_reduce = 'max'            # any one polygon, as with 'UNION'; 'sum': total overlap
+
+# Optional: a single soil layer classified by a hydrologic soil group field,
+# used instead of the six soil layers above with the 'SHAPELY' engine.
+# Groups other than A, B, C, C/D and D are counted as unclassified (UNC).
+soils = arcpy.GetParameterAsText(21)
+soils_hsgfield = arcpy.GetParameterAsText(22)
+if not soils_hsgfield: soils_hsgfield = 'HYDROLGRP'
+
+# Optional: folder in which the spatial indexes of the reference layers are
+# kept between runs (keyed by the state of each layer, see
+# parcel_io.layer_key), for the 'SHAPELY' engine. Unchanged layers then load
+# their index from disk. Its disk budget, in MB, is parameter 33 below.
+index_cache = arcpy.GetParameterAsText(23)
+
+# Optional settings of the 'RASTER' engine: the cell size of the common grid
+# (map units), and the number of parcels per municipality on which the
+# approximation is compared with the exact overlay (0: no comparison).
+raster_cellsize = arcpy.GetParameterAsText(24)
+raster_cellsize = float(raster_cellsize) if raster_cellsize else 5.0
+raster_sample = arcpy.GetParameterAsText(25)
+raster_sample = int(raster_sample) if raster_sample else DEFAULT_SAMPLE_SIZE
+
+# Optional: number of worker processes the municipalities are spread over
+# (1, the default, runs them one after the other), and the number of times a
+# municipality that fails is run again.
+processes = arcpy.GetParameterAsText(26)
+processes = int(processes) if processes else 1
+retries = arcpy.GetParameterAsText(27)
+retries = int(retries) if retries else DEFAULT_RETRIES
+
+# Optional: how the parcels are split into pieces of work. 'MUNICIPALITY'
+# (default) runs every municipality separately; 'TILES' splits the parcels
+# into "tile_count" compact tiles of about equal cost (see parcel_tiles.py),
+# whose reference layers are limited to the tile extent plus "tile_margin"
+# map units. Parcels keep their municipality either way.
+partition = arcpy.GetParameterAsText(28).upper()
+if not partition: partition = 'MUNICIPALITY'
+tile_count = arcpy.GetParameterAsText(29)
+tile_count = int(tile_count) if tile_count else DEFAULT_TILES_PER_PROCESS*processes
+tile_margin = arcpy.GetParameterAsText(30)
+tile_margin = float(tile_margin) if tile_margin else 100.0
+
+# Point and line layers are joined to parcels with the bulk feature join in
+# parcel_overlay.py whenever shapely is available, except with 'UNION'.
+bulk_join = HAS_SHAPELY and overlay_engine != 'UNION'
+
+# Input layers, and the tool settings passed on to worker processes
+LAYER_PARAMETERS = ['parcels', 'townpolys', 'watershedpolys', 'auls',
+                    'soilsA', 'soilsB', 'soilsC', 'soilsCD', 'soilsD', 'soilsUNC',
+                    'wetlands', 'wpas_other', 'z2wpas', 'aqrecharge',
+                    'muniownedpts', 'pastinspectpts', 'catchbasins', 'drainpipes', 'soils']
+SETTINGS = LAYER_PARAMETERS + ['overlay_engine', 'overlay_reduce', 'soils_hsgfield', 'index_cache',
+                               'raster_cellsize', 'raster_sample', 'bulk_join', 'join_sample', 'repaired_layers',
+                               'partition', 'geometry_registry', 'index_budget', 'layer_keys']
+
+# Optional: JSON file recording the layers whose geometry has been checked
+# (see parcel_geometry.py), so that unchanged input layers are not checked
+# and repaired again in later runs. Defaults to a file in the index cache
+# folder, if there is one. It is read by prepare_shared_layers, in the main
+# process only.
+geometry_registry = arcpy.GetParameterAsText(31)
+if not geometry_registry and index_cache: geometry_registry = os.path.join(index_cache, 'geometry_registry.json')
+
+# Optional: number of parcels per municipality on which the bulk feature join
+# is compared with ArcGIS Spatial Join (0, the default: no comparison)
+join_sample = arcpy.GetParameterAsText(32)
+join_sample = int(join_sample) if join_sample else 0
+
+# Optional: disk budget of the spatial index folder, in MB
+index_budget = arcpy.GetParameterAsText(33)
+index_budget = float(index_budget) if index_budget else DEFAULT_BUDGET
+
+# Field of the scratch copy of the parcels holding the tile of every parcel
+# (see assign_tiles)
+TILE_FIELD = 'tile_id'
+
+# Join layers whose geometry has already been checked and repaired (see
+# prepare_shared_layers); join_spatiallyrs skips them
+repaired_layers = set()
+
+# Scratch copies of input layers whose geometry had to be repaired
+layer_copies = list()
+
+# Keys of the input layers for the spatial index cache (see
+# parcel_io.layer_key), by the layer read: the input or its repaired copy
+layer_keys = dict()
+
 ''' Define Useful Functions'''
 
 def join_spatiallyrs(lyr1, lyr2, outlyr, joinfield = '', newname = '', newalias = '', method = 'INTERSECT'):
@@ -57,19 +165,10 @@ def join_spatiallyrs(lyr1, lyr2, outlyr, joinfield = '', newname = '', newalias
         to find the index of a table's fields from the field name '''
         return [i.name for i in arcpy.ListFields(table)].index(fieldname)
     
-    # Repair geometry of both input feature classes
-    # Check for geometry problems
-    outtable = AutoName('geomtable')
-    arcpy.AddMessage('Checking ' + lyr1 + ' geometry...')
-    print('Checking ' + lyr1 + ' geometry...')
-    arcpy.CheckGeometry_management(lyr1, outtable)
-    
-    #Repair geometry problems
-    arcpy.AddMessage('Repairing ' + lyr1 + ' geometry...')
-    print('Repairing ' + lyr1 + ' geometry...')
-    arcpy.RepairGeometry_management(lyr1)
-    
-    arcpy.Delete_management(outtable)
+    # Repair geometry of the joining layer, unless it is an input layer
+    # already repaired by prepare_shared_layers
+    if lyr1 not in repaired_layers:
+        ensure_valid_geometry(lyr1)
     
     # Initiate a fieldmap object
     arcpy.AddMessage('Checking field maps')
@@ -148,6 +247,249 @@ def join_attrblyrs(inlyr, targetlyr, joinfield, keepfields):
     
     return() 
     
+# Reference layers read by overlayatts, by layer and spatial reference, as
+# (geometries, spatial index or None)
+reflayers = dict()
+
+# Outline (polygon) of the tile being run by tile_addatts, or None. Reference
+# layers are then only read within the tile, and only kept for that tile.
+tile_outline = None
+
+def reffeatures(attlyr, fields, sr):
+    # Rows of "fields" of the features of "attlyr" projected to "sr", in one
+    # SearchCursor pass; only the features that intersect tile_outline when
+    # a tile is being run
+    if tile_outline is None:
+        return([row for row in arcpy.da.SearchCursor(attlyr, fields, None, sr)])
+    tilelyr = AutoName('tilefeatures')
+    arcpy.MakeFeatureLayer_management(attlyr, tilelyr)
+    arcpy.SelectLayerByLocation_management(tilelyr, 'INTERSECT', tile_outline)
+    rows = [row for row in arcpy.da.SearchCursor(tilelyr, fields, None, sr)]
+    arcpy.Delete_management(tilelyr)
+    return(rows)
+
+def cachedlayer(wkbs, layers, sr):
+    # Geometries of a reference layer and, when an index cache folder is
+    # set, its packed R-tree from the cache, keyed by the state of the input
+    # "layers" it is read from and by the spatial reference "sr". The
+    # features within a tile are not worth caching.
+    geoms = from_wkb(wkbs)
+    if not index_cache or tile_outline is not None:
+        return(geoms, None)
+    key = [layer_keys.get(lyr) or layer_key(lyr) for lyr in layers] + [sr.exportToString()]
+    return(geoms, layer_index(SpatialIndexCache(index_cache, budget = index_budget), key, geoms))
+
+def reflayer(attlyr, sr):
+    ''' Geometries of reference layer "attlyr" projected to "sr", and their
+    cached spatial index. Every layer is read once and kept for the
+    following municipalities (see reffeatures for tiles). '''
+    key = (attlyr, sr.name)
+    if key not in reflayers:
+        reflayers[key] = cachedlayer([row[0] for row in reffeatures(attlyr, ['SHAPE@WKB'], sr)], [attlyr], sr)
+    return(reflayers[key])
+
+def soillayer(sr):
+    ''' Soil geometries projected to "sr", their cached spatial index and
+    the position of their hydrologic soil group in HSG_CLASSES, from either
+    the single classified "soils" layer or the six soil layers (one per
+    group). '''
+    key = ('soils', sr.name)
+    if key not in reflayers:
+        if soils:
+            rows = reffeatures(soils, ['SHAPE@WKB', soils_hsgfield], sr)
+            groups = [(row[1] or '').strip().upper() for row in rows]
+            classes = encode(np.array(groups, dtype = object), HSG_CLASSES)
+            classes[classes < 0] = HSG_CLASSES.index('UNC')
+            wkbs = [row[0] for row in rows]
+            layers = [soils]
+        else:
+            layers = [soilsA, soilsB, soilsC, soilsCD, soilsD, soilsUNC]
+            stacked = [[row[0] for row in reffeatures(layer, ['SHAPE@WKB'], sr)] for layer in layers]
+            classes = stack_layers(stacked)[1]
+            wkbs = [wkb for layer in stacked for wkb in layer]
+        (geoms, index) = cachedlayer(wkbs, layers, sr)
+        reflayers[key] = (geoms, index, classes)
+    return(reflayers[key])
+
+def overlayatts(clippedparcels, fractionlayers, arealayers, how = 'max', soilfields = HSG_FIELDS, attributes = None):
+    ''' Adds overlap attributes to "clippedparcels" with the exact overlay
+    engine: the fraction of each parcel covered by every layer in
+    "fractionlayers", the area (acres) covered by every layer in
+    "arealayers", both lists of (layer, new field name), and the area
+    (acres) of every hydrologic soil group in "soilfields". Parcels are read
+    and indexed once and all fields are written in one pass, or added to
+    the AttributeAccumulator "attributes" when given. '''
+    sr = arcpy.Describe(clippedparcels).spatialReference
+    overlay = ParcelOverlay(from_wkb(read_shapes(clippedparcels)))
+
+    columns = dict()
+    columns['AREA_parcel'] = overlay.areas*area_factor(sr.metersPerUnit, 'SQUAREFEET')
+    for (attlyr, newname) in fractionlayers:
+        arcpy.AddMessage('Overlaying ' + os.path.basename(os.path.normpath(attlyr)) + ' with ' + clippedparcels + '...')
+        (geoms, index) = reflayer(attlyr, sr)
+        columns[newname] = overlay.overlap_fraction(geoms, how, index)
+    for (attlyr, newname) in arealayers:
+        arcpy.AddMessage('Overlaying ' + os.path.basename(os.path.normpath(attlyr)) + ' with ' + clippedparcels + '...')
+        (geoms, index) = reflayer(attlyr, sr)
+        columns[newname] = overlay.overlap_area(geoms, how, index)*area_factor(sr.metersPerUnit, 'ACRES')
+    if soilfields:
+        # All soil groups in one traversal of the parcel index
+        arcpy.AddMessage('Overlaying soils with ' + clippedparcels + '...')
+        (geoms, index, classes) = soillayer(sr)
+        areas = overlay.class_areas(geoms, classes, len(HSG_CLASSES), how, index)*area_factor(sr.metersPerUnit, 'ACRES')
+        for k in range(len(soilfields)):
+            columns[soilfields[k]] = areas[:, k]
+
+    if attributes is not None:
+        attributes.add_columns(columns)
+    else:
+        write_columns(clippedparcels, columns)
+
+    return(clippedparcels)
+
+def featureatts(clippedparcels, joins, how = 'max', attributes = None):
+    ''' Joins attributes of point and line layers to "clippedparcels" in one
+    pass: "joins" is a list of (layer, join field, new field name, ArcGIS
+    match option); layers left blank are skipped. Every new field holds the
+    largest value of the features matching the parcel ('maximum' merge rule
+    of join_spatiallyrs), or null. Layers are read once and kept for the
+    following municipalities. The new fields are added to the
+    AttributeAccumulator "attributes" when given. '''
+    joins = [join for join in joins if join[0]]
+    if not joins:
+        return(clippedparcels)
+
+    sr = arcpy.Describe(clippedparcels).spatialReference
+    overlay = ParcelOverlay(from_wkb(read_shapes(clippedparcels)))
+
+    columns = dict()
+    fieldtypes = dict()
+    for (attlyr, joinfield, newname, method) in joins:
+        arcpy.AddMessage('Adding ' + os.path.basename(os.path.normpath(attlyr)) + ' attributes to ' + clippedparcels + '...')
+        key = (attlyr, joinfield, sr.name)
+        if key not in reflayers:
+            rows = reffeatures(attlyr, ['SHAPE@WKB', joinfield], sr)
+            values = np.empty(len(rows), dtype = object)
+            values[:] = [row[1] for row in rows]
+            reflayers[key] = (from_wkb([row[0] for row in rows]), values)
+        (geoms, values) = reflayers[key]
+        columns[newname] = overlay.join_features(geoms, values, how, method)
+        fieldtypes[newname] = field_props(attlyr, joinfield)
+
+    # Agreement of the bulk join with ArcGIS Spatial Join on a sample of
+    # parcels
+    if join_sample > 0:
+        (ids, rows) = featureids(clippedparcels)
+        sample = sample_indices(len(ids), join_sample)
+        oidfield = arcpy.AddFieldDelimiters(clippedparcels, arcpy.Describe(clippedparcels).OIDFieldName)
+        samplelyr = AutoName('joinsample')
+        arcpy.MakeFeatureLayer_management(clippedparcels, samplelyr, oidfield + ' IN (' + ', '.join(str(ids[k]) for k in sample) + ')')
+        for (attlyr, joinfield, newname, method) in joins:
+            checklyr = AutoName('joincheck')
+            join_spatiallyrs(attlyr, samplelyr, checklyr, joinfield, newname, '', method)
+            reference = dict(row for row in arcpy.da.SearchCursor(checklyr, ['TARGET_FID', newname]))
+            mismatches = join_mismatches(columns[newname][sample], [reference.get(ids[k]) for k in sample])
+            arcpy.AddMessage(newname + ': bulk join differs from Spatial Join on ' + str(len(mismatches)) + ' of ' + str(len(sample)) + ' parcels')
+            arcpy.Delete_management(checklyr)
+        arcpy.Delete_management(samplelyr)
+
+    if attributes is not None:
+        attributes.add_columns(columns, fieldtypes)
+    else:
+        write_columns(clippedparcels, columns, fieldtypes)
+
+    return(clippedparcels)
+
+def rastergrid(fc, valuefield, grid):
+    # Rasterizes "fc" by "valuefield" onto the grid of raster "grid" and
+    # returns the cells as an array (-1 where there is no feature)
+    outname = AutoName('overlaygrid')
+    arcpy.PolygonToRaster_conversion(fc, valuefield, outname, 'CELL_CENTER', '', raster_cellsize)
+    griddesc = arcpy.Describe(grid)
+    cells = arcpy.RasterToNumPyArray(outname, arcpy.Point(griddesc.extent.XMin, griddesc.extent.YMin), griddesc.width, griddesc.height, nodata_to_value = -1)
+    arcpy.Delete_management(outname)
+    return(cells)
+
+def featureids(fc, fields = []):
+    # Object IDs (and "fields") of every feature of "fc", in cursor order
+    rows = [row for row in arcpy.da.SearchCursor(fc, [arcpy.Describe(fc).OIDFieldName] + fields)]
+    return(np.array([row[0] for row in rows]), rows)
+
+def rasteratts(clippedparcels, fractionlayers, arealayers, soilfields = HSG_FIELDS, attributes = None):
+    ''' Approximate version of overlayatts ('RASTER' engine): parcels and
+    reference layers are rasterized onto a common grid of "raster_cellsize"
+    cells and overlaps are counted per parcel. The approximation is compared
+    with the exact overlay on a sample of parcels when shapely is
+    available. '''
+    desc = arcpy.Describe(clippedparcels)
+    sr = desc.spatialReference
+    (ids, rows) = featureids(clippedparcels, ['SHAPE@AREA'])
+    nparcels = len(ids)
+    sqft = area_factor(sr.metersPerUnit, 'SQUAREFEET')
+    acres = area_factor(sr.metersPerUnit, 'ACRES')
+
+    # Common grid covering the municipality's parcels
+    envsettings = (arcpy.env.extent, arcpy.env.snapRaster, arcpy.env.outputCoordinateSystem)
+    arcpy.env.extent = desc.extent
+    arcpy.env.outputCoordinateSystem = sr
+    parcelgrid = AutoName('parcelgrid')
+    arcpy.PolygonToRaster_conversion(clippedparcels, desc.OIDFieldName, parcelgrid, 'CELL_CENTER', '', raster_cellsize)
+    arcpy.env.snapRaster = parcelgrid
+    zones = zone_lookup(arcpy.RasterToNumPyArray(parcelgrid, nodata_to_value = -1), ids)
+
+    columns = dict()
+    columns['AREA_parcel'] = np.array([row[1] for row in rows], dtype = float)*sqft
+    for (attlyr, newname) in fractionlayers:
+        arcpy.AddMessage('Counting ' + os.path.basename(os.path.normpath(attlyr)) + ' cells in ' + clippedparcels + '...')
+        covered = rastergrid(attlyr, arcpy.Describe(attlyr).OIDFieldName, parcelgrid) >= 0
+        columns[newname] = zonal_fraction(zones, covered, nparcels)
+    for (attlyr, newname) in arealayers:
+        arcpy.AddMessage('Counting ' + os.path.basename(os.path.normpath(attlyr)) + ' cells in ' + clippedparcels + '...')
+        covered = rastergrid(attlyr, arcpy.Describe(attlyr).OIDFieldName, parcelgrid) >= 0
+        columns[newname] = zonal_class_areas(zones, covered.astype(np.int64) - 1, nparcels, 1, raster_cellsize**2)[:, 0]*acres
+    if soilfields:
+        arcpy.AddMessage('Counting soil cells in ' + clippedparcels + '...')
+        if soils:
+            (soilids, soilrows) = featureids(soils, [soils_hsgfield])
+            soilclasses = encode(np.array([(row[1] or '').strip().upper() for row in soilrows], dtype = object), HSG_CLASSES)
+            soilclasses[soilclasses < 0] = HSG_CLASSES.index('UNC')
+            pos = zone_lookup(rastergrid(soils, arcpy.Describe(soils).OIDFieldName, parcelgrid), soilids)
+            classes = np.where(pos >= 0, soilclasses[pos], -1)
+        else:
+            classes = np.full(zones.shape, -1, dtype = np.int64)
+            for (k, layer) in enumerate([soilsA, soilsB, soilsC, soilsCD, soilsD, soilsUNC]):
+                classes[rastergrid(layer, arcpy.Describe(layer).OIDFieldName, parcelgrid) >= 0] = k
+        areas = zonal_class_areas(zones, classes, nparcels, len(HSG_CLASSES), raster_cellsize**2)*acres
+        for k in range(len(soilfields)):
+            columns[soilfields[k]] = areas[:, k]
+
+    arcpy.Delete_management(parcelgrid)
+    (arcpy.env.extent, arcpy.env.snapRaster, arcpy.env.outputCoordinateSystem) = envsettings
+
+    # Error of the approximation on a sample of parcels, against the exact
+    # total overlap
+    if raster_sample > 0 and HAS_SHAPELY:
+        sample = sample_indices(nparcels, raster_sample)
+        wkbs = read_shapes(clippedparcels)
+        overlay = ParcelOverlay(from_wkb([wkbs[k] for k in sample]))
+        for (attlyr, newname) in fractionlayers:
+            (geoms, index) = reflayer(attlyr, sr)
+            error = error_summary(columns[newname][sample], overlay.overlap_fraction(geoms, 'sum', index))
+            arcpy.AddMessage(newname + ' error on ' + str(error['n']) + ' parcels: mean ' + str(round(error['mean'], 4)) + ', 95th percentile ' + str(round(error['p95'], 4)) + ', max ' + str(round(error['max'], 4)))
+        if soilfields:
+            (geoms, index, classes) = soillayer(sr)
+            exact = overlay.class_areas(geoms, classes, len(HSG_CLASSES), 'sum', index)*acres
+            for k in range(len(soilfields)):
+                error = error_summary(columns[soilfields[k]][sample], exact[:, k])
+                arcpy.AddMessage(soilfields[k] + ' error (acres) on ' + str(error['n']) + ' parcels: mean ' + str(round(error['mean'], 4)) + ', 95th percentile ' + str(round(error['p95'], 4)) + ', max ' + str(round(error['max'], 4)))
+
+    if attributes is not None:
+        attributes.add_columns(columns)
+    else:
+        write_columns(clippedparcels, columns)
+
+    return(clippedparcels)
+
 def AutoName(table): 
     # function that automatically names a feature class or raster
     # Adapted from MAPC's stormwater toolkit script at https://github.com/MAPC/stormwater-toolkit/blob/master/Burn_Raster_Script.py
@@ -163,6 +505,97 @@ def AutoName(table):
 
     return newname
 
+def add_area_field(attlyr):
+    # Adds the area of every polygon of a reference layer (square feet) as
+    # AREA_<layer name>, unless the layer already has it
+    areafield = 'AREA_' + os.path.basename(os.path.normpath(attlyr))
+    if areafield in [f.name for f in arcpy.ListFields(attlyr)]:
+        return(areafield)
+    arcpy.AddField_management(attlyr, areafield, 'DOUBLE')
+    arcpy.CalculateField_management(attlyr, areafield, "float(!SHAPE.AREA@SQUAREFEET!)", "PYTHON_9.3")
+    return(areafield)
+
+def prepare_shared_layers():
+    ''' Makes the changes muni_addatts would otherwise make to the shared
+    input layers for every municipality once, before any municipality is
+    run, so that no two workers write to the same layer: the geometry of
+    every input layer is checked (unless the registry shows it unchanged
+    since it was found valid) and a layer with invalid features is replaced
+    by a repaired scratch copy, leaving the input as it is, and the 'UNION'
+    overlap layers get their polygon areas. With a spatial index folder,
+    the key of every input layer is kept for its indexes (see cachedlayer),
+    and the folder is tidied up before any worker uses it. '''
+    registry = GeometryRegistry(geometry_registry or None)
+    validated = dict()
+    for name in LAYER_PARAMETERS:
+        lyr = globals()[name]
+        if lyr and lyr not in repaired_layers:
+            if lyr not in validated:
+                validated[lyr] = valid_layer(lyr, registry)
+                if validated[lyr] != lyr:
+                    layer_copies.append(validated[lyr])
+                if index_cache:
+                    layer_keys[validated[lyr]] = layer_key(lyr)
+            globals()[name] = validated[lyr]
+            repaired_layers.add(validated[lyr])
+    if overlay_engine not in ['SHAPELY', 'RASTER']:
+        for lyr in [wetlands, z2wpas, wpas_other]:
+            add_area_field(lyr)
+    if index_cache:
+        SpatialIndexCache(index_cache, budget = index_budget).sweep()
+
+def assign_tiles(inparcels, ntiles, margin):
+    ''' Splits "inparcels" into at most "ntiles" tiles of about equal cost by
+    parcel centroid, and stores the tile of every parcel in TILE_FIELD of a
+    scratch copy of the parcels ("inparcels" is left unchanged). Returns the
+    path of the copy and the extent of every tile plus "margin". '''
+    tileparcels = arcpy.CreateScratchName('tileparcels', '', 'FeatureClass', arcpy.env.scratchGDB)
+    arcpy.CopyFeatures_management(inparcels, tileparcels)
+    rows = [(g.trueCentroid.X, g.trueCentroid.Y, g.pointCount, g.extent.XMin, g.extent.YMin, g.extent.XMax, g.extent.YMax) if g is not None else (np.nan,)*7
+            for (g,) in arcpy.da.SearchCursor(tileparcels, ['SHAPE@'])]
+    values = np.array(rows, dtype = float).reshape(-1, 7)
+    cost = parcel_cost(np.nan_to_num(values[:, 2]))
+    tiles = tile_partition(values[:, 0], values[:, 1], cost, ntiles)
+    (counts, costs, imbalance) = tile_summary(tiles, cost)
+    arcpy.AddMessage('Split ' + str(len(tiles)) + ' parcels into ' + str(len(counts)) + ' tiles (largest tile cost ' + str(round(imbalance, 2)) + ' x mean)')
+    write_columns(tileparcels, [(TILE_FIELD, tiles.astype(float))], {TILE_FIELD: ('LONG', None)})
+    return(tileparcels, tile_extents(values[:, 3:], tiles, margin))
+
+def tile_addatts(inparcels, tile, extent):
+    ''' Adds the attributes of muni_addatts to the parcels of one tile (see
+    assign_tiles). Geoprocessing tools and the reference layers read by the
+    'SHAPELY' engine and the bulk feature join only use the features within
+    the tile "extent". '''
+    global tile_outline
+    (xmin, ymin, xmax, ymax) = extent
+    corners = [(xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)]
+    envextent = arcpy.env.extent
+    arcpy.env.extent = arcpy.Extent(*extent)
+    tile_outline = arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for (x, y) in corners]), arcpy.Describe(inparcels).spatialReference)
+    reflayers.clear()
+    try:
+        return(parcel_addatts(inparcels, 'Tile' + str(tile), TILE_FIELD + ' = ' + str(tile)))
+    finally:
+        arcpy.env.extent = envextent
+        tile_outline = None
+        reflayers.clear()
+
+def scratch_addatts(scratchfolder, partname, function, args):
+    ''' Runs the function named "function" (muni_addatts or tile_addatts) on
+    "args" in a file geodatabase of its own in "scratchfolder", so that the
+    intermediate files of municipalities or tiles run at the same time cannot
+    collide. Returns the full path of the resulting parcels. '''
+    gdbname = 'scratch_' + arcpy.ValidateTableName(partname) + '.gdb'
+    gdb = os.path.join(scratchfolder, gdbname)
+    if arcpy.Exists(gdb):
+        # Left over from a failed attempt
+        arcpy.Delete_management(gdb)
+    arcpy.CreateFileGDB_management(scratchfolder, gdbname)
+    arcpy.env.workspace = gdb
+    arcpy.env.scratchWorkspace = gdb
+    
+    return(os.path.join(gdb, globals()[function](*args)))
+
 def unique_values(table, field):
     # Function from http://geospatialtraining.com/get-a-list-of-unique-attribute-values-using-arcpy/
     with arcpy.da.SearchCursor(table, [field]) as cursor:
@@ -182,7 +615,10 @@ def join_table_shapefile(table, tablefield, shapefile, shapefield, outputname):
 
     return(outputname)
     
-def muni_addatts(inparcels, townpolys, muniname, muniname_caps):
+def parcel_addatts(inparcels, muniname, where, munioutline = None):
+    ''' Adds every attribute to the parcels of "inparcels" selected by
+    "where" (a municipality or a tile, named "muniname"), in a new feature
+    class whose name is returned. '''
     
     def addatt(clippedparcels, attlyr, muniname, joinfield, newname, newalias, method='INTERSECT'):
         # Get name of feature being added to parcels
@@ -203,15 +639,13 @@ def muni_addatts(inparcels, townpolys, muniname, muniname_caps):
         
         attname = os.path.basename(os.path.normpath(attlyr))
         clippedparcelname = os.path.basename(os.path.normpath(clippedparcels))
-        areafield_attlyr = 'AREA_' + attname
         arcpy.AddField_management(clippedparcels, 'AREA_parcel', 'DOUBLE')
-        arcpy.AddField_management(attlyr, areafield_attlyr, 'DOUBLE')
         
         # Calculate area in square feet
         # AREA_parcel: Area of each parcel.
         arcpy.CalculateField_management(clippedparcels, 'AREA_parcel', exp, "PYTHON_9.3")
-        # areafield_attlyr: Area of each polygon with which to calculate overlap.
-        arcpy.CalculateField_management(attlyr, areafield_attlyr, exp, "PYTHON_9.3")
+        # AREA_<layer>: Area of each polygon with which to calculate overlap.
+        add_area_field(attlyr)
         
         # Take union- will retain info of each unioned piece. 
         unionname = 'sites_union_' + attname
@@ -267,55 +701,77 @@ def muni_addatts(inparcels, townpolys, muniname, muniname_caps):
         
         return(newlayer)
     
-    # Create clip boundary
-    munioutline = AutoName(muniname + '_outline')
-    arcpy.Select_analysis(townpolys, munioutline, "town = '" + muniname_caps + "'")
     # Create a new file of parcels clipped to muni outline
     parcelmuniname = AutoName('clipparcels' + muniname)
     arcpy.AddMessage('Clipping parcels to ' + muniname + ' outline')
     print('Selecting parcels in ' + muniname)
-    arcpy.Select_analysis(inparcels, parcelmuniname, "muni = '" + muniname + "'")     # ORIGINALLY USE "parcels" the global name, not "inparcels", the passed fuction argument.
-    
-    ''' Clip each input layer to the municipal outline, join to municipal parcels, and export as new file. '''
-    # Add wetlands
-    parcelswetlands = overlapatt(parcelmuniname, munioutline, wetlands, muniname, newname = 'wetland_p', newalias = 'Fraction wetland')
+    arcpy.Select_analysis(inparcels, parcelmuniname, where)     # ORIGINALLY USE "parcels" the global name, not "inparcels", the passed fuction argument.
     
-    # Add soils
-    parcelssoilsA = areaatt(parcelmuniname, munioutline, soilsA, muniname, newname = 'hsgA_ac', newalias = 'Area A Soils')
-    
-    parcelssoilsB = areaatt(parcelmuniname, munioutline, soilsB, muniname, newname = 'hsgB_ac', newalias = 'Area B Soils')
-    
-    parcelssoilsC = areaatt(parcelmuniname, munioutline, soilsB, muniname, newname = 'hsgC_ac', newalias = 'Area C Soils')
-    
-    parcelssoilsCD = areaatt(parcelmuniname, munioutline, soilsCD, muniname, newname = 'hsgCD_ac', newalias = 'Area C/D Soils')
-    
-    parcelssoilsD = areaatt(parcelmuniname, munioutline, soilsD, muniname, newname = 'hsgD_ac', newalias = 'Area D Soils')
+    # New attribute columns, collected by MAPC assigned ID and written to
+    # the parcels once at the end
+    commonid = 'mapc_id'
+    attributes = AttributeAccumulator(parcelmuniname, commonid)
     
-    parcelssoilsUNC = areaatt(parcelmuniname, munioutline, soilsUNC, muniname, newname = 'hsgUNC_ac', newalias = 'Area UNC Soils')
+    ''' Clip each input layer to the municipal outline, join to municipal parcels, and export as new file. '''
+    # Add wetlands, soils and wellhead protection areas
+    if overlay_engine == 'SHAPELY':
+        overlayatts(parcelmuniname,
+                    fractionlayers = [(wetlands, 'wetland_p'), (z2wpas, 'zii_p'), (wpas_other, 'z1i_p')],
+                    arealayers = [],
+                    how = overlay_reduce,
+                    attributes = attributes)
+    elif overlay_engine == 'RASTER':
+        rasteratts(parcelmuniname,
+                   fractionlayers = [(wetlands, 'wetland_p'), (z2wpas, 'zii_p'), (wpas_other, 'z1i_p')],
+                   arealayers = [],
+                   attributes = attributes)
+    else:
+        parcelswetlands = overlapatt(parcelmuniname, munioutline, wetlands, muniname, newname = 'wetland_p', newalias = 'Fraction wetland')
+        
+        # Add soils
+        parcelssoilsA = areaatt(parcelmuniname, munioutline, soilsA, muniname, newname = 'hsgA_ac', newalias = 'Area A Soils')
+        
+        parcelssoilsB = areaatt(parcelmuniname, munioutline, soilsB, muniname, newname = 'hsgB_ac', newalias = 'Area B Soils')
+        
+        parcelssoilsC = areaatt(parcelmuniname, munioutline, soilsC, muniname, newname = 'hsgC_ac', newalias = 'Area C Soils')
+        
+        parcelssoilsCD = areaatt(parcelmuniname, munioutline, soilsCD, muniname, newname = 'hsgCD_ac', newalias = 'Area C/D Soils')
+        
+        parcelssoilsD = areaatt(parcelmuniname, munioutline, soilsD, muniname, newname = 'hsgD_ac', newalias = 'Area D Soils')
+        
+        parcelssoilsUNC = areaatt(parcelmuniname, munioutline, soilsUNC, muniname, newname = 'hsgUNC_ac', newalias = 'Area UNC Soils')
+        
+        # Add Zone 2 WPAs
+        parcelswpa2 = overlapatt(parcelmuniname, munioutline, z2wpas, muniname, newname = 'zii_p', newalias = 'Fraction Zone II Wellhead Protection Area')
+        
+        parcelswpa1i = overlapatt(parcelmuniname, munioutline, wpas_other, muniname, newname = 'z1i_p', newalias = 'Fraction Zone 1 Wellhead Protection Area')
     
     # Add AUL sites
     parcelsauls = addatt(parcelmuniname, auls, muniname, joinfield = 'site_info', newname = 'aulsite', newalias = 'AUL Information')
     
-    # Add Zone 2 WPAs
-    parcelswpa2 = overlapatt(parcelmuniname, munioutline, z2wpas, muniname, newname = 'zii_p', newalias = 'Fraction Zone II Wellhead Protection Area')
-    
-    parcelswpa1i = overlapatt(parcelmuniname, munioutline, wpas_other, muniname, newname = 'z1i_p', newalias = 'Fraction Zone 1 Wellhead Protection Area')
-    
     # Add watershed name
     parcelswshed = addatt(parcelmuniname, watershedpolys, muniname, joinfield = 'name', newname = 'watershed', newalias = 'Major Watershed', method='HAVE_THEIR_CENTER_IN')
     
     ''' Open optional inputs '''
-    # Add municipal ownership status
-    if muniownedpts: parcelsmunicipal = addatt(parcelmuniname, muniownedpts, muniname, joinfield = 'OWNER1', newname = 'owner', newalias = 'Municipal Owner', method = 'HAVE_THEIR_CENTER_IN')
-    
-    # Add catch basin presence/absence
-    if catchbasins: parcelscbs = addatt(parcelmuniname, catchbasins, muniname, joinfield = 'Facility_I', newname = 'cbid', newalias = 'Catch Basin ID')
-
-    # Add catch basin presence/absence
-    if drainpipes: parcelsdps = addatt(parcelmuniname, drainpipes, muniname, joinfield = 'Feature_ID', newname = 'dpid', newalias = 'Drain Pipe ID')   
+    if bulk_join:
+        # Join the ownership, catch basin, drain pipe and inspection layers in one pass
+        featureatts(parcelmuniname, [(muniownedpts, 'OWNER1', 'owner', 'HAVE_THEIR_CENTER_IN'),
+                                     (catchbasins, 'Facility_I', 'cbid', 'INTERSECT'),
+                                     (drainpipes, 'Feature_ID', 'dpid', 'INTERSECT'),
+                                     (pastinspectpts, 'Date', 'visityear', 'INTERSECT')],
+                    attributes = attributes)
+    else:
+        # Add municipal ownership status
+        if muniownedpts: parcelsmunicipal = addatt(parcelmuniname, muniownedpts, muniname, joinfield = 'OWNER1', newname = 'owner', newalias = 'Municipal Owner', method = 'HAVE_THEIR_CENTER_IN')
+        
+        # Add catch basin presence/absence
+        if catchbasins: parcelscbs = addatt(parcelmuniname, catchbasins, muniname, joinfield = 'Facility_I', newname = 'cbid', newalias = 'Catch Basin ID')
     
-    # Add field inspection status
-    if pastinspectpts: parcelspastinspect = addatt(parcelmuniname, pastinspectpts, muniname, joinfield = 'Date', newname = 'visityear', newalias = 'Year Inspected')
+        # Add catch basin presence/absence
+        if drainpipes: parcelsdps = addatt(parcelmuniname, drainpipes, muniname, joinfield = 'Feature_ID', newname = 'dpid', newalias = 'Drain Pipe ID')   
+        
+        # Add field inspection status
+        if pastinspectpts: parcelspastinspect = addatt(parcelmuniname, pastinspectpts, muniname, joinfield = 'Date', newname = 'visityear', newalias = 'Year Inspected')
     
     # Add potential recharge depth
     if aqrecharge: parcelsrecharge = addatt(parcelmuniname, aqrecharge, muniname, joinfield = 'Ann_Rch_Depth', newname = 'rech_depth', newalias = 'Annual Recharge Depth (Units)')
@@ -323,96 +779,141 @@ def muni_addatts(inparcels, townpolys, muniname, muniname_caps):
     ''' Combine municipal parcels, each of which has one of the desired attributes, into a single feature class with all attributes.'''
     # Join together based on MAPC assigned ID
     arcpy.AddMessage('Joining in each attribute to parcels based on MAPC parcel ID...')
-    commonid = 'mapc_id'
-    join_attrblyrs(parcelswetlands, parcelmuniname, commonid, 'wetland_p')
-    join_attrblyrs(parcelssoilsA, parcelmuniname, commonid, 'hsgA_ac')
-    join_attrblyrs(parcelssoilsB, parcelmuniname, commonid, 'hsgB_ac')
-    join_attrblyrs(parcelssoilsC, parcelmuniname, commonid, 'hsgC_ac')
-    join_attrblyrs(parcelssoilsCD, parcelmuniname, commonid, 'hsgCD_ac')
-    join_attrblyrs(parcelssoilsD, parcelmuniname, commonid, 'hsgD_ac')
-    join_attrblyrs(parcelssoilsUNC, parcelmuniname, commonid, 'hsgUNC_ac')
-    join_attrblyrs(parcelsauls, parcelmuniname, commonid, 'aulsite')
-    join_attrblyrs(parcelswpa2, parcelmuniname, commonid, 'zii_p')
-    join_attrblyrs(parcelswpa1i, parcelmuniname, commonid, 'z1i_p')
-    join_attrblyrs(parcelswshed, parcelmuniname, commonid, 'watershed')
+    if overlay_engine not in ['SHAPELY', 'RASTER']:
+        attributes.add_table(parcelswetlands, ['wetland_p'])
+        attributes.add_table(parcelssoilsA, ['hsgA_ac'])
+        attributes.add_table(parcelssoilsB, ['hsgB_ac'])
+        attributes.add_table(parcelssoilsC, ['hsgC_ac'])
+        attributes.add_table(parcelssoilsCD, ['hsgCD_ac'])
+        attributes.add_table(parcelssoilsD, ['hsgD_ac'])
+        attributes.add_table(parcelssoilsUNC, ['hsgUNC_ac'])
+        attributes.add_table(parcelswpa2, ['zii_p'])
+        attributes.add_table(parcelswpa1i, ['z1i_p'])
+    attributes.add_table(parcelsauls, ['aulsite'])
+    attributes.add_table(parcelswshed, ['watershed'])
     
     ''' Optional inputs'''
-    if muniownedpts: join_attrblyrs(parcelsmunicipal, parcelmuniname, commonid, 'owner')
-    if pastinspectpts: join_attrblyrs(parcelspastinspect, parcelmuniname, commonid, 'visityear')
-    if aqrecharge: join_attrblyrs(parcelsrecharge, parcelmuniname, commonid, 'rech_depth')
-    if catchbasins: join_attrblyrs(parcelscbs, parcelmuniname, commonid, 'cbid')
-    if drainpipes: join_attrblyrs(parcelsdps, parcelmuniname, commonid, 'dpid')
+    if muniownedpts and not bulk_join: attributes.add_table(parcelsmunicipal, ['owner'])
+    if pastinspectpts and not bulk_join: attributes.add_table(parcelspastinspect, ['visityear'])
+    if aqrecharge: attributes.add_table(parcelsrecharge, ['rech_depth'])
+    if catchbasins and not bulk_join: attributes.add_table(parcelscbs, ['cbid'])
+    if drainpipes and not bulk_join: attributes.add_table(parcelsdps, ['dpid'])
+    
+    # Write all new attributes in one pass
+    attributes.write()
 
     
     print('Deleting unnecessary ' + muniname + ' files...')
-    arcpy.Delete_management(parcelswetlands)
-    arcpy.Delete_management(parcelssoilsA)
-    arcpy.Delete_management(parcelssoilsB)
-    arcpy.Delete_management(parcelssoilsC)
-    arcpy.Delete_management(parcelssoilsCD)
-    arcpy.Delete_management(parcelssoilsD)
-    arcpy.Delete_management(parcelssoilsUNC)
+    if overlay_engine not in ['SHAPELY', 'RASTER']:
+        arcpy.Delete_management(parcelswetlands)
+        arcpy.Delete_management(parcelssoilsA)
+        arcpy.Delete_management(parcelssoilsB)
+        arcpy.Delete_management(parcelssoilsC)
+        arcpy.Delete_management(parcelssoilsCD)
+        arcpy.Delete_management(parcelssoilsD)
+        arcpy.Delete_management(parcelssoilsUNC)
+        arcpy.Delete_management(parcelswpa2)
+        arcpy.Delete_management(parcelswpa1i)
     arcpy.Delete_management(parcelsauls)
-    arcpy.Delete_management(munioutline)
-    arcpy.Delete_management(parcelswpa2)
-    arcpy.Delete_management(parcelswpa1i)
     arcpy.Delete_management(parcelswshed)
     
     ''' Optional inputs '''
-    if muniownedpts: arcpy.Delete_management(parcelsmunicipal)
-    if pastinspectpts: arcpy.Delete_management(parcelspastinspect)
-    if catchbasins: arcpy.Delete_management(parcelscbs)
-    if drainpipes: arcpy.Delete_management(parcelsdps)
+    if muniownedpts and not bulk_join: arcpy.Delete_management(parcelsmunicipal)
+    if pastinspectpts and not bulk_join: arcpy.Delete_management(parcelspastinspect)
+    if catchbasins and not bulk_join: arcpy.Delete_management(parcelscbs)
+    if drainpipes and not bulk_join: arcpy.Delete_management(parcelsdps)
     if aqrecharge: arcpy.Delete_management(parcelsrecharge)
     
     return(parcelmuniname)
 
-
-
-''' Select subset of parcel database to work with '''
-
-### In this case, towns in the Neponset River watershed
-#townnames = ('Boston', 'Milton','Randolph','Dover','Dedham','Westwood','Medfield','Walpole','Norwood','Canton','Foxborough','Sharon', 'Stoughton', 'Quincy')
-#townnames_caps = ('BOSTON', 'MILTON','RANDOLPH','DOVER', 'DEDHAM', 'WESTWOOD', 'MEDFIELD', 'WALPOLE', 'NORWOOD', 'CANTON', 'FOXBOROUGH', 'SHARON', 'STOUGHTON', 'QUINCY')
-
-# Get town names from "townpolys" feature class
-townnames = unique_values(townpolys, 'town')
-townnames = [x.title() for x in townnames]
-townnames_caps = [x.upper() for x in townnames]
-''' 
-Generate Scores 
-'''
-
-# Go through list of towns, add soil and BMP attributes to each town
-muniparcelnames = list()
-for k in np.arange(0, len(townnames)):
-    muniname = townnames[k]
-    muninamecaps = townnames_caps[k]
-    print('Starting ' + muniname)
-    arcpy.AddMessage("Starting " + muniname)
-    muniparcelnames.append(muni_addatts(parcels, townpolys, muniname, muninamecaps))
+def muni_addatts(inparcels, townpolys, muniname, muniname_caps):
     
-arcpy.AddMessage("Completed all municipalities")
+    # Create clip boundary
+    munioutline = AutoName(muniname + '_outline')
+    arcpy.Select_analysis(townpolys, munioutline, "town = '" + muniname_caps + "'")
     
-# Create an empty feature class with the desired schema
-outfile = AutoName('Parcels_Reunited')
-arcpy.CopyFeatures_management(muniparcelnames[0], outfile)
-arcpy.DeleteRows_management(outfile)    # Empty the output file
+    parcelmuniname = parcel_addatts(inparcels, muniname, "muni = '" + muniname + "'", munioutline)
+    arcpy.Delete_management(munioutline)
+    
+    return(parcelmuniname)
 
-# Append all municipal files onto empty feature class with appropriate schema
-arcpy.AddMessage("Re-merging municipalities")
-arcpy.Append_management(muniparcelnames, outfile, schema_type = "TEST")
-for k in range(len(muniparcelnames)):
-    arcpy.Delete_management(muniparcelnames[k])
 
-# Repair geometry
-outtable = AutoName('geomtable')
-arcpy.AddMessage('Checking ' + outfile + ' geometry...')
-arcpy.CheckGeometry_management(outfile, outtable)
 
+if __name__ == '__main__':
+    ''' Select subset of parcel database to work with '''
+    
+    ### In this case, towns in the Neponset River watershed
+    #townnames = ('Boston', 'Milton','Randolph','Dover','Dedham','Westwood','Medfield','Walpole','Norwood','Canton','Foxborough','Sharon', 'Stoughton', 'Quincy')
+    #townnames_caps = ('BOSTON', 'MILTON','RANDOLPH','DOVER', 'DEDHAM', 'WESTWOOD', 'MEDFIELD', 'WALPOLE', 'NORWOOD', 'CANTON', 'FOXBOROUGH', 'SHARON', 'STOUGHTON', 'QUINCY')
+    
+    # Get town names from "townpolys" feature class
+    townnames = unique_values(townpolys, 'town')
+    townnames = [x.title() for x in townnames]
+    townnames_caps = [x.upper() for x in townnames]
+    ''' 
+    Generate Scores 
+    '''
+    
+    # Go through list of towns, add soil and BMP attributes to each town
+    muniparcelnames = list()
+    scratchfolder = None
+    if processes > 1:
+        # Workers open the input layers by path, each in its own workspace
+        for name in LAYER_PARAMETERS:
+            if globals()[name]:
+                globals()[name] = arcpy.Describe(globals()[name]).catalogPath
+    prepare_shared_layers()
+    
+    # Pieces of work: every municipality, or every tile of parcels
+    if partition == 'TILES':
+        (tileparcels, extents) = assign_tiles(parcels, tile_count, tile_margin)
+        parts = [('Tile' + str(k), 'tile_addatts', (tileparcels, k, [float(v) for v in extents[k]])) for k in range(len(extents))]
+    else:
+        parts = [(townnames[k], 'muni_addatts', (parcels, townpolys, townnames[k], townnames_caps[k])) for k in range(len(townnames))]
+    
+    if processes > 1:
+        scratchfolder = tempfile.mkdtemp(prefix = 'parcel_combine_', dir = arcpy.env.scratchFolder)
+        settings = dict((name, globals()[name]) for name in SETTINGS)
+        arcpy.AddMessage('Starting ' + str(len(parts)) + ' ' + partition.lower() + ' parts on ' + str(processes) + ' processes')
+        (results, errors) = run_tasks('parcel_combine', 'scratch_addatts',
+                                      [(scratchfolder,) + part for part in parts],
+                                      settings, processes, retries, log = arcpy.AddMessage)
+        for k in sorted(errors):
+            arcpy.AddWarning('Could not process ' + parts[k][0] + ':\n' + errors[k])
+        # Keep the order of the municipalities or tiles
+        muniparcelnames = [result for result in results if result is not None]
+        if not muniparcelnames:
+            arcpy.AddError('ERROR: No municipality could be processed')
+            raise arcpy.ExecuteError('No municipality could be processed')
+    else:
+        for (partname, function, args) in parts:
+            print('Starting ' + partname)
+            arcpy.AddMessage("Starting " + partname)
+            muniparcelnames.append(globals()[function](*args))
+        
+    arcpy.AddMessage("Completed all municipalities")
+        
+    # Create an empty feature class with the desired schema
+    outfile = AutoName('Parcels_Reunited')
+    arcpy.CopyFeatures_management(muniparcelnames[0], outfile)
+    arcpy.DeleteRows_management(outfile)    # Empty the output file
+    
+    # Append all municipal files onto empty feature class with appropriate schema
+    arcpy.AddMessage("Re-merging municipalities")
+    arcpy.Append_management(muniparcelnames, outfile, schema_type = "TEST")
+    for k in range(len(muniparcelnames)):
+        arcpy.Delete_management(muniparcelnames[k])
+    if partition == 'TILES':
+        arcpy.Delete_management(tileparcels)
+    for lyr in layer_copies:
+        arcpy.Delete_management(lyr)
+    if scratchfolder is not None:
+        for gdb in os.listdir(scratchfolder):
+            arcpy.Delete_management(os.path.join(scratchfolder, gdb))
+        try:
+            os.rmdir(scratchfolder)
+        except OSError:
+            pass
     
-#Repair geometry problems
-arcpy.AddMessage('Repairing ' + outfile + ' geometry...')
-arcpy.RepairGeometry_management(outfile)
-arcpy.Delete_management(outtable)
-
+    # Repair geometry
+    ensure_valid_geometry(outfile)
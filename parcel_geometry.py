@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Geometry Hygiene
+Purpose:     Validates and repairs the geometry of a layer once, instead of
+             running Check Geometry and Repair Geometry on the same
+             statewide layers for every municipality and every join.
+
+             With shapely 2, validity is tested for all features at once
+             (shapely.is_valid), only the invalid ones are repaired
+             (shapely.make_valid, keeping the parts of the layer's dimension)
+             and only those are written back, to a scratch copy of an input
+             layer (see parcel_io.valid_layer). Features whose geometry is
+             null, or empty after the repair, are deleted, as Repair
+             Geometry does.
+
+             A GeometryRegistry remembers the layers whose geometry was found
+             valid, in a JSON file kept between runs, so later stages and
+             later runs skip layers that have not changed. Layers are keyed
+             by metadata that is cheap to read (see parcel_io.layer_key), so
+             the skip does not read the layer's geometry.
+
+"""
+
+import numpy as np
+
+from json_files import load_json, save_json
+from parcel_overlay import shapely
+
+
+# Dimension of the geometries of every ArcGIS shape type
+SHAPE_DIMENSIONS = {'Point': 0, 'Multipoint': 0, 'Polyline': 1, 'Polygon': 2}
+
+
+def invalid_geometries(geoms):
+    ''' Positions of the geometries in "geoms" that are null, empty or not
+    valid (OGC rules). '''
+    geoms = np.asarray(geoms, dtype = object)
+    bad = shapely.is_missing(geoms)
+    bad[~bad] = shapely.is_empty(geoms[~bad]) | ~shapely.is_valid(geoms[~bad])
+    return(np.nonzero(bad)[0])
+
+def repair_geometries(geoms, dimension = 2):
+    ''' Valid versions of "geoms", keeping only the parts of the given
+    dimension (2: polygons, 1: lines, 0: points) of the repaired shapes.
+    Geometries with nothing left are returned as None. '''
+    geoms = np.asarray(geoms, dtype = object)
+    result = np.empty(len(geoms), dtype = object)
+    present = np.nonzero(~shapely.is_missing(geoms))[0]
+    if len(present) == 0:
+        return(result)
+
+    # make_valid may return collections mixing polygons, lines and points;
+    # flatten them (twice, for multi-part members of collections)
+    (parts, index) = shapely.get_parts(shapely.make_valid(geoms[present]), return_index = True)
+    (parts, index2) = shapely.get_parts(parts, return_index = True)
+    index = index[index2]
+    keep = (shapely.get_dimensions(parts) == dimension) & ~shapely.is_empty(parts)
+    parts = parts[keep]
+    if len(parts) == 0:
+        return(result)
+    (found, index) = np.unique(index[keep], return_inverse = True)
+
+    if dimension == 2:
+        # ArcGIS expects clockwise outer rings
+        parts = np.array([shapely.geometry.polygon.orient(p, sign = -1.0) for p in parts], dtype = object)
+        combined = shapely.multipolygons(parts, indices = index)
+    elif dimension == 1:
+        combined = shapely.multilinestrings(parts, indices = index)
+    else:
+        combined = shapely.multipoints(parts, indices = index)
+
+    result[present[found]] = combined
+    return(result)
+
+
+class GeometryRegistry(object):
+    ''' Keys of layers with valid geometry.
+
+    path: JSON file in which the registry is kept between runs; None keeps
+        it in memory for the current run only. '''
+
+    def __init__(self, path = None):
+        self.path = path
+        self.layers = load_json(path, dict()) if path else dict()
+
+    def __contains__(self, key):
+        return(key in self.layers)
+
+    def add(self, key, features):
+        ''' Records a layer as valid, with its number of features. '''
+        self.layers[key] = {'features': features}
+        if self.path:
+            save_json(self.path, self.layers)
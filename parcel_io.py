@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Table I/O
+Purpose:     Helpers that move whole attribute columns between ArcGIS tables
+             and numpy arrays, so that the toolbox steps can compute new
+             attributes in memory and write them back in a single pass
+             instead of joining and copying feature classes.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+
+import arcpy
+import numpy as np
+
+from parcel_loads import join_lookup
+from parcel_geometry import SHAPE_DIMENSIONS, invalid_geometries, repair_geometries
+from parcel_overlay import HAS_SHAPELY, shapely
+
+
+# Field types reported by arcpy.ListFields and the equivalent AddField type
+FIELD_TYPES = {'Integer': 'LONG',
+               'SmallInteger': 'SHORT',
+               'Double': 'DOUBLE',
+               'Single': 'FLOAT',
+               'String': 'TEXT',
+               'Date': 'DATE',
+               'OID': 'LONG'}
+
+NUMERIC_TYPES = ['Integer', 'SmallInteger', 'Double', 'Single', 'OID']
+
+
+def field_props(table, fieldname):
+    ''' Returns the AddField type and length of "fieldname" in "table". '''
+    field = [f for f in arcpy.ListFields(table) if f.name.lower() == fieldname.lower()][0]
+    return(FIELD_TYPES.get(field.type, 'TEXT'), field.length)
+
+def read_columns(table, fields, where = None):
+    ''' Reads "fields" from "table" in one SearchCursor pass. Returns a dict
+    of arrays: numeric fields as float arrays with NaN for nulls, all other
+    fields as object arrays with None for nulls. '''
+
+    types = dict((f.name.lower(), f.type) for f in arcpy.ListFields(table))
+    rows = [row for row in arcpy.da.SearchCursor(table, fields, where)]
+
+    columns = dict()
+    for k in range(len(fields)):
+        values = [row[k] for row in rows]
+        if types.get(fields[k].lower()) in NUMERIC_TYPES:
+            columns[fields[k]] = np.array(values, dtype = float)
+        else:
+            columns[fields[k]] = np.array(values, dtype = object)
+
+    return(columns)
+
+def read_shapes(fc, spatial_reference = None, where = None):
+    ''' Reads the geometry of every feature of "fc" as WKB in one
+    SearchCursor pass, optionally projected to "spatial_reference". '''
+    return([row[0] for row in arcpy.da.SearchCursor(fc, ['SHAPE@WKB'], where, spatial_reference)])
+
+def write_columns(table, columns, fieldtypes = None):
+    ''' Writes each array in "columns" (dict or list of (name, array) pairs)
+    to "table" in a single UpdateCursor pass, in the order the table's rows
+    are read by read_columns. Fields that do not exist yet are added first,
+    with their type taken from "fieldtypes" ({name: (type, length)}) or
+    guessed from the array. NaN and None are written as nulls. '''
+
+    if isinstance(columns, dict):
+        columns = sorted(columns.items())
+    names = [c[0] for c in columns]
+    arrays = [c[1] for c in columns]
+    fieldtypes = fieldtypes or dict()
+
+    existing = [f.name.lower() for f in arcpy.ListFields(table)]
+    for k in range(len(names)):
+        if names[k].lower() in existing:
+            continue
+        if names[k] in fieldtypes:
+            (ftype, flength) = fieldtypes[names[k]]
+        elif arrays[k].dtype.kind in 'fiub':
+            (ftype, flength) = ('DOUBLE', None)
+        else:
+            lengths = [len(v) for v in arrays[k] if v is not None]
+            (ftype, flength) = ('TEXT', max(lengths + [1]))
+        if ftype == 'TEXT':
+            arcpy.AddField_management(table, names[k], ftype, field_length = flength)
+        else:
+            arcpy.AddField_management(table, names[k], ftype)
+
+    floats = [a.dtype.kind == 'f' for a in arrays]
+    j = 0
+    with arcpy.da.UpdateCursor(table, names) as cursor:
+        for row in cursor:
+            for k in range(len(arrays)):
+                value = arrays[k][j]
+                if floats[k] and np.isnan(value):
+                    value = None
+                row[k] = value
+            j = j + 1
+            cursor.updateRow(row)
+
+    return(table)
+
+
+class AttributeAccumulator(object):
+    ''' New attribute columns for the rows of "table", collected from any
+    number of overlay and join steps and written to the table in one pass
+    (see write_columns), instead of one JoinField per attribute.
+
+    table: table the columns are written to (e.g. a municipality's parcels).
+    keyfield: field identifying its rows (e.g. mapc_id), on which the rows of
+        other tables are matched by add_table. '''
+
+    def __init__(self, table, keyfield):
+        self.table = table
+        self.keyfield = keyfield
+        self.keys = read_columns(table, [keyfield])[keyfield]
+        self.columns = list()
+        self.fieldtypes = dict()
+
+    def __len__(self):
+        return(len(self.keys))
+
+    def add(self, name, values, fieldtype = None):
+        ''' Adds a column of values in the row order of the table (e.g.
+        computed from a cursor over it), replacing an earlier column of the
+        same name. "fieldtype" is an optional (AddField type, length). '''
+        values = np.asarray(values)
+        if len(values) != len(self.keys):
+            raise ValueError('Column ' + name + ' has ' + str(len(values)) + ' values for ' + str(len(self.keys)) + ' rows')
+        self.columns = [c for c in self.columns if c[0] != name] + [(name, values)]
+        if fieldtype is not None:
+            self.fieldtypes[name] = fieldtype
+
+    def add_columns(self, columns, fieldtypes = None):
+        ''' Adds a dict of columns (see add). '''
+        fieldtypes = fieldtypes or dict()
+        for (name, values) in sorted(columns.items()):
+            self.add(name, values, fieldtypes.get(name))
+
+    def add_table(self, source, fields):
+        ''' Adds "fields" of table "source", matched to the rows of the table
+        on the key field, with their field types. As with JoinField, the
+        first matching row of "source" is used and rows without a match get
+        nulls. '''
+        columns = join_lookup(self.keys, read_columns(source, [self.keyfield] + fields), self.keyfield, fields)
+        for field in fields:
+            self.add(field, columns[field], field_props(source, field))
+
+    def write(self):
+        ''' Writes all columns to the table in one UpdateCursor pass. '''
+        if self.columns:
+            write_columns(self.table, self.columns, self.fieldtypes)
+        return(self.table)
+
+def invalid_features(fc):
+    ''' Finds the features of "fc" whose geometry is null, empty or invalid.
+    With shapely, all features are tested at once and the invalid ones are
+    repaired in memory (see parcel_geometry.repair_geometries); otherwise
+    Check Geometry is run. Returns the number of invalid features and a dict
+    of their repaired geometries by cursor position (None: to be deleted),
+    or None when Check Geometry was used. '''
+    desc = arcpy.Describe(fc)
+    if HAS_SHAPELY and desc.shapeType in SHAPE_DIMENSIONS:
+        wkbs = read_shapes(fc)
+        values = np.empty(len(wkbs), dtype = object)
+        values[:] = [None if wkb is None else bytes(wkb) for wkb in wkbs]
+        bad = invalid_geometries(shapely.from_wkb(values))
+        return(len(bad), dict(zip(bad, repair_geometries(shapely.from_wkb(values[bad]), SHAPE_DIMENSIONS[desc.shapeType]))))
+
+    outtable = arcpy.CreateUniqueName('geomtable', arcpy.env.scratchGDB)
+    arcpy.CheckGeometry_management(fc, outtable)
+    ninvalid = len(set(row[0] for row in arcpy.da.SearchCursor(outtable, ['FEATURE_ID'])))
+    arcpy.Delete_management(outtable)
+    return(ninvalid, None)
+
+def repair_features(fc, fixes):
+    ''' Repairs the invalid features of "fc" in place, from the "fixes" of
+    invalid_features: only those features are rewritten (or deleted, as
+    Repair Geometry does). Without fixes, Repair Geometry is run. '''
+    if fixes is None:
+        arcpy.RepairGeometry_management(fc)
+        return(fc)
+
+    sr = arcpy.Describe(fc).spatialReference
+    j = 0
+    with arcpy.da.UpdateCursor(fc, ['SHAPE@']) as cursor:
+        for row in cursor:
+            if j in fixes:
+                if fixes[j] is None:
+                    cursor.deleteRow()
+                else:
+                    row[0] = arcpy.FromWKB(bytearray(shapely.to_wkb(fixes[j])), sr)
+                    cursor.updateRow(row)
+            j = j + 1
+    return(fc)
+
+def ensure_valid_geometry(fc):
+    ''' Checks the geometry of every feature of "fc", a layer made by the
+    toolbox itself (e.g. a merged output), and repairs the invalid features
+    in place. Returns the number of features repaired or deleted. '''
+    arcpy.AddMessage('Checking ' + fc + ' geometry...')
+    (ninvalid, fixes) = invalid_features(fc)
+    if ninvalid:
+        arcpy.AddMessage('Repairing ' + str(ninvalid) + ' features of ' + fc + '...')
+        repair_features(fc, fixes)
+    return(ninvalid)
+
+def layer_key(fc):
+    ''' Key of the current state of layer "fc" for a GeometryRegistry, from
+    metadata that is cheap to read: its path, feature count and extent, and
+    the latest modification time of its files (of the whole geodatabase for
+    a file geodatabase feature class; for other layers, of the files in the
+    layer's folder named after it). Editing the layer changes the key. '''
+    desc = arcpy.Describe(fc)
+    path = desc.catalogPath
+    extent = desc.extent
+    gdb = re.search(r'^(.*?\.gdb)(?=[\\/]|$)', path, re.I)
+    if gdb:
+        files = [os.path.join(gdb.group(1), name) for name in os.listdir(gdb.group(1))] if os.path.isdir(gdb.group(1)) else []
+    else:
+        (folder, name) = os.path.split(path)
+        stem = os.path.splitext(name)[0].lower()
+        files = [os.path.join(folder, f) for f in os.listdir(folder)
+                 if os.path.splitext(f)[0].lower() == stem] if os.path.isdir(folder) else []
+    mtimes = [os.path.getmtime(f) for f in files if os.path.exists(f)]
+    state = [path, int(arcpy.GetCount_management(fc).getOutput(0)),
+             [extent.XMin, extent.YMin, extent.XMax, extent.YMax], max(mtimes) if mtimes else None]
+    return(hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest())
+
+def valid_layer(fc, registry = None):
+    ''' Input layer "fc" itself when its geometry is valid, otherwise a
+    scratch copy of it in which the invalid features are repaired; "fc" is
+    never changed. Layers whose key (see layer_key) is in "registry" (a
+    parcel_geometry.GeometryRegistry) were found valid before and are not
+    checked again; layers found valid are added to it. '''
+    key = layer_key(fc)
+    if registry is not None and key in registry:
+        arcpy.AddMessage('Geometry of ' + fc + ' already checked')
+        return(fc)
+
+    arcpy.AddMessage('Checking ' + fc + ' geometry...')
+    (ninvalid, fixes) = invalid_features(fc)
+    if not ninvalid:
+        if registry is not None:
+            registry.add(key, int(arcpy.GetCount_management(fc).getOutput(0)))
+        return(fc)
+
+    name = arcpy.ValidateTableName(os.path.splitext(os.path.basename(os.path.normpath(fc)))[0] + '_valid', arcpy.env.scratchGDB)
+    repaired = arcpy.CreateScratchName(name, '', 'FeatureClass', arcpy.env.scratchGDB)
+    arcpy.AddMessage('Repairing ' + str(ninvalid) + ' features of ' + fc + ' in a copy (' + repaired + ')...')
+    arcpy.CopyFeatures_management(fc, repaired)
+    return(repair_features(repaired, fixes))
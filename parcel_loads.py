@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Load Kernels
+Purpose:     Array-based versions of the per-parcel nutrient load
+             calculations used by load_calc.py and
+             nutrient_muni_percentile.py. Every function here works on the
+             numpy structured arrays returned by
+             arcpy.da.FeatureClassToNumPyArray/TableToNumPyArray and does not
+             need arcpy itself, so the same kernels can be reused by every
+             step of the toolbox.
+
+"""
+
+import numpy as np
+
+
+# Land surface cover labels used by the EPA MS4 table 1-2 (table_1_2)
+P_PERVIOUS = 'Pervious'
+P_IMPERVIOUS = 'Directly connected impervious'
+
+# Field names of table_1_2
+P_LUTYPE_FIELD = 'Phosphorus_source_by_land_use'
+P_COVER_FIELD = 'Land_Surface_Cover'
+P_HSG_FIELD = 'HSG'
+P_RATE_FIELD = 'P_load_export_rate__lbs_acre_year_'
+
+SQFT_PER_ACRE = 43560.0
+
+# Unit area export rates (lb/acre/yr) end in RATE_SUFFIX; the matching
+# per-parcel loads (lb/yr) end in LOAD_SUFFIX.
+RATE_SUFFIX = '_lbacyr'
+LOAD_SUFFIX = '_lbyr'
+P_LOAD_FIELD = 'TP_lbacyr'
+
+# Hydrologic soil group acreage fields added by parcel_combine.py, and the
+# soil classes they stand for, in tie-breaking order.
+HSG_FIELDS = ['hsgA_ac', 'hsgB_ac', 'hsgC_ac', 'hsgCD_ac', 'hsgD_ac', 'hsgUNC_ac']
+HSG_CLASSES = ['A', 'B', 'C', 'C/D', 'D', 'UNC']
+HSG_FIELD = 'hsgtype'
+HSG_FIELD_LENGTH = 3
+
+# Land use overrides applied before export rates are looked up, in priority
+# order (the first matching rule wins). Each rule is
+# (field, operator, value, Code_3_12, Code_1_2); see apply_lu_rules.
+LU_RULE_FIELDS = ['Field', 'Operator', 'Value', 'Code_3_12', 'Code_1_2']
+DEFAULT_LU_RULES = [('poly_typ', 'IN', ['ROW', 'PRIV_ROW', 'RAIL_ROW'], 'Highway', 'Highway'),
+                    ('poly_typ', '==', 'WATER', 'Low Priority Loading', 'Water'),
+                    ('luc_adj_1', 'BLANK', None, 'Low Priority Loading', 'Open Land'),
+                    ('wetland_p', '>=', 0.9, 'Low Priority Loading', 'Forest')]
+
+
+def encode(values, categories):
+    ''' Returns the integer position of each entry of "values" in the list
+    "categories", or -1 where the value is not one of the categories. The
+    lookup is done once per distinct value rather than once per parcel. '''
+    values = np.asarray(values)
+    codes = np.full(len(values), -1, dtype = np.int32)
+    if len(values) == 0:
+        return(codes)
+
+    index = dict((c, k) for k, c in enumerate(categories))
+    if values.dtype.kind == 'O':
+        # Columns read with nulls (None) cannot be sorted by np.unique
+        codes[:] = [index.get(v, -1) for v in values]
+        return(codes)
+    uniq, inverse = np.unique(values, return_inverse = True)
+    ucodes = np.array([index.get(u, -1) for u in uniq], dtype = np.int32)
+    codes[:] = ucodes[inverse]
+
+    return(codes)
+
+def join_lookup(keys, lookup, lookup_key, fields):
+    ''' Attribute-only join of a lookup table onto parcels.
+
+    keys: join key of every parcel (e.g. the luc_adj_1 column).
+    lookup: dict of lookup table columns (or a structured array).
+    lookup_key: name of the key column in "lookup".
+    fields: columns of "lookup" to attach.
+
+    The lookup keys are loaded into a hash index once and each distinct
+    parcel key is probed once. When a key appears more than once in the
+    lookup table the first row is used. Returns a dict of the looked-up
+    columns: float columns with NaN and other columns with None where a
+    parcel key has no match. '''
+
+    index = dict()
+    lookupkeys = lookup[lookup_key]
+    for k in range(len(lookupkeys) - 1, -1, -1):
+        index[lookupkeys[k]] = k
+
+    keys = np.asarray(keys)
+    if keys.dtype.kind == 'O':
+        rows = np.array([index.get(key, -1) for key in keys], dtype = np.int64)
+    elif len(keys) == 0:
+        rows = np.zeros(0, dtype = np.int64)
+    else:
+        uniq, inverse = np.unique(keys, return_inverse = True)
+        rows = np.array([index.get(key, -1) for key in uniq], dtype = np.int64)[inverse]
+    found = rows >= 0
+
+    columns = dict()
+    for field in fields:
+        values = np.asarray(lookup[field])
+        if values.dtype.kind in 'fiub':
+            column = np.full(len(rows), np.nan)
+        else:
+            column = np.empty(len(rows), dtype = object)
+        column[found] = values[rows[found]]
+        columns[field] = column
+
+    return(columns)
+
+def parse_lu_rules(rows):
+    ''' Converts rows of a rule table (Field, Operator, Value, Code_3_12,
+    Code_1_2) into rules for apply_lu_rules. Values of IN rules are comma
+    separated lists; values of comparison rules are converted to numbers. '''
+    rules = []
+    for row in rows:
+        (field, op, value, code312, code12) = row[:5]
+        op = op.strip().upper()
+        if op == 'IN':
+            value = [v.strip() for v in value.split(',')]
+        elif op in ['>', '>=', '<', '<=']:
+            value = float(value)
+        rules.append((field.strip(), op, value, code312, code12))
+    return(rules)
+
+def rule_mask(column, op, value):
+    ''' Parcels selected by one land use rule. NaN never matches a comparison. '''
+    column = np.asarray(column)
+    if op == 'BLANK':
+        return(np.array([v is None or v == ' ' for v in column], dtype = bool))
+    if op == 'IN':
+        return(np.array([v in value for v in column], dtype = bool))
+    if op in ['==', '=']:
+        return(np.array([v == value for v in column], dtype = bool))
+    if op == '!=':
+        return(np.array([v != value for v in column], dtype = bool))
+
+    column = column.astype(float)
+    with np.errstate(invalid = 'ignore'):
+        if op == '>=':
+            return(column >= value)
+        if op == '>':
+            return(column > value)
+        if op == '<=':
+            return(column <= value)
+        if op == '<':
+            return(column < value)
+    raise ValueError('Unknown rule operator: ' + str(op))
+
+def apply_lu_rules(parceltable, code312, code12, rules = DEFAULT_LU_RULES):
+    ''' Overrides the table 3-12 and table 1-2 land use codes of every parcel
+    matched by "rules" (see DEFAULT_LU_RULES). Rules are applied as masked
+    assignments, lowest priority first, so that where several rules match a
+    parcel the first one in the list wins. Returns new code arrays. '''
+    code312 = np.array(code312, dtype = object)
+    code12 = np.array(code12, dtype = object)
+    for (field, op, value, newcode312, newcode12) in reversed(rules):
+        mask = rule_mask(parceltable[field], op, value)
+        code312[mask] = newcode312
+        code12[mask] = newcode12
+    return(code312, code12)
+
+def classify_hsg(parceltable, hsg_fields = HSG_FIELDS):
+    ''' Finds the dominant hydrologic soil group of every parcel from its six
+    HSG acreage fields (A, B, C, C/D, D, UNC, in that order).
+
+    The class is the one with the largest area. Ties go to the first class
+    in the order A > B > C > C/D > D. Parcels where unclassified soils are
+    the largest, or where any of the areas is null (NaN), are classed 'D',
+    matching the original per-parcel if/elif chain.
+
+    Returns an int8 array of positions in HSG_CLASSES (see hsg_labels).'''
+
+    areas = np.column_stack([np.asarray(parceltable[f], dtype = float) for f in hsg_fields])
+    maxarea = areas.max(axis = 1)
+    ismax = areas[:, :5] == maxarea[:, np.newaxis]
+
+    codes = np.full(len(areas), HSG_CLASSES.index('D'), dtype = np.int8)
+    found = ismax.any(axis = 1)
+    codes[found] = ismax.argmax(axis = 1)[found]
+
+    return(codes)
+
+def hsg_labels(codes):
+    ''' Converts HSG codes from classify_hsg to their class names. '''
+    return(np.asarray(HSG_CLASSES)[codes])
+
+def build_prate_matrix(loadtable,
+                       lutype_field = P_LUTYPE_FIELD,
+                       cover_field = P_COVER_FIELD,
+                       hsg_field = P_HSG_FIELD,
+                       rate_field = P_RATE_FIELD):
+    ''' Compiles the phosphorus export rate table (table_1_2) into a dense
+    rate matrix indexed by [land use, HSG, cover], where cover 0 is pervious
+    and cover 1 is directly connected impervious. Combinations missing from
+    the table are 0.0. When a combination appears more than once, the first
+    row wins, as it did in the row-by-row lookup.
+
+    Returns (lutypes, hsgtypes, rates).'''
+
+    lutypes = sorted(set(loadtable[lutype_field]))
+    hsgtypes = sorted(set(loadtable[hsg_field]))
+    rates = np.zeros((len(lutypes), len(hsgtypes), 2))
+
+    lucodes = encode(loadtable[lutype_field], lutypes)
+    hsgcodes = encode(loadtable[hsg_field], hsgtypes)
+    cover = loadtable[cover_field]
+    covercodes = np.where(cover == P_PERVIOUS, 0, np.where(cover == P_IMPERVIOUS, 1, -1))
+
+    # Walk the table backwards so that the first matching row is written last.
+    for k in range(len(loadtable) - 1, -1, -1):
+        if covercodes[k] >= 0:
+            rates[lucodes[k], hsgcodes[k], covercodes[k]] = loadtable[rate_field][k]
+
+    return(lutypes, hsgtypes, rates)
+
+def lookup_prates(lutype, hsgtype, prates):
+    ''' Looks up the pervious and impervious phosphorus export rates of every
+    parcel from a compiled rate matrix (see build_prate_matrix). Parcels with
+    a land use or HSG class that is not in the table get 0.0 for both. '''
+    (lutypes, hsgtypes, rates) = prates
+    lucodes = encode(lutype, lutypes)
+    hsgcodes = encode(hsgtype, hsgtypes)
+
+    found = (lucodes >= 0) & (hsgcodes >= 0)
+    perviousrate = np.zeros(len(lucodes))
+    imperviousrate = np.zeros(len(lucodes))
+    perviousrate[found] = rates[lucodes[found], hsgcodes[found], 0]
+    imperviousrate[found] = rates[lucodes[found], hsgcodes[found], 1]
+
+    return(perviousrate, imperviousrate)
+
+def calcp(perviousrate, imperviousrate, area_ft2, impervpct):
+    ''' Phosphorus export (lb/yr and lb/acre/yr) from pervious and impervious
+    export rates. Works on scalars or on whole columns at once. '''
+    area = area_ft2/float(SQFT_PER_ACRE)    # convert area in square feet to acres
+    impervpct = impervpct/100.0
+
+    a_pervious = (1.0 - impervpct)*area
+    a_impervious = impervpct*area
+
+    pexpratelbs = (perviousrate*a_pervious) + (imperviousrate*a_impervious)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        pexpratelbsacres = pexpratelbs/area
+
+    return(pexpratelbs, pexpratelbsacres)
+
+def calc_pexport(parceltable, loadtable,
+                 lutype_field = 'Code_1_2',
+                 imp_p_field = 'pct_imperv',
+                 area_field = 'lot_areaft',
+                 hsg_field = 'hsgtype',
+                 hsgtype = None):
+    ''' Estimates the phosphorus export of every parcel with the EPA MS4 method.
+
+    parceltable: structured array with land use type, impervious percent,
+        area (square feet) and, unless "hsgtype" is passed, HSG class fields.
+    loadtable: structured array of table_1_2, or a rate matrix already
+        compiled with build_prate_matrix.
+    hsgtype: optional array of HSG classes to use instead of "hsg_field".
+
+    Parcels on unclassified ('UNC') soils are treated as 100% impervious.
+    Returns the TP_lbyr and TP_lbacyr columns as arrays. '''
+
+    if isinstance(loadtable, tuple):
+        prates = loadtable
+    else:
+        prates = build_prate_matrix(loadtable)
+    if hsgtype is None:
+        hsgtype = parceltable[hsg_field]
+    hsgtype = np.asarray(hsgtype)
+
+    area = parceltable[area_field].astype(float)
+    impervpct = parceltable[imp_p_field].astype(float)
+    impervpct = np.where(hsgtype.astype(str) == 'UNC', 100.0, impervpct)
+
+    (perviousrate, imperviousrate) = lookup_prates(parceltable[lutype_field], hsgtype, prates)
+
+    return(calcp(perviousrate, imperviousrate, area, impervpct))
+
+def calc_loads(parceltable, rate_fields, prates,
+               lutype_field = 'Code_1_2',
+               imp_p_field = 'pct_imperv',
+               area_field = 'lot_areaft',
+               hsgtype = None,
+               p_load_field = P_LOAD_FIELD):
+    ''' Computes the loads of every pollutant for every parcel in one pass.
+
+    parceltable: dict of parcel columns (or a structured array) holding the
+        land use type, impervious percent, area (square feet) and the unit
+        area export rate columns named in "rate_fields".
+    rate_fields: unit area export rate columns (e.g. TN_lbacyr, TSS_lbacyr).
+        Each one ending in RATE_SUFFIX gives a load column ending in
+        LOAD_SUFFIX (rate * acres), so new pollutants only need a new rate
+        column in the land use load table.
+    prates: table_1_2 structured array or compiled rate matrix for the EPA
+        MS4 phosphorus method, which replaces the unit area estimate of
+        "p_load_field" (TP_lbyr and TP_lbacyr).
+    hsgtype: HSG class of every parcel (see classify_hsg, hsg_labels).
+
+    Returns a dict of load columns. '''
+
+    area = np.asarray(parceltable[area_field], dtype = float)
+    acres = area/SQFT_PER_ACRE
+
+    loads = dict()
+    for field in rate_fields:
+        if field == p_load_field or not field.endswith(RATE_SUFFIX):
+            continue
+        rate = np.asarray(parceltable[field], dtype = float)
+        loads[field[:-len(RATE_SUFFIX)] + LOAD_SUFFIX] = rate*acres
+
+    (loads[p_load_field[:-len(RATE_SUFFIX)] + LOAD_SUFFIX], loads[p_load_field]) = calc_pexport(parceltable, prates, lutype_field, imp_p_field, area_field, hsgtype = hsgtype)
+
+    return(loads)
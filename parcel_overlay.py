@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Overlay Engine
+Purpose:     Exact polygon overlay of parcels with reference polygon layers
+             (wetlands, wellhead protection areas, soils) for
+             parcel_combine.py, without building union layers.
+
+             The parcels are loaded into a bulk STRtree once. Every reference
+             layer is queried against it in chunks to find the (parcel,
+             reference polygon) pairs that intersect, the intersection areas
+             of all pairs are computed as arrays, and the areas are reduced
+             per parcel.
+
+             With the 'max' reduction the results match the Union + Select +
+             CONTAINS spatial join ('maximum' merge rule) of overlapatt and
+             areaatt: the largest overlap of a parcel with any one reference
+             polygon. Parcels that overlap no reference polygon are null
+             (NaN). The 'sum' reduction gives the total overlap instead.
+
+             Requires shapely 2 (not shipped with ArcGIS Desktop); check
+             HAS_SHAPELY before use.
+
+"""
+
+import numpy as np
+
+try:
+    import shapely
+    from shapely import STRtree
+    HAS_SHAPELY = hasattr(shapely, 'from_wkb') and hasattr(shapely, 'intersection')
+except ImportError:
+    shapely = None
+    HAS_SHAPELY = False
+
+
+SQMETERS_PER_SQFT = 0.09290304
+SQMETERS_PER_ACRE = 4046.8564224
+
+# Number of (parcel, reference polygon) pairs intersected at once
+DEFAULT_CHUNK_SIZE = 100000
+
+REDUCTIONS = ['max', 'sum']
+
+# Reductions of feature attributes joined to parcels (see reduce_values)
+JOIN_REDUCTIONS = ['max', 'count', 'first']
+
+# ArcGIS spatial join match options, with the parcels as target features, and
+# the shapely predicates a parcel must satisfy against a join feature
+# ('HAVE_THEIR_CENTER_IN' tests the parcels' centroids)
+JOIN_PREDICATES = {'INTERSECT': 'intersects',
+                   'WITHIN': 'within',
+                   'HAVE_THEIR_CENTER_IN': 'intersects'}
+
+
+def require_shapely():
+    if not HAS_SHAPELY:
+        raise ImportError('The parcel overlay engine requires shapely 2.0 or later')
+
+def from_wkb(wkbs):
+    ''' Converts a list of WKB geometries (e.g. read with the SHAPE@WKB
+    token) to an array of shapely geometries. Null shapes stay None. '''
+    require_shapely()
+    values = np.empty(len(wkbs), dtype = object)
+    values[:] = [None if wkb is None else bytes(wkb) for wkb in wkbs]
+    return(shapely.from_wkb(values))
+
+def stack_layers(layers):
+    ''' Combines the geometries of several reference layers into one layer
+    for ParcelOverlay.class_areas. Returns the geometries and the class
+    number (position in "layers") of every geometry. '''
+    geoms = np.concatenate([np.asarray(layer, dtype = object) for layer in layers]) if layers else np.zeros(0, dtype = object)
+    classes = np.concatenate([np.full(len(layer), k, dtype = np.int64) for k, layer in enumerate(layers)]) if layers else np.zeros(0, dtype = np.int64)
+    return(geoms, classes)
+
+def layer_index(cache, key, geoms):
+    ''' Packed R-tree of a reference layer with state "key" (see
+    spatial_cache.layer_fingerprint) from a spatial_cache SpatialIndexCache
+    (built and stored when the layer has changed). The geometries are
+    prepared in place for the exact intersection tests. '''
+    require_shapely()
+    (fingerprint, tree) = cache.index(key, shapely.bounds(geoms))
+    shapely.prepare(geoms)
+    return(tree)
+
+def area_factor(meters_per_unit, units = 'SQUAREFEET'):
+    ''' Factor converting areas in squared map units to square feet
+    ('SQUAREFEET') or acres ('ACRES'), from the spatial reference's
+    metersPerUnit. '''
+    if units == 'ACRES':
+        return(meters_per_unit**2/SQMETERS_PER_ACRE)
+    return(meters_per_unit**2/SQMETERS_PER_SQFT)
+
+def reduce_by_parcel(nparcels, parcelidx, values, how = 'max'):
+    ''' Reduces "values" of (parcel, reference polygon) pairs to one value
+    per parcel. Parcels without any pair get NaN. '''
+    if how not in REDUCTIONS:
+        raise ValueError('Unknown reduction: ' + str(how))
+
+    result = np.full(nparcels, np.nan)
+    if len(parcelidx) == 0:
+        return(result)
+
+    order = np.argsort(parcelidx, kind = 'mergesort')
+    sortedidx = parcelidx[order]
+    starts = np.nonzero(np.r_[True, sortedidx[1:] != sortedidx[:-1]])[0]
+    if how == 'max':
+        result[sortedidx[starts]] = np.fmax.reduceat(values[order], starts)
+    else:
+        result[sortedidx[starts]] = np.add.reduceat(values[order], starts)
+
+    return(result)
+
+def reduce_values(nparcels, parcelidx, featidx, values, how = 'max'):
+    ''' Reduces attribute "values" of the features matched to parcels to one
+    value per parcel, like the merge rules of an ArcGIS spatial join.
+
+    parcelidx, featidx: (parcel, feature) pairs.
+    values: attribute of every feature: numbers, or other comparable values
+        (text, dates) in an object array.
+    how: 'max' (largest value), 'count' (number of features) or 'first'
+        (value of the first feature in the layer's order).
+
+    Null values are ignored. Parcels without a matching feature get 0 for
+    'count' and null (NaN or None) otherwise. '''
+    if how not in JOIN_REDUCTIONS:
+        raise ValueError('Unknown reduction: ' + str(how))
+    parcelidx = np.asarray(parcelidx, dtype = np.int64)
+    featidx = np.asarray(featidx, dtype = np.int64)
+
+    if how == 'count':
+        return(np.bincount(parcelidx, minlength = nparcels)[:nparcels])
+
+    values = np.asarray(values)
+    if values.dtype.kind in 'fiub':
+        result = np.full(nparcels, np.nan)
+        ranks = values.astype(float)
+    else:
+        # Compare values by their rank among the layer's non-null values
+        result = np.empty(nparcels, dtype = object)
+        rank = dict((v, k) for k, v in enumerate(sorted(set(v for v in values if v is not None))))
+        ranks = np.array([np.nan if v is None else rank[v] for v in values], dtype = float)
+
+    valid = ~np.isnan(ranks[featidx])
+    pi = parcelidx[valid]
+    fi = featidx[valid]
+    if len(pi) == 0:
+        return(result)
+
+    # Sort the pairs by parcel and then by key; the last pair of every parcel wins
+    if how == 'max':
+        key = ranks[fi]
+    else:
+        key = -fi.astype(float)
+    order = np.lexsort((key, pi))
+    pi = pi[order]
+    fi = fi[order]
+    last = np.r_[pi[1:] != pi[:-1], True]
+    result[pi[last]] = values[fi[last]]
+
+    return(result)
+
+def join_mismatches(values, reference):
+    ''' Positions at which joined "values" (see reduce_values) differ from
+    the "reference" values of the same parcels, e.g. from an ArcGIS spatial
+    join. Nulls (None or NaN) only match nulls. '''
+    def isnull(value):
+        return(value is None or (isinstance(value, float) and np.isnan(value)))
+    mismatches = list()
+    for k in range(len(values)):
+        if isnull(values[k]) or isnull(reference[k]):
+            if not (isnull(values[k]) and isnull(reference[k])):
+                mismatches.append(k)
+        elif values[k] != reference[k]:
+            mismatches.append(k)
+    return(mismatches)
+
+
+class ParcelOverlay(object):
+    ''' Overlay of a set of parcels with any number of reference layers.
+
+    parcels: array of shapely polygons (see from_wkb).
+    chunk_size: number of (parcel, reference polygon) pairs intersected at
+        once, which bounds the memory used by the intersections.
+
+    The spatial index of the parcels is built once and reused for every
+    reference layer. Areas are in squared map units. '''
+
+    def __init__(self, parcels, chunk_size = DEFAULT_CHUNK_SIZE):
+        require_shapely()
+        self.parcels = np.asarray(parcels, dtype = object)
+        self.chunk_size = chunk_size
+        self.tree = STRtree(self.parcels)
+        self.areas = shapely.area(self.parcels)
+
+    def __len__(self):
+        return(len(self.parcels))
+
+    def pairs(self, refs, refindex = None):
+        ''' Yields chunks of at most chunk_size (parcel index, reference
+        index) pairs of intersecting parcels and reference polygons. The
+        parcel STRtree is queried with the reference polygons, unless a
+        prebuilt index of the reference layer ("refindex", a
+        spatial_cache.PackedRTree) is given, in which case it is queried
+        with the parcels' bounding boxes and the candidates are tested
+        exactly. '''
+        if refindex is None:
+            for start in range(0, len(refs), self.chunk_size):
+                (qref, qparcel) = self.tree.query(refs[start:start + self.chunk_size], predicate = 'intersects')
+                qref = qref + start
+                for k in range(0, len(qref), self.chunk_size):
+                    yield(qparcel[k:k + self.chunk_size], qref[k:k + self.chunk_size])
+        else:
+            bounds = shapely.bounds(self.parcels)
+            for start in range(0, len(self), self.chunk_size):
+                (qparcel, qref) = refindex.query(bounds[start:start + self.chunk_size])
+                qparcel = qparcel + start
+                for k in range(0, len(qparcel), self.chunk_size):
+                    pi = qparcel[k:k + self.chunk_size]
+                    ri = qref[k:k + self.chunk_size]
+                    hit = shapely.intersects(refs[ri], self.parcels[pi])
+                    yield(pi[hit], ri[hit])
+
+    def pieces(self, refs, refindex = None):
+        ''' Intersections of the parcels with the reference polygons "refs".
+        Returns (parcel index, reference index, intersection area) arrays for
+        every pair whose intersection has a positive area. '''
+        refs = np.asarray(refs, dtype = object)
+        parcelidx = list()
+        refidx = list()
+        areas = list()
+
+        for (pi, ri) in self.pairs(refs, refindex):
+            area = shapely.area(shapely.intersection(self.parcels[pi], refs[ri]))
+            keep = area > 0
+            parcelidx.append(pi[keep])
+            refidx.append(ri[keep])
+            areas.append(area[keep])
+
+        if not areas:
+            return(np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0))
+        return(np.concatenate(parcelidx), np.concatenate(refidx), np.concatenate(areas))
+
+    def overlap_area(self, refs, how = 'max', refindex = None):
+        ''' Area of every parcel covered by "refs", reduced over reference
+        polygons by 'max' (largest single overlap) or 'sum'. '''
+        (parcelidx, refidx, areas) = self.pieces(refs, refindex)
+        return(reduce_by_parcel(len(self), parcelidx, areas, how))
+
+    def overlap_fraction(self, refs, how = 'max', refindex = None):
+        ''' Fraction of every parcel's area covered by "refs" (see
+        overlap_area). '''
+        (parcelidx, refidx, areas) = self.pieces(refs, refindex)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            fractions = areas/self.areas[parcelidx]
+        return(reduce_by_parcel(len(self), parcelidx, fractions, how))
+
+    def join_features(self, geoms, values, how = 'max', method = 'INTERSECT'):
+        ''' Attributes of point, line or polygon features joined to the
+        parcels they match, reduced per parcel (see reduce_values). "method"
+        is the ArcGIS spatial join match option with the parcels as target
+        features (see JOIN_PREDICATES): a parcel matches the features it
+        intersects ('INTERSECT'), lies within ('WITHIN') or whose centroid
+        lies in them ('HAVE_THEIR_CENTER_IN'). '''
+        geoms = np.asarray(geoms, dtype = object)
+        targets = self.parcels
+        if method == 'HAVE_THEIR_CENTER_IN':
+            targets = shapely.centroid(self.parcels)
+        (parcelidx, featidx) = STRtree(geoms).query(targets, predicate = JOIN_PREDICATES[method])
+        return(reduce_values(len(self), parcelidx, featidx, values, how))
+
+    def class_areas(self, refs, classes, nclasses, how = 'max', refindex = None):
+        ''' Area of every parcel covered by each class of a classified
+        reference layer (e.g. soils by hydrologic soil group), from a single
+        traversal of the parcel index.
+
+        refs: reference polygons of all classes together.
+        classes: class number (0 ... nclasses - 1) of every reference polygon;
+            polygons with a negative class are ignored.
+
+        Returns a (parcels x nclasses) array, reduced over the reference
+        polygons of each class by 'max' or 'sum' (see overlap_area). '''
+        classes = np.asarray(classes)
+        (parcelidx, refidx, areas) = self.pieces(refs, refindex)
+        keep = classes[refidx] >= 0
+        cells = parcelidx[keep]*nclasses + classes[refidx[keep]]
+        return(reduce_by_parcel(len(self)*nclasses, cells, areas[keep], how).reshape(len(self), nclasses))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Parallel Executor
+Purpose:     Runs independent pieces of work (e.g. the per-municipality step
+             of parcel_combine.py) on a pool of worker processes.
+
+             Every task is a call module.function(*args) run in a fresh
+             worker process (one task per process), after "settings" (e.g.
+             the tool parameters of the script) have been set as globals of
+             the module. The worker imports the module by name, so the module
+             must not run its tool driver on import (keep it under
+             if __name__ == '__main__').
+
+             A task that raises is isolated: its error is recorded and the
+             other tasks go on. Failed tasks are retried up to "retries"
+             times. Results are returned in the order of the tasks, whatever
+             order the workers finish in, so merging them is deterministic.
+
+"""
+
+import importlib
+import multiprocessing
+import os
+import sys
+import traceback
+
+
+DEFAULT_RETRIES = 1
+
+
+def call_in_module(module, function, settings, args):
+    ''' Runs module.function(*args) after setting every item of the dict
+    "settings" as a global of the module. '''
+    mod = importlib.import_module(module)
+    for (name, value) in (settings or {}).items():
+        setattr(mod, name, value)
+    return(getattr(mod, function)(*args))
+
+def run_task(task):
+    ''' Worker entry point. "task" is (task number, module, function,
+    settings, args). Returns (task number, result, error message or None). '''
+    (k, module, function, settings, args) = task
+    try:
+        return(k, call_in_module(module, function, settings, args), None)
+    except Exception:
+        return(k, None, traceback.format_exc())
+
+def python_executable():
+    ''' Python interpreter for worker processes. Inside ArcMap or ArcCatalog,
+    sys.executable is the application itself, so the workers are started
+    with the pythonw.exe of the ArcGIS Python installation instead. '''
+    name = os.path.basename(sys.executable).lower()
+    if os.name == 'nt' and not name.startswith('python'):
+        return(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    return(sys.executable)
+
+def run_tasks(module, function, arglist, settings = None, processes = 1, retries = DEFAULT_RETRIES, log = None):
+    ''' Runs module.function(*args) for every "args" in "arglist".
+
+    processes: number of worker processes; 1 runs the tasks one after the
+        other in this process.
+    retries: number of times a failed task is run again.
+    log: optional function called with progress messages (e.g.
+        arcpy.AddMessage).
+
+    Returns (results, errors): the result of every task in the order of
+    "arglist" (None for tasks that failed every attempt), and a dict of the
+    last error message of every failed task, by task number. '''
+    results = [None]*len(arglist)
+    errors = dict()
+    pending = list(range(len(arglist)))
+
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt > 0 and log is not None:
+            log('Retrying ' + str(len(pending)) + ' failed task(s)')
+
+        tasks = [(k, module, function, settings, arglist[k]) for k in pending]
+        if processes > 1 and len(tasks) > 1:
+            if os.name == 'nt':
+                multiprocessing.set_executable(python_executable())
+            pool = multiprocessing.Pool(min(processes, len(tasks)), maxtasksperchild = 1)
+            try:
+                outcomes = list()
+                for outcome in pool.imap_unordered(run_task, tasks):
+                    outcomes.append(outcome)
+                    if log is not None:
+                        log('Finished task ' + str(outcome[0] + 1) + ' of ' + str(len(arglist)) + ('' if outcome[2] is None else ' (failed)'))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            outcomes = [run_task(task) for task in tasks]
+
+        pending = list()
+        for (k, result, error) in outcomes:
+            if error is None:
+                results[k] = result
+                errors.pop(k, None)
+            else:
+                errors[k] = error
+                pending.append(k)
+        pending.sort()
+
+    return(results, errors)
@@ -9,6 +9,8 @@ Created on Mon Dec  2 13:14:40 2019
 import arcpy
 import numpy as np
 
+from parcel_io import ensure_valid_geometry
+
 mxd = arcpy.mapping.MapDocument("CURRENT")
 
 ''' 
@@ -152,13 +154,5 @@ for k in range(len(muniparcelnames)):
     arcpy.Delete_management(muniparcelnames[k])
 
 # Repair geometry
-outtable = AutoName('geomtable')
-arcpy.AddMessage('Checking ' + outfile + ' geometry...')
-arcpy.CheckGeometry_management(outfile, outtable)
-
-    
-#Repair geometry problems
-arcpy.AddMessage('Repairing ' + outfile + ' geometry...')
-arcpy.RepairGeometry_management(outfile)
-arcpy.Delete_management(outtable)
+ensure_valid_geometry(outfile)
 
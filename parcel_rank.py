@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Ranking Kernels
+Purpose:     Percentile ranks used to compare parcels with each other in
+             nutrient_muni_percentile.py and prioritization.py. The percentile
+             of a parcel is one minus the fraction of parcels with a strictly
+             greater value, so tied parcels share the highest percentile of
+             their group. Ranks are computed by sorting, in O(N log N) time
+             and O(N) memory.
+
+"""
+
+import numpy as np
+
+
+def _epctile(values):
+    # Percentile of every entry of a 1-D float array. NaN entries never
+    # count as greater than another value and get a percentile of 1.0, but
+    # still count towards the number of parcels.
+    n = len(values)
+    valid = ~np.isnan(values)
+    ordered = np.sort(values[valid])
+
+    greater = len(ordered) - np.searchsorted(ordered, values, side = 'right')
+    greater[~valid] = 0
+
+    return(1.0 - (greater/float(n)))
+
+def epctile(array):
+    ''' Percentile rank of each value in "array": 1 - (number of values
+    strictly greater)/(number of values). Equivalent to
+    1.0 - (sum(array > array[n])/float(len(array))) for every n.
+
+    "array" may be 1-D, or 2-D with one criterion (e.g. TN, TP, TSS load)
+    per column, in which case every column is ranked separately. '''
+
+    values = np.asarray(array, dtype = float)
+    if values.ndim == 1:
+        return(_epctile(values))
+
+    pctiles = np.zeros(values.shape)
+    for k in range(values.shape[1]):
+        pctiles[:, k] = _epctile(values[:, k])
+
+    return(pctiles)
+
+def _grouped_epctile(values, codes, ngroups):
+    # Percentile of every entry of a 1-D float array within its group.
+    # "codes" holds the group number (0 ... ngroups - 1) of every entry.
+    counts = np.bincount(codes, minlength = ngroups)
+    valid = np.nonzero(~np.isnan(values))[0]
+
+    # Sort valid entries by group, then by value
+    order = valid[np.lexsort((values[valid], codes[valid]))]
+    sortedvals = values[order]
+    sortedcodes = codes[order]
+    m = len(order)
+
+    # Each run of equal (group, value) pairs ends at "runends"; everything
+    # after the run and before the end of the group's block is greater.
+    newrun = np.ones(m, dtype = bool)
+    newrun[1:] = (sortedcodes[1:] != sortedcodes[:-1]) | (sortedvals[1:] != sortedvals[:-1])
+    runid = np.cumsum(newrun) - 1
+    runends = np.append(np.nonzero(newrun)[0][1:], m)
+    groupends = np.cumsum(np.bincount(sortedcodes, minlength = ngroups))
+
+    greater = np.zeros(len(values), dtype = np.int64)
+    greater[order] = groupends[sortedcodes] - runends[runid]
+
+    return(1.0 - (greater/counts[codes].astype(float)))
+
+def grouped_epctile(array, groups):
+    ''' Percentile rank of each value within its group (e.g. municipality),
+    for every group at once. Within each group the result is identical to
+    epctile run on that group's values alone.
+
+    array: 1-D values, or 2-D with one criterion per column.
+    groups: group label (town name, town id, ...) of every row. '''
+
+    values = np.asarray(array, dtype = float)
+    (labels, codes) = np.unique(np.asarray(groups), return_inverse = True)
+    ngroups = len(labels)
+
+    if values.ndim == 1:
+        return(_grouped_epctile(values, codes, ngroups))
+
+    pctiles = np.zeros(values.shape)
+    for k in range(values.shape[1]):
+        pctiles[:, k] = _grouped_epctile(values[:, k], codes, ngroups)
+
+    return(pctiles)
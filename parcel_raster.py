@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Raster Overlay
+Purpose:     Approximate ("fast") parcel overlap attributes for screening
+             runs of parcel_combine.py. Parcels and reference layers are
+             rasterized onto a common grid, and the overlap of every parcel
+             with a layer is found by counting grid cells per parcel with
+             numpy.bincount, instead of intersecting polygons.
+
+             Zones are the parcel number of each cell (-1 outside parcels).
+             The fraction of a parcel covered by a layer is its number of
+             covered cells over its number of cells; areas are cell counts
+             times the cell area. This approximates the total overlap of the
+             parcel (the 'sum' reduction of parcel_overlay.py). Parcels with
+             no overlap, or too small to contain a cell centre, are null, as
+             with the exact overlay. The error of the approximation can be
+             measured on a sample of parcels with error_summary.
+
+"""
+
+import numpy as np
+
+
+DEFAULT_SAMPLE_SIZE = 500
+
+
+def zone_counts(zones, nzones, weights = None):
+    ''' Number of cells (or sum of "weights") of every zone 0 ... nzones - 1.
+    Cells with a negative zone are ignored. '''
+    zones = np.asarray(zones).ravel()
+    valid = zones >= 0
+    if weights is not None:
+        weights = np.asarray(weights, dtype = float).ravel()[valid]
+    return(np.bincount(zones[valid], weights = weights, minlength = nzones)[:nzones].astype(float))
+
+def zonal_fraction(zones, covered, nzones):
+    ''' Fraction of the cells of every zone where "covered" is True. Zones
+    without cells or without covered cells get NaN. '''
+    total = zone_counts(zones, nzones)
+    hits = zone_counts(zones, nzones, np.asarray(covered, dtype = bool))
+    fraction = np.full(nzones, np.nan)
+    found = hits > 0
+    fraction[found] = hits[found]/total[found]
+    return(fraction)
+
+def zonal_class_areas(zones, classes, nzones, nclasses, cellarea = 1.0):
+    ''' Area of every zone covered by each class (0 ... nclasses - 1) of a
+    classified raster, as a (zones x nclasses) array. Cells with a negative
+    class are ignored; zones with no cells of a class get NaN. '''
+    zones = np.asarray(zones).ravel()
+    classes = np.asarray(classes).ravel()
+    valid = (zones >= 0) & (classes >= 0) & (classes < nclasses)
+    cells = zones[valid].astype(np.int64)*nclasses + classes[valid]
+    counts = np.bincount(cells, minlength = nzones*nclasses)[:nzones*nclasses].reshape(nzones, nclasses)
+
+    areas = counts*float(cellarea)
+    areas[counts == 0] = np.nan
+    return(areas)
+
+def zone_lookup(values, ids, nodata = -1):
+    ''' Converts a raster of feature ids (e.g. object IDs) to positions in
+    "ids", e.g. parcel numbers in cursor order. Cells with ids not in "ids"
+    get -1. '''
+    values = np.asarray(values)
+    ids = np.asarray(ids)
+    if len(ids) == 0:
+        return(np.full(values.shape, -1, dtype = np.int64))
+    order = np.argsort(ids, kind = 'mergesort')
+    sortedids = ids[order]
+    pos = np.clip(np.searchsorted(sortedids, values), 0, len(ids) - 1)
+    found = (sortedids[pos] == values) & (values != nodata)
+    return(np.where(found, order[pos], -1))
+
+def sample_indices(n, size = DEFAULT_SAMPLE_SIZE, seed = 0):
+    ''' Sorted random sample of at most "size" of n parcels. '''
+    if n <= size:
+        return(np.arange(n))
+    rng = np.random.RandomState(seed)
+    return(np.sort(rng.choice(n, size, replace = False)))
+
+def error_summary(approx, exact):
+    ''' Error of approximate overlap values against exact ones on a sample.
+    Null values count as 0. Returns a dict with the mean, 95th percentile
+    and maximum absolute error and the number of parcels compared. '''
+    approx = np.nan_to_num(np.asarray(approx, dtype = float))
+    exact = np.nan_to_num(np.asarray(exact, dtype = float))
+    error = np.abs(approx - exact)
+    if len(error) == 0:
+        return({'n': 0, 'mean': np.nan, 'p95': np.nan, 'max': np.nan})
+    return({'n': len(error),
+            'mean': error.mean(),
+            'p95': np.percentile(error, 95),
+            'max': error.max()})
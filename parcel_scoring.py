@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Scoring Kernels
+Purpose:     Array-based scoring of prioritization criteria for
+             prioritization.py. Each function scores a whole criterion column
+             at once and reproduces the rules of the original row-by-row
+             scoring of prioritization.py:
+                 numeric:     thresholds are tested top-down with a strict
+                              ">"; values above none of them (including
+                              nulls) get the last weight.
+                 categorical: values equal to a category get its weight;
+                              values matching no category stay null (NaN).
+                 binary:      null, ' ' and 0 are "absent" and get the first
+                              weight; everything else gets the second.
+
+"""
+
+import numpy as np
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+CATTYPES = ['binary', 'categorical', 'numeric']
+
+
+def _as_strings(values):
+    # Returns a unicode array of "values" where entries that are not strings
+    # (nulls, numbers) are replaced by None, plus a mask of those entries.
+    values = np.asarray(values)
+    if values.dtype.kind in 'US':
+        return(values, np.zeros(len(values), dtype = bool))
+    if values.dtype.kind != 'O':
+        return(None, np.ones(len(values), dtype = bool))
+
+    notstr = np.frompyfunc(lambda x: not isinstance(x, string_types), 1, 1)(values).astype(bool)
+    strings = values.copy()
+    strings[notstr] = u''
+    return(strings.astype('U'), notstr)
+
+def score_numeric(values, threshs, weights):
+    ''' Scores a numeric criterion. "weights" holds one weight per group and
+    the first len(weights) - 1 entries of "threshs" are the thresholds
+    between groups, usually in descending order. '''
+
+    ngroups = len(weights)
+    if ngroups < 2:
+        raise ValueError('Criterion must have at least two groups')
+    t = np.array([float(th) for th in threshs[:ngroups - 1]])
+    w = np.asarray(weights, dtype = float)
+    values = np.asarray(values, dtype = float)
+
+    if np.all(t[:-1] >= t[1:]):
+        # Thresholds are in descending order: the group is the number of
+        # thresholds that the value does not exceed.
+        groups = len(t) - np.searchsorted(t[::-1], values, side = 'left')
+        groups[np.isnan(values)] = ngroups - 1
+        return(w[groups])
+
+    # Unordered thresholds: apply them bottom-up so the first match wins.
+    scores = np.full(len(values), w[-1])
+    with np.errstate(invalid = 'ignore'):
+        for k in range(len(t) - 1, -1, -1):
+            scores[values > t[k]] = w[k]
+    return(scores)
+
+def score_categorical(values, cats, weights):
+    ''' Scores a categorical criterion by mapping each value's category to
+    its weight. The mapping is compiled once and applied to every distinct
+    value, not to every parcel. '''
+
+    ngroups = len(weights)
+    if ngroups < 2:
+        raise ValueError('Criterion must have at least two categories')
+    cats = [str(c) for c in cats[:ngroups]]
+
+    # Code-to-weight table. The second category only applies if it differs
+    # from the first; later categories override earlier duplicates.
+    table = dict()
+    for k in range(ngroups):
+        if k == 1 and cats[1] == cats[0]:
+            continue
+        table[cats[k]] = float(weights[k])
+
+    scores = np.full(len(values), np.nan)
+    (strings, notstr) = _as_strings(values)
+    if strings is None or len(strings) == 0:
+        return(scores)
+
+    uniq, inverse = np.unique(strings, return_inverse = True)
+    uweights = np.array([table.get(u, np.nan) for u in uniq])
+    scores = uweights[inverse]
+    scores[notstr] = np.nan
+
+    return(scores)
+
+def score_binary(values, weights):
+    ''' Scores a presence/absence criterion. '''
+
+    w = np.asarray(weights, dtype = float)
+    values = np.asarray(values)
+    if values.dtype.kind == 'O':
+        absent = np.frompyfunc(lambda x: x is None or x == ' ' or x == 0, 1, 1)(values).astype(bool)
+    elif values.dtype.kind in 'US':
+        absent = (values == ' ')
+    else:
+        values = values.astype(float)
+        absent = np.isnan(values) | (values == 0)
+
+    return(np.where(absent, w[0], w[1]))
+
+def score_criterion(values, cattype, threshs, weights):
+    ''' Scores one whole criterion column. Raises ValueError if the
+    criterion is not set up correctly. '''
+
+    if cattype == 'numeric':
+        return(score_numeric(values, threshs, weights))
+    elif cattype == 'categorical':
+        return(score_categorical(values, threshs, weights))
+    elif cattype == 'binary':
+        return(score_binary(values, weights))
+    else:
+        raise ValueError('Category type (cattype) not recognized. Type must be "binary", "categorical", or "numeric." Check for typos or capitalization errors.')
+
+class ScoringPlan(object):
+    ''' Criteria of a prioritization entry form (the "Data_Entry" sheet),
+    compiled once so that every municipality can be scored with a single
+    read of its parcel table.
+
+    Only criteria with a nonzero weight are kept. For each one the plan
+    holds the parcel field, category type, thresholds/categories, group
+    weights, criterion weight and whether it is a soil (hsg*) criterion.
+    The priority score is the weighted sum of the non-soil criterion
+    scores plus the largest weighted soil score. '''
+
+    def __init__(self, fields, cattypes, threshs, weights, field_weights):
+        self.fields = [str(f) for f in fields]
+        self.cattypes = [str(c) for c in cattypes]
+        self.threshs = [[str(t) for t in th] for th in threshs]
+        self.weights = [np.asarray(w, dtype = float) for w in weights]
+        # Weights used to go through the field calculator as text
+        self.field_weights = np.array([float(str(w)) for w in field_weights])
+        self.soil = np.array([f.startswith('hsg') for f in self.fields], dtype = bool)
+        self.scrnames = [f + '_scr' for f in self.fields]
+
+    @classmethod
+    def from_entry_columns(cls, cols):
+        ''' Builds a plan from the columns of the entry form table, in
+        table order: index, criterion, field name, field weight, number of
+        groups, category type, 9 threshold/category columns and 9 group
+        weight columns. '''
+        field_name = cols[2]
+        field_weight = cols[3]
+        num_groups = cols[4]
+        cat_type = cols[5]
+        threshcols = cols[6:15]
+        weightcols = cols[15:]
+
+        fields = list()
+        cattypes = list()
+        threshs = list()
+        weights = list()
+        field_weights = list()
+        for k in range(len(field_name)):
+            if field_weight[k] == 0:
+                continue
+            ngroups = int(num_groups[k])
+            fields.append(field_name[k])
+            cattypes.append(cat_type[k])
+            threshs.append([col[k] for col in threshcols][0:ngroups])
+            weights.append([col[k] for col in weightcols][0:ngroups])
+            field_weights.append(field_weight[k])
+
+        return(cls(fields, cattypes, threshs, weights, field_weights))
+
+    def score(self, columns):
+        ''' Scores every criterion. "columns" maps each field in the plan to
+        its column of parcel values. Returns the list of score arrays, in
+        plan order, and a list of error messages for criteria that could
+        not be scored (their scores are left NaN). '''
+        scores = list()
+        errors = list()
+        for k in range(len(self.fields)):
+            values = columns[self.fields[k]]
+            try:
+                scores.append(score_criterion(values, self.cattypes[k], self.threshs[k], self.weights[k]))
+            except ValueError as e:
+                errors.append(self.fields[k] + ': ' + str(e))
+                scores.append(np.full(len(values), np.nan))
+
+        return(scores, errors)
+
+    def priority(self, scores):
+        ''' Combines criterion scores into the priority score. Parcels with a
+        null criterion score get a null (NaN) priority score. '''
+        pri = None
+        soilmax = None
+        for k in range(len(scores)):
+            weighted = scores[k]*self.field_weights[k]
+            if self.soil[k]:
+                soilmax = weighted if soilmax is None else np.maximum(soilmax, weighted)
+            else:
+                pri = weighted if pri is None else pri + weighted
+
+        if soilmax is not None:
+            pri = soilmax if pri is None else pri + soilmax
+
+        return(pri)
+
+    def evaluate(self, columns):
+        ''' Scores every criterion and the priority score in one go. Returns
+        (scores, pri_scr, errors). '''
+        (scores, errors) = self.score(columns)
+        return(scores, self.priority(scores), errors)
+
+class ThemeBatch(object):
+    ''' Several prioritization themes (e.g. TN, TP, TSS) evaluated together.
+
+    Criteria that are scored the same way in more than one theme (same
+    field, category type, thresholds and group weights) are scored once.
+    Criterion weights are held in a criteria x themes matrix, so a single
+    pass over the criterion scores gives the priority score of every
+    theme. For each theme the result is the same as its own ScoringPlan: a
+    criterion listed more than once in a theme adds up its weights, except
+    soil criteria, which keep a row per listing for the largest weighted
+    soil score. '''
+
+    def __init__(self, themes, plans):
+        if len(themes) != len(plans):
+            raise ValueError('Every theme must have one scoring plan')
+        for t in range(len(plans)):
+            if not plans[t].fields:
+                raise ValueError('Theme ' + str(themes[t]) + ' has no criteria with a nonzero weight')
+
+        self.themes = [str(t) for t in themes]
+        self.fields = list()
+        self.cattypes = list()
+        self.threshs = list()
+        self.weights = list()
+
+        index = dict()
+        cols = list()
+        for t in range(len(plans)):
+            plan = plans[t]
+            listed = dict()
+            for k in range(len(plan.fields)):
+                key = (plan.fields[k], plan.cattypes[k], tuple(plan.threshs[k]), tuple(plan.weights[k].tolist()))
+                if plan.soil[k]:
+                    listed[key] = listed.get(key, -1) + 1
+                    key = key + (listed[key],)
+                if key not in index:
+                    index[key] = len(self.fields)
+                    self.fields.append(plan.fields[k])
+                    self.cattypes.append(plan.cattypes[k])
+                    self.threshs.append(plan.threshs[k])
+                    self.weights.append(plan.weights[k])
+                cols.append((index[key], t, plan.field_weights[k]))
+
+        # Criterion weight of each scored criterion (rows) in each theme
+        # (columns), and whether the theme uses the criterion at all.
+        self.field_weights = np.zeros((len(self.fields), len(self.themes)))
+        self.used = np.zeros((len(self.fields), len(self.themes)), dtype = bool)
+        for (c, t, w) in cols:
+            self.field_weights[c, t] += w
+            self.used[c, t] = True
+        self.soil = np.array([f.startswith('hsg') for f in self.fields], dtype = bool)
+
+        # Score field of every criterion: <field>_scr as in ScoringPlan, and
+        # <field>_scr_<theme> (first theme using it) for a field scored in
+        # more than one way
+        self.scrnames = list()
+        for c in range(len(self.fields)):
+            name = self.fields[c] + '_scr'
+            if self.fields.count(self.fields[c]) > 1:
+                name = name + '_' + self.themes[np.nonzero(self.used[c])[0][0]]
+            while name in self.scrnames:
+                name = name + '_' + str(c)
+            self.scrnames.append(name)
+
+    def score(self, columns):
+        ''' Scores every distinct criterion once. See ScoringPlan.score. '''
+        scores = list()
+        errors = list()
+        for c in range(len(self.fields)):
+            values = columns[self.fields[c]]
+            try:
+                scores.append(score_criterion(values, self.cattypes[c], self.threshs[c], self.weights[c]))
+            except ValueError as e:
+                errors.append(self.fields[c] + ': ' + str(e))
+                scores.append(np.full(len(values), np.nan))
+
+        return(scores, errors)
+
+    def priority(self, scores):
+        ''' Priority scores of every parcel (rows) in every theme (columns). '''
+        nthemes = len(self.themes)
+        n = len(scores[0]) if scores else 0
+        pri = np.zeros((n, nthemes))
+        soilmax = np.zeros((n, nthemes))
+        hassoil = np.zeros(nthemes, dtype = bool)
+
+        for c in range(len(scores)):
+            used = self.used[c]
+            weighted = scores[c][:, np.newaxis]*self.field_weights[c]
+            if self.soil[c]:
+                first = used & ~hassoil
+                later = used & hassoil
+                soilmax[:, first] = weighted[:, first]
+                soilmax[:, later] = np.maximum(soilmax[:, later], weighted[:, later])
+                hassoil = hassoil | used
+            else:
+                pri[:, used] = pri[:, used] + weighted[:, used]
+
+        pri[:, hassoil] = pri[:, hassoil] + soilmax[:, hassoil]
+
+        return(pri)
+
+    def evaluate(self, columns):
+        ''' Returns (criterion scores, pri_scr matrix, errors). '''
+        (scores, errors) = self.score(columns)
+        return(scores, self.priority(scores), errors)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Load Sensitivity
+Purpose:     Monte Carlo / scenario analysis of parcel nutrient loads for
+             load_calc.py. The export rates of table_1_2 and luloadtable are
+             uncertain; this module evaluates K alternative sets of rates
+             (drawn from a distribution, or read from K alternative tables)
+             for every parcel and summarizes the parcel x K load matrix:
+             mean, standard deviation and percentiles of each parcel's load,
+             and how stable its percentile rank is across scenarios.
+
+             A load is a sum of (rate x area) terms, so every parcel is
+             described by the rate table cells it uses and the area each one
+             applies to, and the rates are the only thing that changes from
+             one scenario to the next. The parcel x K matrix is never held
+             in memory at once: statistics over scenarios are accumulated in
+             chunks of scenarios, and load percentiles in chunks of parcels,
+             sized so that the arrays of a chunk and their temporaries hold
+             at most "max_cells" values together.
+
+"""
+
+import numpy as np
+
+from parcel_loads import encode, SQFT_PER_ACRE
+from parcel_rank import epctile, grouped_epctile
+
+
+# Largest number of parcel x scenario values held in memory at once
+# (20 million float64 values is about 160 MB).
+DEFAULT_MAX_CELLS = 20000000
+
+# Parcel x scenario arrays alive at once while a chunk is summarized (loads,
+# rank values, percentile ranks and the temporaries of their statistics)
+CHUNK_ARRAYS = 5
+
+DEFAULT_QUANTILES = [0.05, 0.5, 0.95]
+
+
+def quantile_key(q):
+    ''' Statistic name of quantile "q" (a fraction): 'q' and the percent,
+    with two digits before an underscore for any decimals (0.05 -> 'q05',
+    0.025 -> 'q02_5', 0.975 -> 'q97_5'). '''
+
+    percent = ('%.6f' % (q*100)).rstrip('0').rstrip('.')
+    (whole, dot, decimals) = percent.partition('.')
+    return('q' + whole.zfill(2) + ('_' + decimals if decimals else ''))
+
+
+class LoadScenarios(object):
+    ''' Loads of every parcel under K alternative sets of export rates.
+
+    cells: (N, m) int array; the rate table cells (columns of "rates") each
+        parcel's load is made of, -1 where the parcel has no matching cell.
+    weights: (N, m) float array; the area (acres) each cell applies to.
+    rates: (K, ncells) float array; the rates of every cell in every scenario.
+    fill: rate used for missing cells (NaN leaves the load null, 0.0 ignores
+        the missing term).
+
+    The load of parcel n in scenario k is
+    sum_j rates[k, cells[n, j]] * weights[n, j]. '''
+
+    def __init__(self, cells, weights, rates, fill = np.nan):
+        self.cells = np.asarray(cells, dtype = np.int64)
+        self.weights = np.asarray(weights, dtype = float)
+        self.rates = np.asarray(rates, dtype = float)
+        self.fill = fill
+
+        # Missing cells point at an extra rate column holding "fill"
+        self.cells = np.where(self.cells < 0, self.rates.shape[1], self.cells)
+
+    def __len__(self):
+        return(len(self.cells))
+
+    @property
+    def nscenarios(self):
+        return(self.rates.shape[0])
+
+    def loads(self, scenarios = slice(None), parcels = slice(None)):
+        ''' Loads (lb/yr) of "parcels" under "scenarios", as a
+        (scenarios x parcels) array. '''
+        rates = self.rates[scenarios]
+        rates = np.hstack([rates, np.full((len(rates), 1), self.fill)])
+        cells = self.cells[parcels]
+        weights = self.weights[parcels]
+
+        loads = np.zeros((len(rates), len(cells)))
+        for j in range(cells.shape[1]):
+            term = rates[:, cells[:, j]]
+            term *= weights[:, j]
+            loads += term
+
+        return(loads)
+
+def lognormal_factors(nscenarios, nrates, cv, seed = None):
+    ''' Multiplicative rate factors for Monte Carlo scenarios, one row per
+    scenario. Factors are lognormal with a mean of 1.0 and a coefficient of
+    variation of "cv", so the rates stay positive and are unbiased. '''
+    sigma2 = np.log(1.0 + cv**2)
+    rng = np.random.RandomState(seed)
+    return(rng.lognormal(-sigma2/2.0, np.sqrt(sigma2), size = (nscenarios, nrates)))
+
+def scenario_count(runs, ntables):
+    ''' Number of scenarios of a sensitivity run, from the number of Monte
+    Carlo "runs" and the number of alternative tables of each kind given
+    ("ntables", 0 where none are given).
+
+    Every pollutant must be evaluated on the same scenarios, so they come
+    either from Monte Carlo draws or from the alternative tables (one
+    scenario per table), and every kind of table given must have the same
+    number of tables. Raises ValueError otherwise. '''
+    counts = sorted(set(n for n in ntables if n))
+    if len(counts) > 1:
+        raise ValueError('Every kind of alternative rate table given must have the same number of tables (got ' + ' and '.join(str(n) for n in ntables) + ')')
+    if counts and runs and runs != counts[0]:
+        raise ValueError('Scenarios come from either ' + str(runs) + ' Monte Carlo runs or ' + str(counts[0]) + ' alternative rate tables; leave the number of runs blank when tables are given')
+    return(counts[0] if counts else runs)
+
+def unit_area_scenarios(lutype, area_ft2, lutypes, rates):
+    ''' Scenarios for a pollutant estimated with the Unit Area Loading method.
+
+    lutype: land use type (Code_3_12) of every parcel.
+    area_ft2: parcel areas in square feet.
+    lutypes: land use types of the rate table, in the order of "rates".
+    rates: (K, len(lutypes)) unit area export rates (lb/acre/yr) in every
+        scenario. Parcels with a land use missing from the table get a null
+        load, as with the single load calculation. '''
+    cells = encode(lutype, lutypes)[:, np.newaxis]
+    acres = np.asarray(area_ft2, dtype = float)/SQFT_PER_ACRE
+    return(LoadScenarios(cells, acres[:, np.newaxis], rates))
+
+def align_prates(prates_list):
+    ''' Stacks compiled phosphorus rate matrices (see
+    parcel_loads.build_prate_matrix) from K alternative tables on the union
+    of their land use and HSG classes. Combinations missing from a table are
+    0.0, as with a single table. Returns (lutypes, hsgtypes, rates) with
+    rates of shape (K, land uses, HSG classes, 2). '''
+    lutypes = sorted(set(lu for prates in prates_list for lu in prates[0]))
+    hsgtypes = sorted(set(hsg for prates in prates_list for hsg in prates[1]))
+
+    rates = np.zeros((len(prates_list), len(lutypes), len(hsgtypes), 2))
+    for k in range(len(prates_list)):
+        (lus, hsgs, table) = prates_list[k]
+        lucodes = encode(lus, lutypes)
+        hsgcodes = encode(hsgs, hsgtypes)
+        rates[k][np.ix_(lucodes, hsgcodes)] = table
+
+    return(lutypes, hsgtypes, rates)
+
+def p_scenarios(lutype, hsgtype, area_ft2, impervpct, prates):
+    ''' Scenarios for phosphorus estimated with the EPA MS4 method (see
+    parcel_loads.calc_pexport): a pervious and an impervious term per parcel.
+    Parcels on unclassified ('UNC') soils are treated as 100% impervious.
+
+    prates: (lutypes, hsgtypes, rates) with rates of shape
+        (K, land uses, HSG classes, 2), e.g. from align_prates. '''
+    (lutypes, hsgtypes, rates) = prates
+    (nlu, nhsg) = rates.shape[1:3]
+
+    lucodes = encode(lutype, lutypes)
+    hsgcodes = encode(hsgtype, hsgtypes)
+    cell = (lucodes*nhsg + hsgcodes)*2
+    cell[(lucodes < 0) | (hsgcodes < 0)] = -1
+    cells = np.column_stack([cell, np.where(cell < 0, -1, cell + 1)])
+
+    acres = np.asarray(area_ft2, dtype = float)/SQFT_PER_ACRE
+    impervpct = np.asarray(impervpct, dtype = float)/100.0
+    impervpct = np.where(np.asarray(hsgtype).astype(str) == 'UNC', 1.0, impervpct)
+    weights = np.column_stack([(1.0 - impervpct)*acres, impervpct*acres])
+
+    return(LoadScenarios(cells, weights, rates.reshape(len(rates), nlu*nhsg*2), fill = 0.0))
+
+def _merge_moments(count, mean, m2, chunk):
+    # Adds the rows of "chunk" to running per-column counts, means and sums
+    # of squared deviations (Chan et al. parallel variance update).
+    n = len(chunk)
+    chunkmean = chunk.mean(axis = 0)
+    deviation = chunk - chunkmean
+    deviation **= 2
+    chunkm2 = deviation.sum(axis = 0)
+    del deviation
+
+    total = count + n
+    delta = chunkmean - mean
+    mean = mean + delta*(n/float(total))
+    m2 = m2 + chunkm2 + delta**2*(count*n/float(total))
+
+    return(total, mean, m2)
+
+def summarize(scenarios,
+              acres = None,
+              groups = None,
+              quantiles = DEFAULT_QUANTILES,
+              top = 0.9,
+              max_cells = DEFAULT_MAX_CELLS):
+    ''' Per-parcel statistics of the loads in "scenarios" (LoadScenarios).
+
+    acres: parcel areas in acres. When given, parcels are ranked on their
+        load per acre (as in nutrient_muni_percentile.py), otherwise on their
+        total load.
+    groups: optional group (municipality) of every parcel; parcels are then
+        ranked within their group.
+    quantiles: load percentiles to report, as fractions.
+    top: percentile rank that counts as a "top" parcel (0.9 = top decile).
+    max_cells: largest number of parcel x scenario values held at once,
+        counting temporary arrays (see CHUNK_ARRAYS).
+
+    Returns a dict of arrays: 'mean' and 'std' of the load, 'q<percent>' for
+    every quantile (see quantile_key), and the rank stability statistics
+    'pct_mean' and 'pct_std' (mean and standard deviation of the percentile
+    rank) and
+    'p_top' (fraction of scenarios in which the parcel ranks in the top).
+    Parcels with a null load get null statistics. '''
+
+    keys = [quantile_key(q) for q in quantiles]
+    if len(set(keys)) < len(keys):
+        raise ValueError('Quantiles must be distinct (got ' + ', '.join(str(q) for q in quantiles) + ')')
+
+    n = len(scenarios)
+    k = scenarios.nscenarios
+    if acres is not None:
+        acres = np.asarray(acres, dtype = float)
+
+    # 1. Chunks of scenarios over all parcels: moments of loads and ranks
+    count = 0
+    loadmean = np.zeros(n)
+    loadm2 = np.zeros(n)
+    pctmean = np.zeros(n)
+    pctm2 = np.zeros(n)
+    ntop = np.zeros(n)
+
+    step = max(1, max_cells//(CHUNK_ARRAYS*max(n, 1)))
+    for start in range(0, k, step):
+        loads = scenarios.loads(slice(start, start + step))
+        if acres is not None:
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                rankvalues = loads/acres
+        else:
+            rankvalues = loads
+        if groups is None:
+            pctiles = epctile(rankvalues.T).T
+        else:
+            pctiles = grouped_epctile(rankvalues.T, groups).T
+        del rankvalues
+
+        (total, loadmean, loadm2) = _merge_moments(count, loadmean, loadm2, loads)
+        (total, pctmean, pctm2) = _merge_moments(count, pctmean, pctm2, pctiles)
+        count = total
+        ntop += (pctiles >= top).sum(axis = 0)
+
+    # Null loads are ranked like any value; their rank statistics are null
+    null = np.isnan(loadmean)
+    stats = {'mean': loadmean,
+             'std': np.sqrt(loadm2/float(k)),
+             'pct_mean': np.where(null, np.nan, pctmean),
+             'pct_std': np.where(null, np.nan, np.sqrt(pctm2/float(k))),
+             'p_top': np.where(null, np.nan, ntop/float(k))}
+
+    # 2. Chunks of parcels over all scenarios: percentiles of loads
+    for key in keys:
+        stats[key] = np.zeros(n)
+    step = max(1, max_cells//(CHUNK_ARRAYS*max(k, 1)))
+    for start in range(0, n, step):
+        parcels = slice(start, start + step)
+        loads = scenarios.loads(parcels = parcels)
+        for (key, q) in zip(keys, quantiles):
+            stats[key][parcels] = np.percentile(loads, q*100, axis = 0)
+
+    return(stats)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Parcel Tiles
+Purpose:     Load-balanced spatial partition of a parcel layer, as an
+             alternative to partitioning the work by municipality (where
+             Boston takes many times longer than Dover).
+
+             Parcels are ordered along a Hilbert curve by their centroids
+             (see spatial_cache.hilbert_index) and the curve is cut into
+             runs of about equal total cost, the cost of a parcel being a
+             fixed overhead plus its number of vertices. Every run is a
+             compact tile. A parcel belongs to exactly one tile, the one of
+             its centroid, so no parcel is cut at a tile boundary.
+
+             The extent of a tile covers all of its parcels; with a margin,
+             it is the area of the reference layers the tile needs.
+             Statistics by municipality are computed afterwards by grouping
+             the tiles' parcels on their municipality field.
+
+"""
+
+import numpy as np
+
+from spatial_cache import hilbert_index
+
+
+# Cost of a parcel besides its vertices, in vertices
+FEATURE_COST = 50
+
+DEFAULT_TILES_PER_PROCESS = 4
+
+
+def parcel_cost(vertices, feature_cost = FEATURE_COST):
+    ''' Processing cost of every parcel from its number of vertices. '''
+    return(feature_cost + np.asarray(vertices, dtype = float))
+
+def tile_partition(x, y, cost, ntiles):
+    ''' Tile number (0 ... tiles - 1) of every parcel from its centroid (x, y)
+    and cost. Tiles are numbered along the Hilbert curve and hold about equal
+    total costs; there are at most "ntiles" tiles, and none are empty.
+    Parcels without a centroid (null shapes) go to tile 0. '''
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    cost = np.asarray(cost, dtype = float)
+    tiles = np.zeros(len(x), dtype = np.int64)
+    valid = np.nonzero(~(np.isnan(x) | np.isnan(y)))[0]
+    if len(valid) == 0 or ntiles <= 1:
+        return(tiles)
+
+    extent = (x[valid].min(), y[valid].min(), x[valid].max(), y[valid].max())
+    d = hilbert_index(x[valid], y[valid], extent)
+    order = valid[np.argsort(d, kind = 'mergesort')]
+
+    # A parcel goes to the tile in which the middle of its cost falls
+    ordercost = cost[order]
+    mid = np.cumsum(ordercost) - ordercost/2.0
+    total = max(mid[-1] + ordercost[-1]/2.0, 1e-12)
+    tile = np.minimum((mid/total*ntiles).astype(np.int64), ntiles - 1)
+
+    # Renumber without empty tiles
+    tiles[order] = np.unique(tile, return_inverse = True)[1]
+    return(tiles)
+
+def tile_extents(bounds, tiles, margin = 0.0):
+    ''' Extent (xmin, ymin, xmax, ymax) of every tile from the (N, 4)
+    bounding boxes of its parcels, grown by "margin" map units on every
+    side. Returns a (tiles, 4) array. '''
+    bounds = np.asarray(bounds, dtype = float).reshape(-1, 4)
+    tiles = np.asarray(tiles, dtype = np.int64)
+    ntiles = tiles.max() + 1 if len(tiles) else 0
+    extents = np.full((ntiles, 4), np.nan)
+    if ntiles == 0:
+        return(extents)
+
+    order = np.argsort(tiles, kind = 'mergesort')
+    sortedtiles = tiles[order]
+    starts = np.nonzero(np.r_[True, sortedtiles[1:] != sortedtiles[:-1]])[0]
+    for (col, reduce, sign) in [(0, np.fmin, -1), (1, np.fmin, -1), (2, np.fmax, 1), (3, np.fmax, 1)]:
+        extents[sortedtiles[starts], col] = reduce.reduceat(bounds[order, col], starts) + sign*margin
+    return(extents)
+
+def tile_summary(tiles, cost):
+    ''' Number of parcels and total cost of every tile, and the imbalance of
+    the partition (largest tile cost over the mean tile cost). '''
+    tiles = np.asarray(tiles, dtype = np.int64)
+    ntiles = tiles.max() + 1 if len(tiles) else 0
+    counts = np.bincount(tiles, minlength = ntiles)
+    costs = np.bincount(tiles, weights = np.asarray(cost, dtype = float), minlength = ntiles)
+    imbalance = costs.max()/costs.mean() if ntiles else np.nan
+    return(counts, costs, imbalance)
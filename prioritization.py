@@ -21,6 +21,9 @@ import numpy as np
 from numpy.lib.recfunctions import rec_append_fields
 import os
 
+from parcel_rank import epctile, grouped_epctile
+from parcel_scoring import ScoringPlan, ThemeBatch
+
 mxd = arcpy.mapping.MapDocument("CURRENT")
 
 workspace = arcpy.GetParameterAsText(0)
@@ -41,6 +44,29 @@ table = arcpy.GetParameterAsText(2)     # This table includes categorizations,
 theme = arcpy.GetParameterAsText(3)     # Short (ideally < 3 character) descriptive 
                                         # string identifying priority theme
 #theme = 'TN'
+
+sheets = arcpy.GetParameterAsText(4)    # Optional: entry form sheet of each theme
+                                        # (default "Data_Entry"). Script-only: not
+                                        # in the toolbox, see README.md.
+                                        
+# Batch mode: several themes, separated by semicolons, are scored together.
+# "table" then lists one workbook per theme (or a single workbook whose
+# "sheets" hold the themes).
+themes = [t.strip() for t in theme.split(';') if t.strip()] or [theme]
+tables = [t.strip() for t in table.split(';') if t.strip()]
+sheets = [s.strip() for s in sheets.split(';') if s.strip()]
+if len(tables) == 1: tables = tables*len(themes)
+if len(sheets) <= 1: sheets = (sheets or ['Data_Entry'])*len(themes)
+if len(tables) != len(themes) or len(sheets) != len(themes):
+    arcpy.AddError('ERROR: Give one entry table, or one per theme, and one sheet, or one per theme (' +
+                   str(len(themes)) + ' themes, ' + str(len(tables)) + ' tables, ' + str(len(sheets)) + ' sheets)')
+    raise arcpy.ExecuteError('Number of entry tables or sheets does not match the themes')
+
+# Fields removed from the rank tables
+dropfields = ["TN_pctile_scr", "TP_pctile_scr", "TSS_pctile_scr", "aulsite_scr",
+              "hsgtype_scr", "OBJECTID_1", "Shape_1", "Shape_2", "LU_type",
+              "Code_3_12", "Code_1_2", "Code_Parcel_Database", 
+              "Desc_Parcel_Database", "Desc_full"]
                                         
 
 
@@ -83,312 +109,114 @@ def join_table_shapefile(table, tablefield, shapefile, shapefield, outputname):
 
     return(outputname)
     
-def calc_catscr(parcels, fieldname, cattype, threshs, weights):
-    
-#    print(fieldname)
+def compile_plan(table):
+    # Reads the entry form table once and compiles its criteria into a
+    # scoring plan that can be evaluated on any number of parcel tables
+    cols = [[r[0] for r in arcpy.da.SearchCursor(table, field.name)] for field in arcpy.ListFields(table)]
+    plan = ScoringPlan.from_entry_columns(cols)
     
-    def findindex(table, fieldname):
-        ''' Function from https://gis.stackexchange.com/questions/101540/finding-the-index-of-a-field-with-its-name-using-arcpy
-        to find the index of a table's fields from the field name '''
-        return [i.name for i in arcpy.ListFields(table)].index(fieldname)
-
-    num_groups = len(threshs)
-    threshs = [str(t) for t in threshs]
+    for k in range(len(plan.fields)):
+        arcpy.AddMessage(plan.fields[k] + ' ' + str(plan.soil[k]))
     
-    # Add a new field for the categorization score
-    scrname = fieldname + '_scr'
-    arcpy.AddField_management(parcels, scrname, 'DOUBLE')
+    return(plan)
     
-    # Go through and calculate new value based on  original score and table cats
-    fields = [fieldname, scrname]
-    with arcpy.da.UpdateCursor(parcels, fields) as cursor:
-        for row in cursor:
-            if cattype == 'categorical':
-                threshs = [str(t) for t in threshs]
-                if num_groups >= 2:
-                    if row[0] == threshs[0]:
-                        row[1] = weights[0]
-                    elif row[0] == threshs[1]:
-                        row[1] = weights[1]
-                        
-                    if num_groups > 2:
-                        if row[0] == threshs[2]:
-                            row[1] = weights[2]
-                        else:
-                            pass
-                        
-                        if num_groups > 3:
-                            if row[0] == threshs[3]:
-                                row[1] = weights[3]
-                            else:
-                                pass
-                        
-                            if num_groups > 4:
-                                if row[0] == threshs[4]:
-                                    row[1] = weights[4]
-                                else:
-                                    pass
-                        
-                                if num_groups > 5:
-                                    if row[0] == threshs[5]:
-                                        row[1] = weights[5]
-                                    else:
-                                        pass
-                        
-                                    if num_groups > 6:
-                                        if row[0] == threshs[6]:
-                                            row[1] = weights[6]
-                                        else:
-                                            pass
-                        
-                                        if num_groups > 7:
-                                            if row[0] == threshs[7]:
-                                                row[1] = weights[7]
-                                            else:
-                                                pass
-                        
-                                            if num_groups > 8:
-                                                if row[0] == threshs[8]:
-                                                    row[1] = weights[8]
-                                                else:
-                                                    pass
-                                            else:   # Pair: if 8
-                                                pass
-                                        else:   # Pair: if 7
-                                            pass
-                                    else:   # Pair: if 6
-                                        pass   
-                                else:    # Pair: if 5
-                                    pass
-                            else:   # Pair: if 4
-                                pass
-                        else:   # Pair: if 3
-                            pass
-                    else:   # Pair: if 2
-                        pass
-                else:
-                    arcpy.AddMessage('ERROR: Criterion must have at least two categories')
-                    
-            elif cattype == 'numeric':
-                threshs = [float(t) for t in threshs]
-                if num_groups == 2:
-                    if row[0] > threshs[0]:
-                        row[1] = weights[0]
-#                        print(weights[0])
-                    else:
-                        row[1] = weights[1]
-#                        print(weights[1])
-                elif num_groups == 3:
-                    if row[0] > threshs[0]:
-                        row[1] = weights[0]
-                    elif row[0] > threshs[1]:
-                        row[1] = weights[1]
-                    else:
-                        row[1] = weights[2]
-                elif num_groups == 4:
-                    if row[0] > threshs[0]:
-                        row[1] = weights[0]
-                    elif row[0] > threshs[1]:
-                        row[1] = weights[1]
-                    elif row[0] > threshs[2]:
-                        row[1] = weights[2]
-                    else:
-                        row[1] = weights[3]
-                elif num_groups == 5:
-                    if row[0] > threshs[0]:
-                        row[1] = weights[0]
-                    elif row[0] > threshs[1]:
-                        row[1] = weights[1]
-                    elif row[0] > threshs[2]:
-                        row[1] = weights[2]
-                    elif row[0] > threshs[3]:
-                        row[1] = weights[3]
-                    else:
-                        row[1] = weights[4]
-                elif num_groups == 6:
-                    if row[0] > threshs[0]:
-                        row[1] = weights[0]
-                    elif row[0] > threshs[1]:
-                        row[1] = weights[1]
-                    elif row[0] > threshs[2]:
-                        row[1] = weights[2]
-                    elif row[0] > threshs[3]:
-                        row[1] = weights[3]
-                    elif row[0] > threshs[4]:
-                        row[1] = weights[4]
-                    else:
-                        row[1] = weights[5]
-                elif num_groups == 7:
-                    if row[0] > threshs[0]:
-                        row[1] = weights[0]
-                    elif row[0] > threshs[1]:
-                        row[1] = weights[1]
-                    elif row[0] > threshs[2]:
-                        row[1] = weights[2]
-                    elif row[0] > threshs[3]:
-                        row[1] = weights[3]
-                    elif row[0] > threshs[4]:
-                        row[1] = weights[4]
-                    elif row[0] > threshs[5]:
-                        row[1] = weights[5]
-                    else:
-                        row[1] = weights[6]
-                elif num_groups == 8:
-                    if row[0] > threshs[0]:
-                        row[1] = weights[0]
-                    elif row[0] > threshs[1]:
-                        row[1] = weights[1]
-                    elif row[0] > threshs[2]:
-                        row[1] = weights[2]
-                    elif row[0] > threshs[3]:
-                        row[1] = weights[3]
-                    elif row[0] > threshs[4]:
-                        row[1] = weights[4]
-                    elif row[0] > threshs[5]:
-                        row[1] = weights[5]
-                    elif row[0] > threshs[6]:
-                        row[1] = weights[6]
-                    else:
-                        row[1] = weights[7]
-                else:
-                    arcpy.AddMessage('ERROR: Number of thresholds is not an integer between 1 and 8')
-                    
-            elif cattype == 'binary':
-                threshs = [str(t) for t in threshs]
-                if row[0] is None or row[0] == ' ' or row[0] == 0:
-                    row[1] = weights[0]
-                else:
-                    row[1] = weights[1]
-            else:
-                arcpy.AddMessage('ERROR: Category type (cattype) not recognized. Type must be "binary", "categorical", or "numeric." Check for typos or capitalization errors.')
-            cursor.updateRow(row)
-            
-    return(scrname)
-    
-def prioritize_parcels(parcels, fieldnames, scrnames, field_weight, soilind):
-    ''' Updates "parcels".'''
+def categorizebmp(parcellyr, plan):
+    # Function to convert original values of criteria in parcel database to 
+    # score-relevant values based on the compiled entry form ("plan"), and
+    # combine them into a prioritization score. Reads the criteria in one
+    # pass over "parcellyr" and writes all score fields in another.
     
-    # Add a new field for the categorization score
-    arcpy.AddField_management(parcels, 'pri_scr', 'DOUBLE')
+    fields = sorted(set(plan.fields))
+    rows = [row for row in arcpy.da.SearchCursor(parcellyr, fields)]
+    columns = dict()
+    for k in range(len(fields)):
+        columns[fields[k]] = np.array([row[k] for row in rows], dtype = object)
+    del rows
     
-    # Calculate normalized weights
-    total_weight = np.sum(field_weight)
+    (scores, pri, errors) = plan.evaluate(columns)
+    for error in errors:
+        arcpy.AddMessage('ERROR: ' + error)
     
-    namelist = list()
-    soillist = list()
+    # Add the score fields and fill them in a single pass. Unscored
+    # parcels (NaN) are left null.
+    outfields = plan.scrnames + ['pri_scr']
+    outvalues = scores + [pri]
+    for name in outfields:
+        arcpy.AddField_management(parcellyr, name, 'DOUBLE')
     
-    # Calculate the normalized weight for all criteria
-    for k in range(len(fieldnames)):
-        if field_weight[k] == 0:
-            pass
-        else:
-            # # Add a weight field and normalize by total weight
-            # wtfld = str(fieldnames[k]) + '_wt'
-            # # soillist.append(soilind[k])
-            # namelist.append(wtfld)
-            # expr_type = "PYTHON"
-            # expr = str(field_weight[k]) + '*(1.0/' + str(total_weight) + ')'
-            # arcpy.AddField_management(parcels, wtfld, 'DOUBLE')
-            # arcpy.CalculateField_management(parcels, wtfld, expr, expr_type)
-            # Add a weight field
-            wtfld = str(fieldnames[k]) + '_wt'
-            # soillist.append(soilind[k])
-            namelist.append(wtfld)
-            expr_type = "PYTHON"
-            expr = str(field_weight[k])
-            arcpy.AddField_management(parcels, wtfld, 'DOUBLE')
-            arcpy.CalculateField_management(parcels, wtfld, expr, expr_type)
+    j = 0
+    with arcpy.da.UpdateCursor(parcellyr, outfields) as cursor:
+        for row in cursor:
+            for k in range(len(outvalues)):
+                if not np.isnan(outvalues[k][j]):
+                    row[k] = outvalues[k][j]
+            j = j + 1
+            cursor.updateRow(row)
             
-    arcpy.AddMessage(str(namelist))
-    arcpy.AddMessage(str(soillist))
-    
-    # add prioritization field
-    expr_pri = ''
-    expr_soil = 'max(['
-    for k in range(len(namelist)):
-        if soilind[k]:
-            # If a soil field, add to the list of soil fields.
-            expr_soil = expr_soil + '!' + scrnames[k] + '!*!' + namelist[k] + '!, '
-        else:
-            # If not, add to the calculation.
-            expr_pri = expr_pri + ' + ' + '!' + scrnames[k] + '!*!' + namelist[k] + '!'
-    
-    # Done with list: Take max of soil fields.
-    
-    expr_soil = expr_soil[:-2]  # Strip last comma and space
-    expr_soil = expr_soil + '])'# Conclude the "Max"
-    if sum(soilind) == 0: 
-        # If all soils weighted 0, don't add them to score.
-        expr_pri = expr_pri[3:]     # Strip ' + ' from front of expr_pri.
-    else:
-        expr_pri = expr_pri[3:]     # Strip ' + ' from front of expr_pri.
-        expr_pri = expr_pri + ' + ' + expr_soil
-
-    arcpy.AddMessage(expr_pri)
-    arcpy.CalculateField_management(parcels, 'pri_scr', expr_pri, expr_type)
+    return()
     
-    # remove unneeded fields
-    for k in range(len(namelist)):
-        arcpy.DeleteField_management(parcels, namelist[k])
+def prioritize_batch(parcels, outfile, townnames, themes, plans, groupfield = 'muni'):
+    # Scores every theme in "plans" from a single read of the parcel table.
+    # Writes one table, "outfile", with the parcels of all municipalities in
+    # "townnames", the criterion score fields (see ThemeBatch.scrnames) and a
+    # pri_scr_<theme> and pri_pct_<theme> field per theme.
+    # Percentiles are calculated within each municipality, as in the single
+    # theme results. Like the single theme rank tables, the rows are sorted
+    # by municipality and then by percentile, of the first theme in
+    # "themes" (one order cannot follow the rank of every theme).
+    batch = ThemeBatch(themes, plans)
     
-    return()
+    # Copy the attributes of all requested municipalities to a working table
+    delimfield = arcpy.AddFieldDelimiters(parcels, groupfield)
+    names = ["'" + name.replace("'", "''") + "'" for name in townnames]
+    scoretable = AutoName(os.path.basename(outfile) + '_unsorted')
+    arcpy.TableToTable_conversion(parcels, workspace, os.path.basename(scoretable), delimfield + ' IN (' + ', '.join(names) + ')')
     
-def categorizebmp(parcellyr, table):
-    # Function to convert original values of criteria in parcel database to 
-    # score-relevant values based on user-defined table
+    # One read of the criteria of all themes
+    fields = sorted(set(batch.fields))
+    rows = [row for row in arcpy.da.SearchCursor(scoretable, fields + [groupfield])]
+    columns = dict()
+    for k in range(len(fields)):
+        columns[fields[k]] = np.array([row[k] for row in rows], dtype = object)
+    groups = np.array([row[-1] or '' for row in rows])
+    del rows
     
-    numcats = arcpy.GetCount_management(table)
-    numcats = int(numcats[0])
+    (scores, pri, errors) = batch.evaluate(columns)
+    for error in errors:
+        arcpy.AddMessage('ERROR: ' + error)
     
-    cols = [[r[0] for r in arcpy.da.SearchCursor(table, field.name)] for field in arcpy.ListFields(table)]
-#    inds = cols[0]
-#    criteria = cols[1]
-    field_name = cols[2]
-    field_weight = cols[3]
-    num_groups = cols[4]
-    cat_type = cols[5]
-    threshs = np.concatenate([np.array(i) for i in cols[6:15]])
-    threshs = np.reshape(threshs, (numcats, 9), order = 'F')    # use rows-first indexing (Fortran-like)
+    # Null scores rank as 0, like in the single theme rank tables
+    pct = grouped_epctile(np.where(np.isnan(pri), 0.0, pri), groups)
     
-    weights = np.concatenate([np.array(i) for i in cols[15:]])
-    weights = np.reshape(weights, (numcats, 9), order = 'F')    # Fortran-like indexing
+    # Criterion scores, then every theme's priority score and percentile.
+    # Unscored parcels (NaN) are left null.
+    outfields = [arcpy.ValidateFieldName(name, workspace) for name in batch.scrnames]
+    outvalues = list(scores)
+    for t in range(len(batch.themes)):
+        outfields = outfields + [arcpy.ValidateFieldName('pri_scr_' + batch.themes[t], workspace),
+                                 arcpy.ValidateFieldName('pri_pct_' + batch.themes[t], workspace)]
+        outvalues = outvalues + [pri[:, t], pct[:, t]]
+    for name in outfields:
+        arcpy.AddField_management(scoretable, name, 'DOUBLE')
     
-    # Ensure soils correctly accounted for
-    scrnames = list()
-    numsoils = np.zeros(numcats, dtype = bool)
-    deleteinds = list()
-    for k in range(numcats):
-        weight = field_weight[k]        
-        if weight == 0:
-            deleteinds.append(k)
-        else:       # Calculate categories for that field
-            fieldname = str(field_name[k])
-            if fieldname.startswith('hsg'): numsoils[k] = True
-            arcpy.AddMessage(fieldname + ' ' + str(numsoils[k]))
-            cattype = str(cat_type[k])
-            ngroups = num_groups[k]
-            threshs_crit = threshs[k,0:ngroups]
-            weights_crit = weights[k,0:ngroups]
-            scrname = calc_catscr(parcellyr, fieldname, cattype, threshs_crit, weights_crit)
-            scrnames.append(scrname)
-            
-    numsoils = np.delete(numsoils, deleteinds)
+    # Write all the fields in a single pass
+    j = 0
+    with arcpy.da.UpdateCursor(scoretable, outfields) as cursor:
+        for row in cursor:
+            for k in range(len(outvalues)):
+                if not np.isnan(outvalues[k][j]):
+                    row[k] = outvalues[k][j]
+            j = j + 1
+            cursor.updateRow(row)
     
-    # scrnames = np.asarray(scrnames) # Convert to a numpy array for easier handling.
-    # soilscores = np.multiply(scrnames, numsoils)    # Multiply by array with 1 at soil scores to convert others to 0
-    # maxind = np.max(soilscores)         # Get index where highest absolute value score is located
-    # arcpy.AddMessage(str(soilscores))
-    # arcpy.AddMessage(str(maxind))
-    # numsoils = numsoils - maxind                # Convert the array indexing soil scores to indexing soil scores we do not want to keep
-    # keepinds = numsoils == False                # Invert that array so that it indexes all the scores (not just soil scores) we DO want to keep
-    # scrnames = np.multiply(scrnames, keepinds)      # Multiply previous array element-wise by previous so that only one soil score remains alongside other scores
+    # Rank-sort and export, the same way as the single theme rank tables
+    new_table = arcpy.da.TableToNumPyArray(scoretable, '*', null_value = 0)
+    new_table = new_table[np.lexsort((pct[:, 0], groups))]
+    arcpy.da.NumPyArrayToTable(new_table, os.path.join(workspace, os.path.basename(outfile)))
+    arcpy.Delete_management(scoretable)
+    arcpy.DeleteField_management(outfile, dropfields)
     
-    # # Convert back to a list.
-    # scrnames = scrnames.tolist()
-            
-    prioritize_parcels(parcellyr, field_name, scrnames, field_weight, numsoils) # Adds prioritization score to each parcel
-            
-    return()
+    return(outfile)
     
 def importallsheets(in_excel, out_gdb):
     # Function taken from ESRI documentation http://pro.arcgis.com/en/pro-app/tool-reference/conversion/excel-to-table.htm
@@ -417,10 +245,16 @@ def importallsheets(in_excel, out_gdb):
 Begin the Calculations
 
 '''
-# 0. Convert excel table to esri table
-entrytable = AutoName('entryform')
-result = arcpy.ExcelToTable_conversion(table, entrytable, "Data_Entry")
-entrytable = result.getOutput(0)
+# 0. Convert excel table(s) to esri table(s)
+entrytables = dict()
+plans = list()
+for k in range(len(themes)):
+    if (tables[k], sheets[k]) not in entrytables:
+        entrytable = AutoName('entryform')
+        result = arcpy.ExcelToTable_conversion(tables[k], entrytable, sheets[k])
+        entrytables[(tables[k], sheets[k])] = compile_plan(result.getOutput(0))
+    plans.append(entrytables[(tables[k], sheets[k])])
+plan = plans[0]
 
 
 # 1. Select records from only desired muni
@@ -429,52 +263,53 @@ townnames = unique_values(parcels, 'muni')
 townnames = [x.title() for x in townnames]
 townnames_caps = [x.upper() for x in townnames]
 
-muniparcelnames = list()
-for k in range(len(townnames_caps)):
-    muni = townnames[k]
-    muniname = AutoName('parcels' + muni)
-    arcpy.Select_analysis(parcels, muniname, "muni = '" + muni + "'")
-    arcpy.AddMessage("Working with " + muni + " parcels")
-
-    # 2. Calculate scores for each criterion by threshold
-    outname = AutoName('bmpcats_' + muniname)
-    categorizebmp(muniname, entrytable) #outname
-    arcpy.AddMessage("Categorized " + muni + " bmp criteria")
-
-    # 3. Calculate percentiles, sort, and export to table
-    parceltable = arcpy.da.TableToNumPyArray(muniname, '*', null_value = 0)
-
-    nparcels = len(parceltable['pri_scr'])
-    pripct = list()
-    for j in range(nparcels):
-        pripct.append(1.0 - (np.sum(parceltable['pri_scr'] > parceltable['pri_scr'][j])/float(nparcels)))
+if len(themes) > 1:
+    # Batch mode: all themes from one read of the parcel table
+    arcpy.AddMessage("Scoring themes " + ', '.join(themes))
+    outfile = AutoName('Parcels_' + '_'.join(themes))
+    prioritize_batch(parcels, outfile, townnames, themes, plans)
+    arcpy.AddMessage("Finished scoring all municipalities")
+
+else:
+    muniparcelnames = list()
+    for k in range(len(townnames_caps)):
+        muni = townnames[k]
+        muniname = AutoName('parcels' + muni)
+        arcpy.Select_analysis(parcels, muniname, "muni = '" + muni + "'")
+        arcpy.AddMessage("Working with " + muni + " parcels")
     
-    new_table = rec_append_fields(parceltable, 'pri_pct', data = pripct, dtypes = '<f8')
-    new_table = new_table[new_table['pri_pct'].argsort()]
-
-    ranktable = AutoName(muni + '_rnkst')
-    out_table = os.path.join(workspace, os.path.basename(ranktable))
-    arcpy.da.NumPyArrayToTable(new_table, out_table)
-    muniparcelnames.append(out_table)
-    arcpy.Delete_management(muniname)
-    arcpy.AddMessage("Finished scoring " + muni + " parcels")
+        # 2. Calculate scores for each criterion by threshold
+        outname = AutoName('bmpcats_' + muniname)
+        categorizebmp(muniname, plan) #outname
+        arcpy.AddMessage("Categorized " + muni + " bmp criteria")
     
+        # 3. Calculate percentiles, sort, and export to table
+        parceltable = arcpy.da.TableToNumPyArray(muniname, '*', null_value = 0)
     
-## Create an empty feature class with the desired schema
-outfile = AutoName('Parcels_' + theme)
-arcpy.CreateTable_management(workspace, outfile, muniparcelnames[0])
-
-# Append all municipal files onto empty feature class with appropriate schema
-arcpy.AddMessage("Re-merging municipalities")
-arcpy.Append_management(muniparcelnames, outfile, schema_type = "TEST")
-
-dropfields = ["TN_pctile_scr", "TP_pctile_scr", "TSS_pctile_scr", "aulsite_scr",
-              "hsgtype_scr", "OBJECTID_1", "Shape_1", "Shape_2", "LU_type",
-              "Code_3_12", "Code_1_2", "Code_Parcel_Database", 
-              "Desc_Parcel_Database", "Desc_full"]
-arcpy.DeleteField_management(outfile, dropfields)
-
-for k in range(len(muniparcelnames)):
-    arcpy.Delete_management(muniparcelnames[k])
+        pripct = epctile(parceltable['pri_scr'])
+        
+        new_table = rec_append_fields(parceltable, 'pri_pct', data = pripct, dtypes = '<f8')
+        new_table = new_table[new_table['pri_pct'].argsort()]
+    
+        ranktable = AutoName(muni + '_rnkst')
+        out_table = os.path.join(workspace, os.path.basename(ranktable))
+        arcpy.da.NumPyArrayToTable(new_table, out_table)
+        muniparcelnames.append(out_table)
+        arcpy.Delete_management(muniname)
+        arcpy.AddMessage("Finished scoring " + muni + " parcels")
+        
+        
+    ## Create an empty feature class with the desired schema
+    outfile = AutoName('Parcels_' + themes[0])
+    arcpy.CreateTable_management(workspace, outfile, muniparcelnames[0])
+    
+    # Append all municipal files onto empty feature class with appropriate schema
+    arcpy.AddMessage("Re-merging municipalities")
+    arcpy.Append_management(muniparcelnames, outfile, schema_type = "TEST")
+    
+    arcpy.DeleteField_management(outfile, dropfields)
+    
+    for k in range(len(muniparcelnames)):
+        arcpy.Delete_management(muniparcelnames[k])
 
 
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Name:        Spatial Index Cache
+Purpose:     Packed R-tree spatial indexes of parcel and reference layers,
+             kept in a local cache directory between runs.
+
+             A PackedRTree is a static, bulk-loaded R-tree stored in a few
+             flat numpy arrays: the bounding boxes of the layer's features
+             sorted along a Hilbert curve, and the bounding boxes of every
+             group of "node_size" boxes above them, level by level. Because it
+             is only arrays, it can be saved with numpy and loaded again
+             memory-mapped, without rebuilding anything.
+
+             SpatialIndexCache keys every index by a fingerprint of the
+             layer's state, from metadata that is cheap to read (see
+             layer_fingerprint and parcel_io.layer_key), so a layer that has
+             not changed since the last run (e.g. statewide soils, wetlands
+             or Zone II areas) gets its index straight from disk, and a
+             changed layer gets a new one. A manifest records the size of
+             every index and when it was last used; when the cache grows
+             beyond its disk budget, the least recently used indexes are
+             removed. Several processes may use the cache at once: indexes
+             are moved into place whole, and the manifest is merged with the
+             one on disk when it is saved.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from json_files import load_json, save_json
+
+
+DEFAULT_NODE_SIZE = 16
+
+# Disk budget of the cache, in MB
+DEFAULT_BUDGET = 2048
+
+MANIFEST = 'manifest.json'
+
+# Names of index folders (see SpatialIndexCache.path), and prefix of the
+# folders indexes are written to before they are moved into place
+INDEX_FOLDER = re.compile('^[0-9a-f]{40}_n[0-9]+$')
+PARTIAL_PREFIX = 'partial_'
+
+# Number of query boxes traversed through the tree at once
+DEFAULT_QUERY_CHUNK = 10000
+
+HILBERT_ORDER = 16
+
+INDEX_ARRAYS = ['boxes', 'levels', 'order']
+
+
+def hilbert_index(x, y, extent, order = HILBERT_ORDER):
+    ''' Position along a Hilbert curve of the points (x, y) on a
+    2^order x 2^order grid covering "extent" (xmin, ymin, xmax, ymax).
+    Nearby points get nearby positions. '''
+    (xmin, ymin, xmax, ymax) = extent
+    n = 2**order
+    width = max(xmax - xmin, 1e-12)
+    height = max(ymax - ymin, 1e-12)
+    xi = np.clip(((np.asarray(x, dtype = float) - xmin)/width*(n - 1)), 0, n - 1).astype(np.int64)
+    yi = np.clip(((np.asarray(y, dtype = float) - ymin)/height*(n - 1)), 0, n - 1).astype(np.int64)
+
+    d = np.zeros(len(xi), dtype = np.int64)
+    s = n//2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s*s*((3*rx) ^ ry)
+        # Rotate the quadrant so that the curve stays continuous
+        flip = ~ry
+        mirror = flip & rx
+        xi[mirror] = n - 1 - xi[mirror]
+        yi[mirror] = n - 1 - yi[mirror]
+        (xi[flip], yi[flip]) = (yi[flip], xi[flip].copy())
+        s = s//2
+
+    return(d)
+
+def layer_fingerprint(key):
+    ''' Fingerprint of a layer from "key", a JSON-serializable description
+    of its state that changes when the layer does (e.g. its
+    parcel_io.layer_key and the spatial reference it is read in). '''
+    return(hashlib.sha1(json.dumps(key, sort_keys = True).encode('utf-8')).hexdigest())
+
+def folder_size(folder):
+    ''' Total size in bytes of the files of "folder". '''
+    return(sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)))
+
+
+class PackedRTree(object):
+    ''' Static R-tree over the bounding boxes of a layer's features.
+
+    boxes: (nodes, 4) xmin, ymin, xmax, ymax of every node, leaves first.
+    levels: start of every level in "boxes", plus the total number of nodes.
+    order: feature number of every leaf. '''
+
+    def __init__(self, boxes, levels, order, node_size = DEFAULT_NODE_SIZE):
+        self.boxes = boxes
+        self.levels = np.asarray(levels, dtype = np.int64)
+        self.order = order
+        self.node_size = node_size
+
+    def __len__(self):
+        return(len(self.order))
+
+    @classmethod
+    def build(cls, bounds, node_size = DEFAULT_NODE_SIZE):
+        ''' Bulk-loads the tree from the (N, 4) bounding boxes of a layer.
+        Features with null (NaN) bounds are left out. '''
+        bounds = np.asarray(bounds, dtype = float).reshape(-1, 4)
+        valid = np.nonzero(~np.isnan(bounds).any(axis = 1))[0]
+        if len(valid) == 0:
+            return(cls(np.zeros((0, 4)), [0, 0], np.zeros(0, dtype = np.int64), node_size))
+
+        leaves = bounds[valid]
+        extent = (leaves[:, 0].min(), leaves[:, 1].min(), leaves[:, 2].max(), leaves[:, 3].max())
+        d = hilbert_index((leaves[:, 0] + leaves[:, 2])/2.0, (leaves[:, 1] + leaves[:, 3])/2.0, extent)
+        sort = np.argsort(d, kind = 'mergesort')
+        order = valid[sort]
+
+        levelboxes = [leaves[sort]]
+        while len(levelboxes[-1]) > 1:
+            child = levelboxes[-1]
+            starts = np.arange(0, len(child), node_size)
+            parent = np.column_stack([np.minimum.reduceat(child[:, 0], starts),
+                                      np.minimum.reduceat(child[:, 1], starts),
+                                      np.maximum.reduceat(child[:, 2], starts),
+                                      np.maximum.reduceat(child[:, 3], starts)])
+            levelboxes.append(parent)
+
+        levels = np.cumsum([0] + [len(b) for b in levelboxes])
+        return(cls(np.vstack(levelboxes), levels, order, node_size))
+
+    def _query_chunk(self, qboxes):
+        # Walks the candidate (query, node) pairs down the tree, one level
+        # at a time, keeping the pairs whose boxes intersect.
+        top = len(self.levels) - 2
+        nodes = np.arange(self.levels[top], self.levels[top + 1])
+        qidx = np.repeat(np.arange(len(qboxes)), len(nodes))
+        nidx = np.tile(nodes, len(qboxes))
+
+        for level in range(top, -1, -1):
+            q = qboxes[qidx]
+            b = self.boxes[nidx]
+            hit = (q[:, 0] <= b[:, 2]) & (q[:, 2] >= b[:, 0]) & (q[:, 1] <= b[:, 3]) & (q[:, 3] >= b[:, 1])
+            qidx = qidx[hit]
+            nidx = nidx[hit]
+            if level == 0:
+                break
+
+            # Children of node j of this level are nodes j*node_size ...
+            # (j + 1)*node_size - 1 of the level below
+            first = (nidx - self.levels[level])*self.node_size
+            count = np.minimum(self.node_size, (self.levels[level] - self.levels[level - 1]) - first)
+            qidx = np.repeat(qidx, count)
+            offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+            nidx = self.levels[level - 1] + np.repeat(first, count) + offsets
+
+        return(qidx, np.asarray(self.order)[nidx - self.levels[0]])
+
+    def query(self, bounds, chunk_size = DEFAULT_QUERY_CHUNK):
+        ''' Candidate pairs of query boxes and features whose bounding boxes
+        intersect. "bounds" is an (M, 4) array of query boxes. Returns
+        (query index, feature index) arrays. '''
+        bounds = np.asarray(bounds, dtype = float).reshape(-1, 4)
+        if len(self) == 0 or len(bounds) == 0:
+            return(np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64))
+
+        qidx = list()
+        fidx = list()
+        for start in range(0, len(bounds), chunk_size):
+            (q, f) = self._query_chunk(bounds[start:start + chunk_size])
+            qidx.append(q + start)
+            fidx.append(f)
+
+        return(np.concatenate(qidx), np.concatenate(fidx))
+
+    def save(self, directory):
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), np.asarray(getattr(self, name)))
+
+    @classmethod
+    def load(cls, directory, node_size = DEFAULT_NODE_SIZE, mmap_mode = 'r'):
+        arrays = dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode = mmap_mode)) for name in INDEX_ARRAYS)
+        return(cls(arrays['boxes'], np.array(arrays['levels']), arrays['order'], node_size))
+
+
+class SpatialIndexCache(object):
+    ''' Directory of PackedRTree indexes keyed by layer fingerprint.
+
+    directory: cache folder; it is created when needed.
+    node_size: R-tree fan-out. Indexes are only reused with the same
+        node size.
+    budget: disk budget in MB. '''
+
+    def __init__(self, directory, node_size = DEFAULT_NODE_SIZE, budget = DEFAULT_BUDGET):
+        self.directory = directory
+        self.node_size = node_size
+        self.budget = budget
+        self.manifest = os.path.join(directory, MANIFEST)
+        self.entries = load_json(self.manifest, dict())
+        self.removed = set()
+
+    def path(self, fingerprint):
+        return(os.path.join(self.directory, fingerprint + '_n' + str(self.node_size)))
+
+    def complete(self, path):
+        ''' Whether index folder "path" holds every array of an index (an
+        index removed while memory-mapped elsewhere may be partly left). '''
+        return(all(os.path.exists(os.path.join(path, name + '.npy')) for name in INDEX_ARRAYS))
+
+    def get(self, fingerprint):
+        ''' Cached index of a layer, loaded memory-mapped, or None. '''
+        path = self.path(fingerprint)
+        if not self.complete(path):
+            return(None)
+        tree = PackedRTree.load(path, self.node_size)
+        self.record(os.path.basename(path))
+        self.save()
+        return(tree)
+
+    def put(self, fingerprint, tree):
+        ''' Saves "tree" under "fingerprint", and removes least recently
+        used indexes (other than this one) while the cache is over its
+        budget. The index is written to a temporary folder first and moved
+        into place, so that an interrupted run never leaves a partial index
+        behind. '''
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(fingerprint)
+        tempdir = tempfile.mkdtemp(prefix = PARTIAL_PREFIX, dir = self.directory)
+        tree.save(tempdir)
+        if os.path.isdir(path) and not self.complete(path):
+            shutil.rmtree(path, ignore_errors = True)
+        try:
+            os.rename(tempdir, path)
+        except OSError:
+            # Another run stored the same index first
+            shutil.rmtree(tempdir, ignore_errors = True)
+        self.record(os.path.basename(path))
+        self.evict(keep = os.path.basename(path))
+        self.save()
+        return(PackedRTree.load(path, self.node_size))
+
+    def index(self, key, bounds):
+        ''' Index of the layer with state "key" (see layer_fingerprint) and
+        (N, 4) "bounds", from the cache when the layer is unchanged,
+        otherwise built and stored. Returns (fingerprint, tree). '''
+        fingerprint = layer_fingerprint(key)
+        tree = self.get(fingerprint)
+        if tree is None:
+            tree = self.put(fingerprint, PackedRTree.build(bounds, self.node_size))
+        return(fingerprint, tree)
+
+    def record(self, name, used = None):
+        ''' Records the size of index folder "name" and when it was used
+        (default: now). '''
+        self.entries[name] = {'size': folder_size(os.path.join(self.directory, name)),
+                              'used': time.time() if used is None else used}
+        self.removed.discard(name)
+
+    def size(self):
+        ''' Total size of the cached indexes, in bytes. '''
+        return(sum(entry['size'] for entry in self.entries.values()))
+
+    def evict(self, keep = None):
+        ''' Removes the least recently used indexes, except "keep", until
+        the cache fits in its budget. '''
+        budget = self.budget*2**20
+        for name in sorted(self.entries, key = lambda k: self.entries[k]['used']):
+            if self.size() <= budget:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors = True)
+            del self.entries[name]
+            self.removed.add(name)
+
+    def sweep(self):
+        ''' Brings the manifest in line with the cache folder when no other
+        process is using the cache (e.g. before starting worker processes):
+        removes the folders of interrupted writes, records index folders the
+        manifest does not know (stored by a process whose save was lost),
+        forgets indexes that are gone and applies the budget. Only folders
+        named like indexes, or partial indexes, are touched, so the cache
+        can share a folder with other data. '''
+        if not os.path.isdir(self.directory):
+            return
+        names = os.listdir(self.directory)
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+            if name.startswith(PARTIAL_PREFIX):
+                shutil.rmtree(path, ignore_errors = True)
+            elif INDEX_FOLDER.match(name) and name not in self.entries:
+                self.record(name, os.path.getmtime(path))
+        for name in [name for name in self.entries if name not in names]:
+            del self.entries[name]
+            self.removed.add(name)
+        self.evict()
+        self.save()
+
+    def save(self):
+        ''' Writes the manifest (see json_files.save_json), merged with the
+        one on disk, which other processes using the cache may have changed
+        since it was read. '''
+        entries = load_json(self.manifest, dict())
+        for (name, entry) in self.entries.items():
+            if name not in entries or entry['used'] >= entries[name]['used']:
+                entries[name] = entry
+        for name in self.removed:
+            entries.pop(name, None)
+        self.entries = entries
+        try:
+            save_json(self.manifest, entries)
+        except OSError:
+            # Another process is swapping the manifest at the same time; the
+            # changes are kept for the next save
+            return
+        self.removed = set()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the pure-numpy kernels against naive references on small arrays.
+None of them need arcpy; run them with "python -m pytest tests" from the
+repository folder.
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
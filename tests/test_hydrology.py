@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import heapq
+
+import numpy as np
+import pytest
+
+import hydrology
+
+
+DIRECTIONS = dict(zip(hydrology.D8_CODES, hydrology.D8_OFFSETS))
+
+
+def random_dem(rng, t):
+    shape = (rng.randint(2, 25), rng.randint(2, 25))
+    if t % 2:
+        dem = rng.randint(0, 6, size = shape).astype(float)
+    else:
+        dem = rng.rand(*shape)*5
+    if t % 3 == 0:
+        dem[rng.rand(*shape) < 0.1] = np.nan
+    return(dem)
+
+def naive_fill(dem):
+    # Cell by cell Priority-Flood from the edge and NaN cells
+    z = dem.astype(float)
+    (nr, nc) = z.shape
+    nodata = np.isnan(z)
+    closed = nodata.copy()
+    heap = []
+    for i in range(nr):
+        for j in range(nc):
+            if nodata[i, j]:
+                continue
+            edge = i in (0, nr - 1) or j in (0, nc - 1) or \
+                any(nodata[i + dr, j + dc] for (dr, dc) in hydrology.D8_OFFSETS)
+            if edge:
+                heapq.heappush(heap, (z[i, j], i, j))
+                closed[i, j] = True
+    while heap:
+        (level, i, j) = heapq.heappop(heap)
+        for (dr, dc) in hydrology.D8_OFFSETS:
+            (a, b) = (i + dr, j + dc)
+            if 0 <= a < nr and 0 <= b < nc and not closed[a, b]:
+                closed[a, b] = True
+                z[a, b] = max(z[a, b], level)
+                heapq.heappush(heap, (z[a, b], a, b))
+    return(z)
+
+def downstream_cell(direction, i, j):
+    # Next cell along the flow direction, or None where flow leaves the
+    # raster or stops
+    code = int(direction[i, j])
+    if code not in DIRECTIONS:
+        return(None)
+    (dr, dc) = DIRECTIONS[code]
+    (a, b) = (i + dr, j + dc)
+    if not (0 <= a < direction.shape[0] and 0 <= b < direction.shape[1]):
+        return(None)
+    if direction[a, b] == hydrology.NODATA_DIRECTION:
+        return(None)
+    return((a, b))
+
+def naive_accumulation(direction, weight):
+    total = np.zeros(direction.shape)
+    for (i, j) in zip(*np.nonzero(direction != hydrology.NODATA_DIRECTION)):
+        cell = downstream_cell(direction, i, j)
+        while cell is not None:
+            total[cell] += weight[i, j]
+            cell = downstream_cell(direction, *cell)
+    return(total)
+
+def naive_watershed(direction, pour, nodata):
+    out = np.full(direction.shape, nodata, dtype = np.int64)
+    for (i, j) in zip(*np.nonzero(direction != hydrology.NODATA_DIRECTION)):
+        cell = (i, j)
+        while cell is not None and pour[cell] == nodata:
+            cell = downstream_cell(direction, *cell)
+        if cell is not None:
+            out[i, j] = pour[cell]
+    return(out)
+
+def naive_snap(accumulation, rows, cols, radius):
+    snapped = ([], [])
+    for (r, c) in zip(rows, cols):
+        best = None
+        for (i, j) in zip(*np.nonzero(accumulation >= 0)):
+            d = (i - r)**2 + (j - c)**2
+            if d <= radius**2 and (best is None or (-accumulation[i, j], d) < best[0]):
+                best = ((-accumulation[i, j], d), i, j)
+        snapped[0].append(r if best is None else best[1])
+        snapped[1].append(c if best is None else best[2])
+    return(snapped)
+
+
+@pytest.mark.parametrize('t', range(30))
+def test_fill_matches_priority_flood(t):
+    dem = random_dem(np.random.RandomState(t), t)
+    filled = hydrology.fill(dem)
+    expected = naive_fill(dem)
+    assert np.array_equal(np.isnan(filled), np.isnan(expected))
+    assert np.allclose(filled[~np.isnan(filled)], expected[~np.isnan(expected)])
+
+def test_fill_z_limit_leaves_deep_sinks():
+    dem = np.full((7, 12), 10.0)
+    dem[1:6, 1:5] = 9.0
+    dem[3, 2] = 4.0       # 6 below its pour point
+    dem[1:6, 7:11] = 9.6
+    dem[3, 8] = 9.2       # 0.8 below its pour point
+    filled = hydrology.fill(dem, 1)
+    assert filled[3, 2] == 4.0
+    assert (filled[1:6, 1:5][dem[1:6, 1:5] == 9.0] == 9.0).all()
+    assert (filled[:, 6:] == 10.0).all()
+    assert np.array_equal(hydrology.fill(dem), np.full(dem.shape, 10.0))
+
+@pytest.mark.parametrize('t', range(20))
+def test_flow_direction_drains_filled_dem(t):
+    dem = random_dem(np.random.RandomState(100 + t), t)
+    filled = hydrology.fill(dem)
+    direction = hydrology.flow_direction(filled)
+    nodata = np.isnan(filled)
+    assert (direction[nodata] == hydrology.NODATA_DIRECTION).all()
+    assert (direction[~nodata] != 0).all()
+    for (i, j) in zip(*np.nonzero(~nodata)):
+        # Downhill or level, and every path leaves the raster
+        (cell, steps) = (downstream_cell(direction, i, j), 0)
+        if cell is not None:
+            assert filled[cell] <= filled[i, j]
+        while cell is not None:
+            cell = downstream_cell(direction, *cell)
+            steps += 1
+            assert steps <= direction.size
+
+def test_flow_direction_follows_steepest_descent():
+    dem = np.random.RandomState(1).rand(30, 30)
+    direction = hydrology.flow_direction(dem)
+    neighbour = hydrology.steepest_neighbour(dem)
+    lower = neighbour >= 0
+    assert (direction[lower] == np.array(hydrology.D8_CODES)[neighbour[lower]]).all()
+
+@pytest.mark.parametrize('t', range(20))
+@pytest.mark.parametrize('threads', [1, 3])
+def test_flow_accumulation_matches_path_walk(t, threads):
+    rng = np.random.RandomState(200 + t)
+    dem = random_dem(rng, t)
+    direction = hydrology.flow_direction(hydrology.fill(dem, 1 if t % 2 else None))
+    valid = direction != hydrology.NODATA_DIRECTION
+
+    count = hydrology.flow_accumulation(direction, threads = threads)
+    assert (count[~valid] == -1).all()
+    assert np.array_equal(count[valid], naive_accumulation(direction, np.ones(dem.shape))[valid])
+
+    weight = rng.rand(*dem.shape)
+    weight[rng.rand(*dem.shape) < 0.1] = np.nan
+    total = hydrology.flow_accumulation(direction, weight, threads = threads)
+    assert np.isnan(total[~valid]).all()
+    assert np.allclose(total[valid], naive_accumulation(direction, np.nan_to_num(weight))[valid], atol = 1e-4)
+
+@pytest.mark.parametrize('t', range(20))
+def test_snap_and_watershed_match_naive(t):
+    rng = np.random.RandomState(300 + t)
+    dem = random_dem(rng, t)
+    direction = hydrology.flow_direction(hydrology.fill(dem, 1 if t % 2 else None))
+    accumulation = hydrology.flow_accumulation(direction)
+
+    n = rng.randint(1, 6)
+    rows = rng.randint(0, dem.shape[0], n)
+    cols = rng.randint(0, dem.shape[1], n)
+    radius = rng.rand()*4
+    (srows, scols) = hydrology.snap_pour_points(accumulation, rows, cols, radius)
+    (nrows, ncols) = naive_snap(accumulation, rows, cols, radius)
+    # Cells at the same distance with the same accumulation are equivalent
+    for k in range(n):
+        assert accumulation[srows[k], scols[k]] == accumulation[nrows[k], ncols[k]]
+        assert (srows[k] - rows[k])**2 + (scols[k] - cols[k])**2 == (nrows[k] - rows[k])**2 + (ncols[k] - cols[k])**2
+
+    nodata = np.iinfo(np.int32).min
+    pour = np.full(dem.shape, nodata, dtype = np.int32)
+    pour[srows, scols] = np.arange(n) + 1
+    assert np.array_equal(hydrology.watershed(direction, pour, nodata), naive_watershed(direction, pour, nodata))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pytest
+
+import hydrology
+import hydrology_tiles
+
+
+@pytest.fixture(autouse = True)
+def small_tiles(monkeypatch):
+    monkeypatch.setattr(hydrology_tiles, 'MIN_TILE_SIZE', 3)
+
+def random_dem(rng, t):
+    shape = (rng.randint(4, 30), rng.randint(4, 30))
+    if t % 2:
+        dem = rng.randint(0, 6, size = shape).astype(float)
+    else:
+        dem = rng.rand(*shape).cumsum(0) + rng.rand(*shape)*3
+    if t % 3 == 0:
+        dem[rng.rand(*shape) < 0.1] = np.nan
+    if t % 4 == 1:
+        # A flat crossing tiles
+        dem[2:-2, 2:-2] = 2.0
+    if t % 5 == 0:
+        dem = dem.astype(np.float32)
+    return(dem)
+
+def tile_memory(rng):
+    # Memory budget of tiles of 3 to 11 cells a side
+    size = rng.randint(3, 12)
+    return(size**2*hydrology_tiles.BYTES_PER_CELL/2.0**20)
+
+
+@pytest.mark.parametrize('t', range(20))
+def test_tiled_matches_in_memory(t, tmp_path):
+    rng = np.random.RandomState(t)
+    dem = random_dem(rng, t)
+    memory = tile_memory(rng)
+    scratch = str(tmp_path)
+
+    for z_limit in (None, 1):
+        expected = hydrology.fill(dem, z_limit)
+        filled = np.zeros(dem.shape, dem.dtype)
+        hydrology_tiles.fill(dem, filled, z_limit, memory, scratch)
+        assert np.array_equal(np.isnan(filled), np.isnan(expected))
+        assert np.allclose(filled[~np.isnan(filled)], expected[~np.isnan(expected)])
+
+    filled = hydrology.fill(dem, 1 if t % 2 else None)
+    expected = hydrology.flow_direction(filled)
+    direction = np.zeros(dem.shape, np.uint8)
+    hydrology_tiles.flow_direction(filled, direction, memory, scratch)
+    assert np.array_equal(direction, expected)
+
+    weight = rng.rand(*dem.shape).astype(np.float32)
+    for w in (None, weight):
+        expected = hydrology.flow_accumulation(direction, w)
+        accumulation = np.zeros(dem.shape, expected.dtype)
+        hydrology_tiles.flow_accumulation(direction, accumulation, w, memory, scratch)
+        assert np.allclose(accumulation, expected, equal_nan = True, rtol = 1e-5)
+
+    nodata = np.iinfo(np.int32).min
+    pour = np.full(dem.shape, nodata, dtype = np.int32)
+    n = rng.randint(1, 6)
+    pour[rng.randint(0, dem.shape[0], n), rng.randint(0, dem.shape[1], n)] = np.arange(n)
+    basins = np.zeros(dem.shape, np.int32)
+    hydrology_tiles.watershed(direction, pour, basins, nodata, memory, scratch)
+    assert np.array_equal(basins, hydrology.watershed(direction, pour, nodata))
+    assert os.listdir(scratch) == []
+
+def test_tiled_on_disk_arrays(tmp_path):
+    rng = np.random.RandomState(0)
+    folder = str(tmp_path)
+    path = lambda name: os.path.join(folder, name + '.npy')
+    dem = hydrology_tiles.create_array(path('dem'), (60, 50), np.float32)
+    dem[:] = (rng.rand(60, 50)*3).astype(np.float32).cumsum(0) + rng.rand(60, 50).astype(np.float32)*10
+    memory = 12**2*hydrology_tiles.BYTES_PER_CELL/2.0**20
+
+    filled = hydrology_tiles.create_array(path('fill'), dem.shape, np.float32)
+    hydrology_tiles.fill(hydrology_tiles.open_array(path('dem')), filled, None, memory)
+    direction = hydrology_tiles.create_array(path('direction'), dem.shape, np.uint8)
+    hydrology_tiles.flow_direction(filled, direction, memory)
+    accumulation = hydrology_tiles.create_array(path('accumulation'), dem.shape, np.int32)
+    hydrology_tiles.flow_accumulation(direction, accumulation, None, memory)
+
+    expected = hydrology.fill(np.array(dem))
+    assert np.allclose(filled, expected)
+    assert np.array_equal(direction, hydrology.flow_direction(expected))
+    assert np.array_equal(accumulation, hydrology.flow_accumulation(np.array(direction)))
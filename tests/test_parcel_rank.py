@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from parcel_rank import epctile, grouped_epctile
+
+
+def naive_epctile(values):
+    # 1 - (number of values strictly greater)/(number of values); NaN is
+    # never greater and is ranked 1.0
+    values = np.asarray(values, dtype = float)
+    valid = values[~np.isnan(values)]
+    return(np.array([1.0 if np.isnan(v) else 1.0 - np.sum(valid > v)/float(len(values)) for v in values]))
+
+def random_values(rng, n):
+    # Integer values so that ties are common, and some nulls
+    values = rng.randint(0, 10, n).astype(float)
+    values[rng.rand(n) < 0.1] = np.nan
+    return(values)
+
+
+@pytest.mark.parametrize('t', range(10))
+def test_epctile_matches_naive(t):
+    rng = np.random.RandomState(t)
+    values = random_values(rng, rng.randint(1, 60))
+    assert np.allclose(epctile(values), naive_epctile(values))
+
+def test_epctile_ranks_columns_separately():
+    rng = np.random.RandomState(0)
+    values = np.column_stack([random_values(rng, 40) for k in range(3)])
+    expected = np.column_stack([naive_epctile(values[:, k]) for k in range(3)])
+    assert np.allclose(epctile(values), expected)
+
+@pytest.mark.parametrize('t', range(10))
+def test_grouped_epctile_matches_per_group_loop(t):
+    rng = np.random.RandomState(t)
+    n = rng.randint(1, 80)
+    values = np.column_stack([random_values(rng, n) for k in range(2)])
+    groups = np.array(['Boston', 'Dover', 'Milton', 'Quincy'])[rng.randint(0, 4, n)]
+
+    expected = np.zeros(values.shape)
+    for group in np.unique(groups):
+        rows = groups == group
+        for k in range(values.shape[1]):
+            expected[rows, k] = naive_epctile(values[rows, k])
+
+    assert np.allclose(grouped_epctile(values, groups), expected)
+    assert np.allclose(grouped_epctile(values[:, 0], groups), expected[:, 0])
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from parcel_scoring import ScoringPlan, ThemeBatch, score_binary, score_categorical, score_numeric
+
+
+def entry_columns(fields, field_weights, threshs, weights, cattypes = None):
+    # Columns of an entry form with one row per criterion (see
+    # ScoringPlan.from_entry_columns)
+    m = len(fields)
+    ngroups = [len(w) for w in weights]
+    cattypes = cattypes or ['numeric']*m
+    threshcols = [[th[g] if g < len(th) else None for th in threshs] for g in range(9)]
+    weightcols = [[w[g] if g < len(w) else None for w in weights] for g in range(9)]
+    return([list(range(m)), ['criterion']*m, fields, field_weights, ngroups, cattypes] + threshcols + weightcols)
+
+
+def test_score_numeric_matches_first_exceeded_threshold():
+    rng = np.random.RandomState(0)
+    values = rng.rand(200)*10
+    values[::13] = np.nan
+    values[:3] = [7.5, 5, 2.5]
+    weights = [3, 2, 1, 0]
+    # Descending and unordered thresholds
+    for threshs in ([7.5, 5, 2.5], [2.5, 7.5, 5]):
+        expected = []
+        for v in values:
+            # The first threshold exceeded, in list order, wins
+            hits = [k for k in range(3) if v > threshs[k]]
+            expected.append(weights[hits[0]] if hits else weights[-1])
+        assert np.array_equal(score_numeric(values, threshs, weights), expected)
+
+def test_score_categorical_and_binary():
+    values = np.array(['R', 'C', None, 'I', 'R', 5], dtype = object)
+    scores = score_categorical(values, ['R', 'C', 'I'], [3, 2, 1])
+    assert np.allclose(scores[[0, 1, 3, 4]], [3, 2, 1, 3])
+    assert np.isnan(scores[[2, 5]]).all()
+
+    assert np.array_equal(score_binary(np.array([0.0, 2.0, np.nan]), [0, 5]), [0, 5, 0])
+    assert np.array_equal(score_binary(np.array([None, ' ', 'Y', 0], dtype = object), [1, 4]), [1, 1, 4, 1])
+
+def test_plan_priority_adds_criteria_and_keeps_best_soil():
+    rng = np.random.RandomState(1)
+    n = 100
+    columns = {'wetland_p': rng.rand(n), 'hsgA_ac': rng.rand(n), 'hsgB_ac': rng.rand(n), 'lot': rng.rand(n)}
+    plan = ScoringPlan.from_entry_columns(entry_columns(
+        ['wetland_p', 'hsgA_ac', 'lot', 'hsgB_ac', 'unused'], [2.0, 1.5, 0.5, 3.0, 0],
+        [[0.5], [0.3], [0.2], [0.6], [0.1]], [[1, 0], [2, 1], [4, 0], [1, 0], [1, 0]]))
+    assert plan.fields == ['wetland_p', 'hsgA_ac', 'lot', 'hsgB_ac']
+
+    (scores, pri, errors) = plan.evaluate(columns)
+    expected = []
+    for k in range(n):
+        wetland = 2.0*(1 if columns['wetland_p'][k] > 0.5 else 0)
+        lot = 0.5*(4 if columns['lot'][k] > 0.2 else 0)
+        soil = max(1.5*(2 if columns['hsgA_ac'][k] > 0.3 else 1), 3.0*(1 if columns['hsgB_ac'][k] > 0.6 else 0))
+        expected.append(wetland + lot + soil)
+    assert errors == []
+    assert np.allclose(pri, expected)
+
+@pytest.mark.parametrize('t', range(5))
+def test_theme_batch_matches_plans(t):
+    rng = np.random.RandomState(t)
+    n = 300
+    columns = {'wetland_p': rng.rand(n), 'hsgA_ac': rng.rand(n), 'lot': rng.rand(n)}
+    columns['wetland_p'][::17] = np.nan
+    # Criteria repeated within and across themes, with shared and different
+    # thresholds
+    fields = ['wetland_p', 'hsgA_ac', 'wetland_p', 'hsgA_ac', 'lot', 'hsgA_ac']
+    plans = []
+    for theme in range(3):
+        field_weights = np.round(rng.rand(len(fields))*3, 1)
+        field_weights[rng.rand(len(fields)) < 0.3] = 0
+        field_weights[0] = 1.0
+        threshs = [[rng.choice([0.5, 0.7])] for f in fields]
+        weights = [[rng.randint(1, 5), 0] for f in fields]
+        plans.append(ScoringPlan.from_entry_columns(entry_columns(fields, field_weights.tolist(), threshs, weights)))
+
+    batch = ThemeBatch(['TN', 'TP', 'TSS'], plans)
+    (scores, pri, errors) = batch.evaluate(columns)
+    assert pri.shape == (n, 3)
+    assert len(set(batch.scrnames)) == len(batch.scrnames)
+    for theme in range(3):
+        expected = plans[theme].evaluate(columns)[1]
+        assert np.allclose(pri[:, theme], expected, equal_nan = True)
+
+def test_theme_batch_rejects_empty_themes():
+    plan = ScoringPlan.from_entry_columns(entry_columns(['lot'], [0], [[0.5]], [[1, 0]]))
+    with pytest.raises(ValueError):
+        ThemeBatch(['TN'], [plan])
+    with pytest.raises(ValueError):
+        ThemeBatch(['TN', 'TP'], [plan])
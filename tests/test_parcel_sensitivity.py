@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from parcel_loads import HSG_CLASSES, build_prate_matrix, calc_pexport
+from parcel_rank import epctile, grouped_epctile
+from parcel_sensitivity import (LoadScenarios, align_prates, p_scenarios, quantile_key, scenario_count,
+                                summarize, unit_area_scenarios)
+from test_parcel_loads import LUTYPES, rate_table
+
+
+def random_scenarios(rng, n = 40, k = 25):
+    cells = rng.randint(-1, 6, (n, 3))
+    cells[::9] = -1    # parcels with no rate at all have a null load
+    weights = rng.rand(n, 3)
+    rates = rng.rand(k, 6)
+    return(LoadScenarios(cells, weights, rates))
+
+def naive_loads(scenarios):
+    # sum_j rates[k, cells[n, j]] * weights[n, j], null where a cell is missing
+    (n, m) = scenarios.cells.shape
+    loads = np.zeros((scenarios.nscenarios, n))
+    for k in range(scenarios.nscenarios):
+        for p in range(n):
+            for j in range(m):
+                cell = scenarios.cells[p, j]
+                rate = scenarios.rates[k, cell] if cell < scenarios.rates.shape[1] else scenarios.fill
+                loads[k, p] += rate*scenarios.weights[p, j]
+    return(loads)
+
+
+def test_loads_match_naive_sum():
+    scenarios = random_scenarios(np.random.RandomState(0))
+    expected = naive_loads(scenarios)
+    assert np.allclose(scenarios.loads(), expected, equal_nan = True)
+    assert np.allclose(scenarios.loads(slice(3, 9), slice(5, 20)), expected[3:9, 5:20], equal_nan = True)
+
+@pytest.mark.parametrize('grouped', [False, True])
+@pytest.mark.parametrize('max_cells', [1, 137, 10**6])
+def test_summarize_matches_full_matrix(grouped, max_cells):
+    rng = np.random.RandomState(1)
+    scenarios = random_scenarios(rng)
+    n = len(scenarios)
+    acres = rng.rand(n) + 0.5
+    groups = rng.randint(0, 3, n) if grouped else None
+    quantiles = [0.025, 0.03, 0.5, 0.975]
+
+    stats = summarize(scenarios, acres, groups, quantiles, 0.8, max_cells)
+
+    loads = naive_loads(scenarios)
+    rankvalues = loads/acres
+    if grouped:
+        pctiles = np.array([grouped_epctile(row, groups) for row in rankvalues])
+    else:
+        pctiles = np.array([epctile(row) for row in rankvalues])
+    null = np.isnan(loads).any(axis = 0)
+    assert np.allclose(stats['mean'], loads.mean(axis = 0), equal_nan = True)
+    assert np.allclose(stats['std'], loads.std(axis = 0), equal_nan = True)
+    assert np.allclose(stats['pct_mean'][~null], pctiles.mean(axis = 0)[~null])
+    assert np.allclose(stats['pct_std'][~null], pctiles.std(axis = 0)[~null])
+    assert np.allclose(stats['p_top'][~null], (pctiles >= 0.8).mean(axis = 0)[~null])
+    for name in ('pct_mean', 'pct_std', 'p_top'):
+        assert np.isnan(stats[name][null]).all()
+    for q in quantiles:
+        with np.errstate(invalid = 'ignore'):
+            expected = np.percentile(loads, q*100, axis = 0)
+        assert np.allclose(stats[quantile_key(q)][~null], expected[~null])
+
+def test_quantile_keys_are_distinct():
+    assert [quantile_key(q) for q in [0.05, 0.5, 0.95, 0.025, 0.03, 0.975]] == \
+        ['q05', 'q50', 'q95', 'q02_5', 'q03', 'q97_5']
+    scenarios = random_scenarios(np.random.RandomState(2))
+    with pytest.raises(ValueError):
+        summarize(scenarios, quantiles = [0.5, 0.5])
+
+def test_single_table_scenarios_match_single_load():
+    rng = np.random.RandomState(3)
+    n = 60
+    lutype = np.array(LUTYPES)[rng.randint(0, len(LUTYPES), n)]
+    hsgtype = np.array(HSG_CLASSES)[rng.randint(0, len(HSG_CLASSES), n)]
+    area = rng.rand(n)*20000 + 1000
+    impervpct = rng.rand(n)*100
+    prates = build_prate_matrix(rate_table(rng))
+
+    parcels = {'Code_1_2': lutype, 'pct_imperv': impervpct, 'lot_areaft': area}
+    expected = calc_pexport(parcels, prates, hsgtype = hsgtype)[0]
+    loads = p_scenarios(lutype, hsgtype, area, impervpct, align_prates([prates])).loads()
+    assert np.allclose(loads[0], expected)
+
+    rates = rng.rand(4, 3)
+    loads = unit_area_scenarios(lutype, area, LUTYPES[:3], rates).loads()
+    for k in range(4):
+        for p in range(n):
+            if lutype[p] in LUTYPES[:3]:
+                assert np.isclose(loads[k, p], rates[k, LUTYPES.index(lutype[p])]*area[p]/43560.0)
+            else:
+                assert np.isnan(loads[k, p])
+
+def test_scenario_count():
+    assert scenario_count(100, [0, 0]) == 100
+    assert scenario_count(0, [5, 5]) == 5
+    with pytest.raises(ValueError):
+        scenario_count(0, [5, 4])
+    with pytest.raises(ValueError):
+        scenario_count(100, [5, 0])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from parcel_tiles import parcel_cost, tile_extents, tile_partition, tile_summary
+
+
+@pytest.mark.parametrize('ntiles', [1, 2, 7, 50])
+def test_tile_partition_balances_cost(ntiles):
+    rng = np.random.RandomState(ntiles)
+    n = 500
+    (x, y) = (rng.rand(n)*1000, rng.rand(n)*1000)
+    x[::50] = np.nan
+    cost = parcel_cost(rng.randint(4, 200, n))
+
+    tiles = tile_partition(x, y, cost, ntiles)
+    (counts, costs, imbalance) = tile_summary(tiles, cost)
+    assert counts.sum() == n
+    assert (counts > 0).all()
+    assert len(counts) <= ntiles
+    assert (tiles[np.isnan(x)] == 0).all()
+    # Apart from the parcels without a centroid, no tile holds more than its
+    # share plus one parcel
+    valid = ~np.isnan(x)
+    costs = tile_summary(tiles[valid], cost[valid])[1]
+    assert costs.max() <= cost[valid].sum()/len(counts) + cost.max()
+
+def test_tile_extents_match_per_tile_loop():
+    rng = np.random.RandomState(0)
+    n = 200
+    corner = rng.rand(n, 2)*100
+    bounds = np.column_stack([corner, corner + rng.rand(n, 2)*5])
+    bounds[7] = np.nan
+    tiles = rng.randint(0, 6, n)
+
+    extents = tile_extents(bounds, tiles, margin = 2.0)
+    for t in range(6):
+        rows = bounds[tiles == t]
+        expected = [np.nanmin(rows[:, 0]) - 2, np.nanmin(rows[:, 1]) - 2, np.nanmax(rows[:, 2]) + 2, np.nanmax(rows[:, 3]) + 2]
+        assert np.allclose(extents[t], expected)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pytest
+
+from spatial_cache import PackedRTree, SpatialIndexCache, hilbert_index, layer_fingerprint
+
+
+def random_boxes(rng, n, size = 0.05):
+    corner = rng.rand(n, 2)
+    return(np.column_stack([corner, corner + rng.rand(n, 2)*size]))
+
+def brute_force(bounds, queries):
+    pairs = set()
+    for (q, box) in enumerate(queries):
+        for (f, feature) in enumerate(bounds):
+            if np.isnan(feature).any():
+                continue
+            if box[0] <= feature[2] and box[2] >= feature[0] and box[1] <= feature[3] and box[3] >= feature[1]:
+                pairs.add((q, f))
+    return(pairs)
+
+
+@pytest.mark.parametrize('n', [0, 1, 15, 16, 17, 300])
+@pytest.mark.parametrize('node_size', [2, 16])
+def test_query_matches_brute_force(n, node_size):
+    rng = np.random.RandomState(n)
+    bounds = random_boxes(rng, n)
+    if n > 2:
+        bounds[1] = np.nan
+    queries = random_boxes(rng, 40, 0.2)
+    tree = PackedRTree.build(bounds, node_size)
+    (q, f) = tree.query(queries, chunk_size = 7)
+    assert len(set(zip(q.tolist(), f.tolist()))) == len(q)
+    assert set(zip(q.tolist(), f.tolist())) == brute_force(bounds, queries)
+
+def test_hilbert_index_visits_every_cell_once():
+    (x, y) = np.meshgrid(np.arange(8), np.arange(8))
+    d = hilbert_index(x.ravel(), y.ravel(), (0, 0, 7, 7), order = 3)
+    assert sorted(d.tolist()) == list(range(64))
+    # Consecutive positions are neighbouring cells
+    order = np.argsort(d)
+    steps = np.abs(np.diff(x.ravel()[order])) + np.abs(np.diff(y.ravel()[order]))
+    assert (steps == 1).all()
+
+def test_cache_reuses_and_evicts(tmp_path):
+    folder = str(tmp_path)
+    os.makedirs(os.path.join(folder, 'project.gdb'))
+    os.makedirs(os.path.join(folder, 'partial_interrupted'))
+    bounds = random_boxes(np.random.RandomState(0), 2000)
+
+    cache = SpatialIndexCache(folder, budget = 0.2)
+    cache.sweep()
+    assert sorted(os.listdir(folder)) == ['manifest.json', 'project.gdb']
+
+    (first, tree) = cache.index(['parcels.shp', 1], bounds)
+    assert cache.index(['parcels.shp', 1], bounds)[0] == first
+    assert first == layer_fingerprint(['parcels.shp', 1])
+    (second, tree) = cache.index(['parcels.shp', 2], bounds)
+    (third, tree) = cache.index(['soils.shp', 1], bounds)
+    # Three indexes do not fit in 0.2 MB: the least recently used go first
+    assert cache.size() <= 0.2*2**20
+    assert cache.path(third)[len(folder) + 1:] in cache.entries
+    assert not os.path.exists(cache.path(first))
+    assert os.path.exists(os.path.join(folder, 'project.gdb'))
+
+    reloaded = SpatialIndexCache(folder, budget = 0.2)
+    assert sorted(reloaded.entries) == sorted(cache.entries)
+    queries = random_boxes(np.random.RandomState(1), 20, 0.2)
+    (q, f) = reloaded.get(third).query(queries)
+    assert set(zip(q.tolist(), f.tolist())) == brute_force(bounds, queries)